@@ -2,12 +2,24 @@
 # SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
+import asyncio
+import hashlib
+import json
+import logging
+import mmap
 import os
+import shutil
+import threading
+from functools import lru_cache
 from pathlib import Path
+from urllib.parse import urlparse
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import shapely
+
+_logger = logging.getLogger(__name__)
 
 
 def sets_path_to_root(root_directory_name):
@@ -322,6 +334,362 @@ def progress_retrieve(url, file, data=None, disable_progress=False, roundto=1.0)
     urllib.request.urlretrieve(url, file, reporthook=dlProgress, data=data)
 
 
+class DownloadManager:
+    """
+    Asyncio download manager with bounded concurrency per host
+
+    The files are downloaded into {file}.part, resumed with HTTP range requests
+    when a partial file exists and atomically renamed into file on completion.
+    The ETag or Last-Modified validator of the partial file is stored in
+    {file}.part.json and sent with If-Range, so that a file changed on the
+    server since the partial download is downloaded again from the start;
+    partial files without validator are discarded.
+    Connection errors, incomplete transfers and server errors are retried,
+    resuming the partial file; the other failures move to the next url.
+    The completed files are recorded in the manifest download_manifest.json
+    of their folder, with the url and the size of the file, so that they
+    are not downloaded again unless update is true.
+
+    Parameters
+    ----------
+    max_per_host : int
+        Maximum number of concurrent downloads per host
+    update : bool
+        When true, the files are downloaded again even if completed
+    verify : bool
+        Verify the SSL certificate of the servers
+    chunk_size : int
+        Size of the chunks written to disk
+    timeout : float
+        Timeout of the requests in seconds
+    retries : int
+        Number of additional attempts per url after a transient failure
+    retry_wait : float
+        Waiting time in seconds before the first retry, increased linearly
+    """
+
+    manifest_name = "download_manifest.json"
+
+    def __init__(
+        self,
+        max_per_host=4,
+        update=False,
+        verify=True,
+        chunk_size=1024 * 1024,
+        timeout=60,
+        retries=3,
+        retry_wait=1.0,
+    ):
+        self.max_per_host = max_per_host
+        self.update = update
+        self.verify = verify
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self._semaphores = {}
+        self._manifest_lock = threading.Lock()
+
+    def _manifest_path(self, file):
+        return os.path.join(os.path.dirname(os.path.abspath(file)), self.manifest_name)
+
+    def _read_manifest(self, manifest_path):
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path) as f:
+                return json.load(f)
+        except ValueError:
+            _logger.warning(f"Invalid download manifest {manifest_path}: it is reset")
+            return {}
+
+    def is_completed(self, file):
+        "Check whether file is a completed download of the manifest"
+        if not os.path.exists(file):
+            return False
+        with self._manifest_lock:
+            manifest = self._read_manifest(self._manifest_path(file))
+        entry = manifest.get(os.path.basename(file))
+        return entry is not None and entry["size"] == os.path.getsize(file)
+
+    def _add_to_manifest(self, url, file):
+        manifest_path = self._manifest_path(file)
+        with self._manifest_lock:
+            manifest = self._read_manifest(manifest_path)
+            manifest[os.path.basename(file)] = {
+                "url": url,
+                "size": os.path.getsize(file),
+            }
+            tmp_path = manifest_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(tmp_path, manifest_path)
+
+    @staticmethod
+    def _get_validator(headers):
+        "Get the validator of a response for If-Range: strong ETag or Last-Modified"
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return headers.get("Last-Modified")
+
+    def _discard_part(self, part_file):
+        for fn in [part_file, part_file + ".json"]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def _read_part_validator(self, url, part_file):
+        "Get the validator of the partial download of url, if any"
+        try:
+            with open(part_file + ".json") as f:
+                part_info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if part_info.get("url") != url:
+            return None
+        return part_info.get("validator")
+
+    def _fetch(self, url, file, size_min):
+        """
+        Blocking download of url into file; returns true when successful
+
+        Transient failures raise an exception, so that the download is retried
+        """
+        import requests
+
+        part_file = file + ".part"
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        validator = self._read_part_validator(url, part_file) if offset > 0 else None
+        if offset > 0 and validator is None:
+            # the partial file cannot be validated against the remote file
+            _logger.info(f"Partial file {part_file} discarded: no validator")
+            self._discard_part(part_file)
+            offset = 0
+        headers = (
+            {"Range": f"bytes={offset}-", "If-Range": validator} if offset > 0 else {}
+        )
+
+        with requests.get(
+            url,
+            stream=True,
+            headers=headers,
+            verify=self.verify,
+            timeout=self.timeout,
+        ) as r:
+            if r.status_code == 416 and offset > 0:
+                # the partial file may be already complete: check its size
+                total_size = r.headers.get("Content-Range", "").split("/")[-1]
+                if total_size != str(offset):
+                    self._discard_part(part_file)
+                    raise IOError(
+                        f"Partial file {part_file} of {offset} bytes does not match "
+                        f"the {total_size or 'unknown'} bytes of {url}: restarted"
+                    )
+            elif r.status_code in [200, 206]:
+                if r.status_code == 206:
+                    if self._get_validator(r.headers) not in [None, validator]:
+                        # If-Range ignored by the server and file changed
+                        self._discard_part(part_file)
+                        raise IOError(f"File {url} changed since the partial download")
+                    total_size = int(r.headers["Content-Range"].split("/")[-1])
+                    mode = "ab"
+                elif "Content-Encoding" in r.headers:
+                    # the size of the decoded content is unknown
+                    total_size = -1
+                    mode = "wb"
+                else:
+                    # the range is not supported: restart the download
+                    total_size = int(r.headers.get("Content-Length", -1))
+                    mode = "wb"
+
+                if 0 <= total_size <= size_min:
+                    _logger.warning(
+                        f"File {url} of {total_size} bytes smaller than {size_min} bytes"
+                    )
+                    return False
+
+                if mode == "wb":
+                    # store the validator of the new partial file
+                    with open(part_file + ".json", "w") as f:
+                        json.dump(
+                            {"url": url, "validator": self._get_validator(r.headers)},
+                            f,
+                        )
+
+                with open(part_file, mode) as f:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+
+                if 0 <= total_size != os.path.getsize(part_file):
+                    raise IOError(
+                        f"Incomplete download of {url}: {os.path.getsize(part_file)} of {total_size} bytes"
+                    )
+            elif r.status_code >= 500:
+                r.raise_for_status()
+            else:
+                _logger.error(
+                    f"Error code: {r.status_code}. File {os.path.basename(file)} not downloaded from {url}"
+                )
+                return False
+
+        os.replace(part_file, file)
+        self._discard_part(part_file)
+        self._add_to_manifest(url, file)
+        return True
+
+    async def download(self, urls, file, size_min=0):
+        """
+        Download file from the first working url of urls
+
+        Parameters
+        ----------
+        urls : str or list
+            Url or list of alternative urls of the file
+        file : str
+            Path of the downloaded file
+        size_min : int
+            Files of size_min bytes or less are discarded
+
+        Returns
+        -------
+        downloaded : bool
+            True when the file is available
+        """
+        if isinstance(urls, str):
+            urls = [urls]
+
+        if not self.update and self.is_completed(file):
+            return True
+
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+
+        loop = asyncio.get_running_loop()
+        for url in urls:
+            host = urlparse(url).netloc
+            if host not in self._semaphores:
+                self._semaphores[host] = asyncio.Semaphore(self.max_per_host)
+
+            downloaded = False
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    await asyncio.sleep(self.retry_wait * attempt)
+
+                async with self._semaphores[host]:
+                    try:
+                        downloaded = await loop.run_in_executor(
+                            None, self._fetch, url, file, size_min
+                        )
+                        break
+                    except Exception as e:
+                        _logger.warning(
+                            f"Download of {url} failed (attempt {attempt + 1} of {self.retries + 1}): {e}"
+                        )
+
+            if downloaded:
+                return True
+
+        return False
+
+    async def download_all(self, downloads, size_min=0):
+        "Download concurrently the (urls, file) pairs of downloads"
+        return await asyncio.gather(
+            *[self.download(urls, file, size_min) for urls, file in downloads]
+        )
+
+
+def download_files(downloads, size_min=0, **kwargs):
+    """
+    Function to download files concurrently with a DownloadManager
+
+    Parameters
+    ----------
+    downloads : list
+        List of (urls, file) pairs; urls is a url or a list of alternative urls
+    size_min : int
+        Files of size_min bytes or less are discarded
+    **kwargs
+        Options of the DownloadManager, e.g. max_per_host, update and verify
+
+    Returns
+    -------
+    downloaded : list
+        For each pair, true when the file is available
+    """
+    manager = DownloadManager(**kwargs)
+    return asyncio.run(manager.download_all(downloads, size_min=size_min))
+
+
+def calculate_md5(fname, chunk_size=64 * 1024 * 1024):
+    """Calculate the md5 of a file hashing large chunks of its memory map"""
+    hash_md5 = hashlib.md5()
+    with open(fname, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hash_md5.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for start in range(0, len(mm), chunk_size):
+                    hash_md5.update(view[start : start + chunk_size])
+            finally:
+                view.release()
+    return hash_md5.hexdigest()
+
+
+def get_file_md5(fname, cache_dir=None):
+    """
+    Get the md5 of a file, reusing the cached value when the file is unchanged
+
+    When cache_dir is specified, the md5 is cached in {cache_dir}/md5 keyed on
+    the absolute path, the size and the modification time of the file, that
+    identify an unchanged file; otherwise the md5 is always computed.
+    """
+    if not cache_dir:
+        return calculate_md5(fname)
+
+    path = os.path.abspath(fname)
+    path_key = hashlib.sha256(path.encode()).hexdigest()[:20]
+    cache_file = os.path.join(cache_dir, "md5", f"{path_key}.json")
+    stat = os.stat(fname)
+    key = {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+            if all(cache.get(k) == v for k, v in key.items()):
+                return cache["md5"]
+        except (ValueError, KeyError):
+            _logger.warning(
+                f"Invalid md5 cache {cache_file}: the md5 is computed again"
+            )
+
+    md5 = calculate_md5(fname)
+
+    # write to a temporary file of the process to avoid races between processes
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({**key, "md5": md5}, f)
+    os.replace(tmp_file, cache_file)
+
+    return md5
+
+
+def get_cache_key(files, cache_dir=None, **options):
+    """
+    Get a content-addressed key of the files and the options
+
+    The key changes whenever the content of any file or the value of any
+    option changes; options shall be json serializable. The md5 of the files
+    are cached in cache_dir, when specified.
+    """
+    hash_key = hashlib.sha256()
+    for fname in files:
+        hash_key.update(get_file_md5(fname, cache_dir).encode())
+    hash_key.update(json.dumps(options, sort_keys=True).encode())
+    return hash_key.hexdigest()[:20]
+
+
 def get_aggregation_strategies(aggregation_strategies):
     """
     default aggregation strategies that cannot be defined in .yaml format must be specified within
@@ -413,6 +781,34 @@ def mock_snakemake(rulename, **wildcards):
     return snakemake
 
 
+@lru_cache(maxsize=None)
+def get_country_table(source, target):
+    """
+    Function to get the lookup table from the source to the target country codes
+
+    The table is built from pycountry once per process and its keys are
+    the lowercase source codes, as the lookups of pycountry are case insensitive
+
+    Parameters
+    ----------
+    source: str
+        Type of the country code of the keys, e.g. 'alpha_2'
+    target: str
+        Type of the country code of the values, e.g. 'alpha_3' or 'name'
+
+    Returns
+    -------
+    dict from the lowercase source codes to the target codes
+    """
+    import pycountry as pyc
+
+    return {
+        getattr(c, source).lower(): getattr(c, target, np.nan)
+        for c in pyc.countries
+        if hasattr(c, source)
+    }
+
+
 def get_country(target, **keys):
     """
     Function to convert country codes using pycountry
@@ -444,15 +840,19 @@ def get_country(target, **keys):
     - Convert 2-digit code to full name: get_country('name', alpha_2="ZA")
 
     """
-    import pycountry as pyc
-
     assert len(keys) == 1
+    [(source, code)] = keys.items()
     try:
-        return getattr(pyc.countries.get(**keys), target)
-    except (KeyError, AttributeError):
+        return get_country_table(source, target).get(code.lower(), np.nan)
+    except AttributeError:
         return np.nan
 
 
+def _map_unique(series, func, **kwargs):
+    "Function to apply func to a Series by mapping its unique non-null values"
+    return series.map({x: func(x, **kwargs) for x in series.dropna().unique()})
+
+
 def getContinent(code):
     """
     Returns continent names that contains list of iso-code countries
@@ -597,6 +997,33 @@ def country_name_2_two_digits(country_name):
     return full_name
 
 
+def two_2_three_digits_country_series(two_code_countries):
+    "Convert a Series of 2-digit to 3-digit country codes; see two_2_three_digits_country"
+    return _map_unique(two_code_countries, two_2_three_digits_country)
+
+
+def three_2_two_digits_country_series(three_code_countries):
+    "Convert a Series of 3-digit to 2-digit country codes; see three_2_two_digits_country"
+    return _map_unique(three_code_countries, three_2_two_digits_country)
+
+
+def two_digits_2_name_country_series(
+    two_code_countries, nocomma=False, remove_start_words=[]
+):
+    "Convert a Series of 2-digit country codes to full names; see two_digits_2_name_country"
+    return _map_unique(
+        two_code_countries,
+        two_digits_2_name_country,
+        nocomma=nocomma,
+        remove_start_words=remove_start_words,
+    )
+
+
+def country_name_2_two_digits_series(country_names):
+    "Convert a Series of full country names to 2-digit codes; see country_name_2_two_digits"
+    return _map_unique(country_names, country_name_2_two_digits)
+
+
 NA_VALUES = ["NULL"]
 
 
@@ -642,3 +1069,400 @@ def read_geojson(fn):
     else:
         # else return an empty GeoDataFrame
         return gpd.GeoDataFrame(geometry=[])
+
+
+def set_osm_dtypes(df, dtypes):
+    """
+    Parse the columns of df into the dtypes given by the schema dtypes.
+    Numeric columns are converted once with pd.to_numeric and categorical
+    columns are stored as pandas categoricals; missing columns are skipped.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Dataframe to convert
+    dtypes : dict
+        Dictionary of column names and target dtypes, e.g. lines_dtypes in config_osm_data.py
+    """
+    for col, dtype in dtypes.items():
+        if col not in df.columns:
+            continue
+        if dtype == "category":
+            df[col] = df[col].astype("category")
+        else:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(dtype)
+    return df
+
+
+# extensions of the columnar formats of the raw OSM data
+RAW_FORMATS = {"parquet": ".parquet", "flatgeobuf": ".fgb"}
+
+
+def get_raw_path(fn, raw_format):
+    "Function to get the path of the raw data file in raw_format next to the geojson fn"
+    return os.path.splitext(fn)[0] + RAW_FORMATS[raw_format]
+
+
+def save_raw_geodata(df, fn, raw_format="parquet", export_geojson=False):
+    """
+    Function to save the raw data in a columnar format next to the geojson file fn
+
+    The geojson file fn, expected by snakemake, is written only when
+    raw_format is "geojson" or export_geojson is true;
+    otherwise an empty placeholder file is created.
+    """
+    if raw_format != "geojson" and raw_format not in RAW_FORMATS:
+        raise ValueError(
+            f"Unknown raw format {raw_format}; options: geojson, {', '.join(RAW_FORMATS)}"
+        )
+
+    # remove outdated files of any format
+    for ext in RAW_FORMATS.values():
+        fn_raw = os.path.splitext(fn)[0] + ext
+        if os.path.exists(fn_raw):
+            os.unlink(fn_raw)
+
+    if raw_format == "geojson" or export_geojson:
+        save_to_geojson(df, fn)
+    else:
+        # create empty file to avoid issues with snakemake
+        with open(fn, "w") as fp:
+            pass
+
+    if raw_format == "geojson" or df.empty:
+        return
+
+    if raw_format == "parquet":
+        df.to_parquet(get_raw_path(fn, raw_format))
+    else:
+        df.to_file(get_raw_path(fn, raw_format), driver="FlatGeobuf")
+
+
+def read_raw_geodata(fn):
+    """
+    Function to read the raw data saved by save_raw_geodata
+
+    The columnar file next to the geojson file fn is preferred when available
+    """
+    fn_parquet = get_raw_path(fn, "parquet")
+    if os.path.exists(fn_parquet):
+        return gpd.read_parquet(fn_parquet)
+
+    fn_fgb = get_raw_path(fn, "flatgeobuf")
+    if os.path.exists(fn_fgb):
+        return gpd.read_file(fn_fgb)
+
+    return read_geojson(fn)
+
+
+def get_raw_files(fn):
+    "Function to get the existing files of the raw data saved by save_raw_geodata"
+    fn_raws = [get_raw_path(fn, raw_format) for raw_format in RAW_FORMATS] + [fn]
+    return [fn_raw for fn_raw in fn_raws if os.path.exists(fn_raw)]
+
+
+def cached_geodata(cache_path, func, *args, **kwargs):
+    """
+    Function to read the result of func(*args, **kwargs) from the parquet
+    file cache_path, when available, or to compute and cache it otherwise
+
+    When cache_path is None, the caching is disabled. Empty results are not cached.
+    """
+    if cache_path is None:
+        return func(*args, **kwargs)
+
+    if os.path.exists(cache_path):
+        _logger.info(f"Reading cached intermediate result {cache_path}")
+        return gpd.read_parquet(cache_path)
+
+    df = func(*args, **kwargs)
+
+    if not df.empty:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        # write to a temporary file first to avoid partial cache files
+        df.to_parquet(cache_path + ".part")
+        os.replace(cache_path + ".part", cache_path)
+
+    return df
+
+
+def cached_geodata_chunks(cache_path, func, *args, read_chunk_size=None, **kwargs):
+    """
+    Function to iterate over the chunks of the result of func(*args, **kwargs),
+    a generator of dataframes, reading them from the cache directory cache_path,
+    when available, or computing and caching them otherwise
+
+    The chunks are written to disk one by one as parquet files, so that the
+    result is never held in memory as a whole; cached chunks are read
+    in chunks of read_chunk_size rows, or at once when read_chunk_size is None.
+    When cache_path is None, the caching is disabled. Empty results are not cached.
+    """
+    if cache_path is None:
+        yield from func(*args, **kwargs)
+        return
+
+    if os.path.isdir(cache_path):
+        _logger.info(f"Reading cached intermediate result {cache_path}")
+        for fn in sorted(os.listdir(cache_path)):
+            fn_part = os.path.join(cache_path, fn)
+            if read_chunk_size:
+                yield from iter_parquet_geodata(fn_part, read_chunk_size)
+            else:
+                yield gpd.read_parquet(fn_part)
+        return
+
+    # write to a temporary directory first to avoid partial caches
+    part_path = cache_path + ".part"
+    if os.path.isdir(part_path):
+        shutil.rmtree(part_path)
+    os.makedirs(part_path)
+
+    n_parts = 0
+    for df in func(*args, **kwargs):
+        if not df.empty:
+            df.to_parquet(os.path.join(part_path, f"{n_parts:06d}.parquet"))
+            n_parts += 1
+        yield df
+
+    if n_parts:
+        os.replace(part_path, cache_path)
+    else:
+        os.rmdir(part_path)
+
+
+def iter_parquet_geodata(fn_parquet, chunk_size, columns=None):
+    """
+    Function to read the geoparquet file fn_parquet in chunks of chunk_size rows
+
+    When columns is specified, only the available columns among them are read,
+    without geometry.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(fn_parquet)
+
+    if columns is not None:
+        columns = [c for c in columns if c in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(chunk_size, columns=columns):
+            yield batch.to_pandas()
+        return
+
+    geo = json.loads(parquet_file.schema_arrow.metadata[b"geo"])
+    geom_col = geo["primary_column"]
+    crs = geo["columns"][geom_col].get("crs", "OGC:CRS84")
+
+    for batch in parquet_file.iter_batches(chunk_size):
+        df = batch.to_pandas()
+        geometry = gpd.GeoSeries.from_wkb(df.pop(geom_col), crs=crs)
+        yield gpd.GeoDataFrame(df, geometry=geometry)
+
+
+def iter_raw_geodata(fn, chunk_size, columns=None):
+    """
+    Function to read the raw data saved by save_raw_geodata in chunks of chunk_size rows
+
+    When columns is specified, only the available columns among them are read,
+    without geometry. Empty files yield no chunk.
+    """
+    fn_parquet = get_raw_path(fn, "parquet")
+    if os.path.exists(fn_parquet):
+        yield from iter_parquet_geodata(fn_parquet, chunk_size, columns)
+        return
+
+    fn_fgb = get_raw_path(fn, "flatgeobuf")
+    if not os.path.exists(fn_fgb):
+        if os.path.getsize(fn) == 0:
+            return
+        fn_fgb = fn  # read the geojson file
+
+    for df in iter_ogr_geodata(fn_fgb, chunk_size):
+        if columns is not None:
+            df = pd.DataFrame(df[[c for c in columns if c in df.columns]])
+        yield df
+
+
+def iter_ogr_geodata(fn, chunk_size):
+    """
+    Function to read the geojson or flatgeobuf file fn in chunks of chunk_size rows
+
+    The file is opened once and its features are read sequentially, by arrow
+    batches of pyogrio when available, else by the feature iterator of fiona.
+    """
+    try:
+        from pyogrio.raw import open_arrow
+    except ImportError:
+        open_arrow = None
+
+    if open_arrow is not None:
+        with open_arrow(fn, batch_size=chunk_size, use_pyarrow=True) as (meta, reader):
+            geom_col = meta["geometry_name"] or "wkb_geometry"
+            for batch in reader:
+                if batch.num_rows == 0:
+                    continue
+                df = batch.to_pandas()
+                geometry = gpd.GeoSeries.from_wkb(df.pop(geom_col), crs=meta["crs"])
+                yield gpd.GeoDataFrame(df, geometry=geometry)
+        return
+
+    import itertools
+
+    import fiona
+
+    with fiona.open(fn) as src:
+        features = iter(src)
+        while True:
+            chunk = list(itertools.islice(features, chunk_size))
+            if not chunk:
+                return
+            yield gpd.GeoDataFrame.from_features(chunk, crs=src.crs)
+
+
+def get_line_endings(geoms):
+    """
+    Get the start and end points of the lines in a single vectorized pass
+
+    Closed lines have no endings, as their boundary is empty; the endings of
+    closed lines, missing geometries and multi-part geometries are None
+
+    Parameters
+    ----------
+    geoms : array_like
+        Line geometries
+
+    Returns
+    -------
+    start_points, end_points : ndarray
+        Start and end points of the lines
+    start_xy, end_xy : ndarray
+        (n, 2) arrays of the coordinates of the start and end points;
+        NaN when the ending is missing
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    start_points = shapely.get_point(geoms, 0)
+    end_points = shapely.get_point(geoms, -1)
+
+    is_closed = shapely.is_closed(geoms)
+    start_points[is_closed] = None
+    end_points[is_closed] = None
+
+    start_xy = np.column_stack(
+        [shapely.get_x(start_points), shapely.get_y(start_points)]
+    )
+    end_xy = np.column_stack([shapely.get_x(end_points), shapely.get_y(end_points)])
+
+    return start_points, end_points, start_xy, end_xy
+
+
+class CountryShapes:
+    """
+    Lookup of the country of geometries with an STRtree of the prepared
+    country shapes; shared by the scripts that locate assets in countries
+
+    Parameters
+    ----------
+    shapes : GeoSeries
+        Shapes of the countries indexed by their name
+    """
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+        self.crs = shapes.crs
+        self.names = np.asarray(shapes.index, dtype=object)
+        self.geoms = np.asarray(shapes.values, dtype=object)
+        shapely.prepare(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+
+    def __len__(self):
+        return len(self.geoms)
+
+    def __contains__(self, name):
+        return name in self.shapes.index
+
+    def __getitem__(self, name):
+        return self.shapes[name]
+
+    def query(self, geoms, predicate="intersects"):
+        """
+        Pairs of positions (geometry, shape) of the geometries and the shapes
+        that satisfy the predicate, e.g. "intersects" or "within"
+        """
+        return self.tree.query(np.asarray(geoms, dtype=object), predicate=predicate)
+
+    def first_overlap(self, geoms, default_names):
+        """
+        Return, for each geometry, the name of the first shape that intersects it,
+        or the corresponding default name when no shape intersects it
+        """
+        geom_ids, shape_ids = self.query(geoms)
+
+        # position of the first overlapping shape; len(self) when none
+        first_ids = np.full(len(geoms), len(self))
+        np.minimum.at(first_ids, geom_ids, shape_ids)
+
+        has_overlap = first_ids < len(self)
+        names = np.array(default_names, dtype=object)
+        names[has_overlap] = self.names[first_ids[has_overlap]]
+        return names
+
+    def within_any(self, geoms):
+        "Return, for each geometry, true when it is within any of the shapes"
+        geom_ids, _ = self.query(geoms, predicate="within")
+        is_within = np.zeros(len(geoms), dtype=bool)
+        is_within[geom_ids] = True
+        return is_within
+
+
+def create_extended_country_shapes(country_shapes, offshore_shapes):
+    """Obtain the extended country shape by merging on- and off-shore shapes"""
+    offshore_geoms = offshore_shapes.reindex(country_shapes.index).values
+    has_offshore = ~shapely.is_missing(offshore_geoms)
+
+    geoms = np.asarray(country_shapes.values, dtype=object).copy()
+    geoms[has_offshore] = shapely.union(
+        geoms[has_offshore], offshore_geoms[has_offshore]
+    )
+
+    return gpd.GeoSeries(
+        geoms, index=country_shapes.index.rename("name"), crs=country_shapes.crs
+    )
+
+
+def load_extended_country_shapes(
+    country_shapes_fn, offshore_shapes_fn=None, cache_dir=None
+):
+    """
+    Load the country lookup of the extended country shapes, obtained by
+    merging the on- and off-shore shapes
+
+    When cache_dir is specified, the extended shapes are cached on disk
+    as a parquet file keyed by the content of the shape files
+
+    Returns
+    -------
+    country_lookup : CountryShapes
+        Prepared and STRtree-indexed extended country shapes
+    """
+    files = [country_shapes_fn]
+    if offshore_shapes_fn is not None and os.path.getsize(offshore_shapes_fn) > 0:
+        files.append(offshore_shapes_fn)
+
+    def build_shapes():
+        country_shapes = gpd.read_file(country_shapes_fn).set_index("name")["geometry"]
+        if len(files) == 1:
+            _logger.info("No offshore file exist. Passing only onshore shape")
+            return gpd.GeoDataFrame(geometry=country_shapes)
+
+        _logger.info("Combining on- and offshore shape")
+        offshore_shapes = gpd.read_file(offshore_shapes_fn).set_index("name")[
+            "geometry"
+        ]
+        return gpd.GeoDataFrame(
+            geometry=create_extended_country_shapes(country_shapes, offshore_shapes)
+        )
+
+    cache_path = None
+    if cache_dir:
+        key = get_cache_key(files, cache_dir)
+        cache_path = os.path.join(cache_dir, f"ext_country_shapes_{key}.parquet")
+
+    return CountryShapes(cached_geodata(cache_path, build_shapes)["geometry"])
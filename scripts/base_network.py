@@ -67,10 +67,9 @@ import scipy as sp
 import shapely.prepared
 import shapely.wkt
 import yaml
-from _helpers import configure_logging, read_csv_nafix
+from _helpers import CountryShapes, configure_logging, read_csv_nafix, read_geojson
 from scipy.sparse import csgraph
 from shapely.geometry import LineString, Point
-from shapely.ops import unary_union
 
 logger = logging.getLogger(__name__)
 
@@ -332,21 +331,15 @@ def _set_countries_and_substations(n):
     buses = n.buses
 
     countries = snakemake.config["countries"]
-    country_shapes = gpd.read_file(snakemake.input.country_shapes).set_index("name")[
-        "geometry"
-    ]
-    offshore_shapes = unary_union(
-        gpd.read_file(snakemake.input.offshore_shapes)["geometry"]
+    offshore_shapes = CountryShapes(
+        read_geojson(snakemake.input.offshore_shapes)["geometry"]
     )
 
-    bus_locations = buses
-    bus_locations = gpd.GeoDataFrame(
-        bus_locations,
-        geometry=gpd.points_from_xy(bus_locations.x, bus_locations.y),
-        crs=country_shapes.crs,  # the workflow sets the the same crs for buses and shapes
-    )
+    # the workflow sets the the same crs for buses and shapes
+    bus_locations = gpd.points_from_xy(buses.x, buses.y)
+
     # Check if bus is in shape
-    offshore_b = bus_locations.within(offshore_shapes)
+    offshore_b = pd.Series(offshore_shapes.within_any(bus_locations), buses.index)
 
     # Assumption that HV-bus qualifies as potential offshore bus. Offshore bus is empty otherwise.
     offshore_hvb = (
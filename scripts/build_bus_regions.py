@@ -47,7 +47,7 @@ import geopandas as gpd
 import numpy
 import pandas as pd
 import pypsa
-from _helpers import configure_logging, two_2_three_digits_country
+from _helpers import CountryShapes, configure_logging, two_2_three_digits_country
 from shapely.geometry import Point, Polygon
 from vresutils.graph import voronoi_partition_pts
 
@@ -147,38 +147,31 @@ def custom_voronoi_partition_pts(points, outline, add_bounds_shape=True, multipl
     return polygons_arr
 
 
-def get_gadm_shape(onshore_locs, gadm_shapes):
-    def locate_bus(coords):
-        point = Point(Point(coords["x"], coords["y"]))
-        gadm_shapes_country = gadm_shapes.filter(
-            like=two_2_three_digits_country(country), axis=0
-        )
-
-        try:
-            return gadm_shapes[gadm_shapes.contains(point)].item()
-        except ValueError:
-            return min(
-                gadm_shapes_country, key=(point.distance)
-            )  # TODO returns closest shape if the point was not inside one. Works well but will not catch an outlier bus.
-
-    def get_id(coords):
-        point = Point(Point(coords["x"], coords["y"]))
-        gadm_shapes_country = gadm_shapes.filter(
+def get_gadm_shape(onshore_locs, gadm_shapes, country):
+    """
+    Locate the buses in the GADM shapes that contain them with the STRtree of
+    the CountryShapes lookup gadm_shapes; a bus that is not contained by exactly
+    one shape is assigned to the closest shape of its country
+    """
+    points = gpd.points_from_xy(onshore_locs["x"], onshore_locs["y"])
+    point_ids, shape_ids = gadm_shapes.query(points, predicate="within")
+
+    # position of the shape containing each bus; -1 when not exactly one
+    n_shapes = numpy.bincount(point_ids, minlength=len(points))
+    ids = numpy.full(len(points), -1)
+    is_unique = n_shapes[point_ids] == 1
+    ids[point_ids[is_unique]] = shape_ids[is_unique]
+
+    if (ids < 0).any():
+        # TODO returns closest shape if the point was not inside one. Works well but will not catch an outlier bus.
+        gadm_shapes_country = gadm_shapes.shapes.filter(
             like=two_2_three_digits_country(country), axis=0
         )
+        for i in numpy.flatnonzero(ids < 0):
+            closest_id = gadm_shapes_country.distance(points[i]).idxmin()
+            ids[i] = gadm_shapes.shapes.index.get_loc(closest_id)
 
-        try:
-            return gadm_shapes[gadm_shapes.contains(point)].index.item()
-        except ValueError:
-            # return 'not_found'
-            return gadm_shapes_country[
-                gadm_shapes_country.geometry
-                == min(gadm_shapes_country, key=(point.distance))
-            ].index.item()  # TODO returns closest shape if the point was not inside one.
-
-    regions = onshore_locs[["x", "y"]].apply(locate_bus, axis=1)
-    ids = onshore_locs[["x", "y"]].apply(get_id, axis=1)
-    return regions.values, ids.values
+    return gadm_shapes.geoms[ids], gadm_shapes.names[ids]
 
 
 if __name__ == "__main__":
@@ -200,9 +193,9 @@ if __name__ == "__main__":
     offshore_shapes = gpd.read_file(snakemake.input.offshore_shapes).set_index("name")[
         "geometry"
     ]
-    gadm_shapes = gpd.read_file(snakemake.input.gadm_shapes).set_index("GADM_ID")[
-        "geometry"
-    ]
+    gadm_shapes = CountryShapes(
+        gpd.read_file(snakemake.input.gadm_shapes).set_index("GADM_ID")["geometry"]
+    )
 
     onshore_regions = []
     offshore_regions = []
@@ -217,8 +210,9 @@ if __name__ == "__main__":
         onshore_shape = country_shapes[country]
         onshore_locs = n.buses.loc[c_b & n.buses.substation_lv, ["x", "y"]]
         if snakemake.config["cluster_options"]["alternative_clustering"]:
-            onshore_geometry = get_gadm_shape(onshore_locs, gadm_shapes)[0]
-            shape_id = get_gadm_shape(onshore_locs, gadm_shapes)[1]
+            onshore_geometry, shape_id = get_gadm_shape(
+                onshore_locs, gadm_shapes, country
+            )
         else:
             onshore_geometry = custom_voronoi_partition_pts(
                 onshore_locs.values, onshore_shape
@@ -8,9 +8,21 @@ import os
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-from _helpers import configure_logging, read_geojson, sets_path_to_root, to_csv_nafix
+import shapely
+from _helpers import (
+    configure_logging,
+    get_line_endings,
+    read_geojson,
+    set_osm_dtypes,
+    sets_path_to_root,
+    to_csv_nafix,
+)
+from config_osm_data import lines_dtypes, substations_dtypes
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from shapely.geometry import LineString, Point
-from shapely.ops import linemerge, split
+from shapely.ops import linemerge, substring
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
@@ -19,38 +31,41 @@ logger.setLevel(logging.INFO)
 
 def line_endings_to_bus_conversion(lines):
     # Assign to every line a start and end point
-
-    lines["bounds"] = lines["geometry"].boundary  # create start and end point
-
-    lines["bus_0_coors"] = lines["bounds"].map(lambda p: p.geoms[0])
-    lines["bus_1_coors"] = lines["bounds"].map(lambda p: p.geoms[1])
+    start_points, end_points, start_xy, end_xy = get_line_endings(
+        lines["geometry"].values
+    )
+    lines["bus_0_coors"] = gpd.GeoSeries(start_points, lines.index, crs=lines.crs)
+    lines["bus_1_coors"] = gpd.GeoSeries(end_points, lines.index, crs=lines.crs)
 
     # splits into coordinates
-    lines["bus0_lon"] = lines["bus_0_coors"].x
-    lines["bus0_lat"] = lines["bus_0_coors"].y
-    lines["bus1_lon"] = lines["bus_1_coors"].x
-    lines["bus1_lat"] = lines["bus_1_coors"].y
+    lines["bus0_lon"] = start_xy[:, 0]
+    lines["bus0_lat"] = start_xy[:, 1]
+    lines["bus1_lon"] = end_xy[:, 0]
+    lines["bus1_lat"] = end_xy[:, 1]
 
     return lines
 
 
 def create_bus_df_from_lines(substations, lines):
-    # extract columns from substation df
-    bus_s = gpd.GeoDataFrame(columns=substations.columns)
-    bus_e = gpd.GeoDataFrame(columns=substations.columns)
-
-    # Read information from line.csv
-    bus_s[["voltage", "lon", "lat", "geometry", "country"]] = lines[
-        ["voltage", "bus0_lon", "bus0_lat", "bus_0_coors", "country"]
-    ]  # line start points
-    bus_e[["voltage", "lon", "lat", "geometry", "country"]] = lines[
-        ["voltage", "bus1_lon", "bus1_lat", "bus_1_coors", "country"]
-    ]  # line end points
-    bus_all = bus_s.append(bus_e).reset_index(drop=True)
+    # Read information from line.csv: line start points, then line end points
+    buses = gpd.GeoDataFrame(
+        {
+            "voltage": np.tile(lines["voltage"].values, 2),
+            "lon": np.concatenate([lines["bus0_lon"].values, lines["bus1_lon"].values]),
+            "lat": np.concatenate([lines["bus0_lat"].values, lines["bus1_lat"].values]),
+            "geometry": np.concatenate(
+                [lines["bus_0_coors"].values, lines["bus_1_coors"].values]
+            ),
+            "country": np.tile(lines["country"].values, 2),
+        },
+        columns=substations.columns.union(
+            ["voltage", "lon", "lat", "geometry", "country"], sort=False
+        ),
+        crs=lines.crs,
+    )
 
     # Assign index to bus_id
-    bus_all.loc[:, "bus_id"] = bus_all.index
-    buses = bus_all
+    buses.loc[:, "bus_id"] = buses.index
 
     # Removing the NaN
     buses["dc"] = "False"
@@ -64,97 +79,115 @@ def create_bus_df_from_lines(substations, lines):
 
 
 def add_line_endings_tosubstations(substations, lines):
-    # extract columns from substation df
-    bus_s = gpd.GeoDataFrame(columns=substations.columns)
-    bus_e = gpd.GeoDataFrame(columns=substations.columns)
-
     is_ac = lines["tag_frequency"].astype(float) != 0
 
-    # Read information from line.csv
-    bus_s[["voltage", "country"]] = lines[["voltage", "country"]]  # line start points
-    bus_s["geometry"] = lines.geometry.boundary.map(lambda p: p.geoms[0])
-    bus_s["lon"] = bus_s["geometry"].x
-    bus_s["lat"] = bus_s["geometry"].y
-    bus_s["bus_id"] = lines["line_id"].astype(str) + "_s"
-    bus_s["dc"] = ~is_ac
-
-    bus_e[["voltage", "country"]] = lines[["voltage", "country"]]  # line start points
-    bus_e["geometry"] = lines.geometry.boundary.map(lambda p: p.geoms[1])
-    bus_e["lon"] = bus_s["geometry"].x
-    bus_e["lat"] = bus_s["geometry"].y
-    bus_e["bus_id"] = lines["line_id"].astype(str) + "_e"
-    bus_e["dc"] = ~is_ac
-
-    bus_all = pd.concat([bus_s, bus_e], ignore_index=True)
-    # Assign index to bus_id
-    bus_all.loc[:, "bus_id"] = bus_all.index
-    buses = bus_all
-
-    # Add NaN as default
-    bus_all["station_id"] = np.nan
-    # bus_all["dc"] = False  # np.nan
-    # Assuming substations completed for installed lines
-    bus_all["under_construction"] = False
-    bus_all["tag_area"] = 0.0  # np.nan
-    bus_all["symbol"] = "substation"
-    # TODO: this tag may be improved, maybe depending on voltage levels
-    bus_all["tag_substation"] = "transmission"
+    start_points, end_points, start_xy, end_xy = get_line_endings(lines.geometry.values)
+    bus_xy = np.concatenate([start_xy, end_xy])
+
+    # Read information from line.csv: line start points, then line end points
+    bus_all = gpd.GeoDataFrame(
+        {
+            "voltage": np.tile(lines["voltage"].values, 2),
+            "country": np.tile(lines["country"].values, 2),
+            "geometry": np.concatenate([start_points, end_points]),
+            "lon": bus_xy[:, 0],
+            "lat": bus_xy[:, 1],
+            # Assign index to bus_id
+            "bus_id": np.arange(2 * len(lines)),
+            "dc": np.tile(~is_ac.values, 2),
+            # Add NaN as default
+            "station_id": np.nan,
+            # Assuming substations completed for installed lines
+            "under_construction": False,
+            "tag_area": 0.0,  # np.nan
+            "symbol": "substation",
+            # TODO: this tag may be improved, maybe depending on voltage levels
+            "tag_substation": "transmission",
+        },
+        crs=lines.crs,
+    )
 
-    buses = substations.append(bus_all).reset_index(drop=True)
+    buses = pd.concat([substations, bus_all], ignore_index=True)
 
     return buses
 
 
 # tol in m
-def set_substations_ids(buses, distance_crs, tol=2000):
+def set_substations_ids(buses, distance_crs, tol=2000, method="cluster"):
     """
     Function to set substations ids to buses, accounting for location tolerance
 
-    The algorithm is as follows:
-
-    1. initialize all substation ids to -1
-    2. if the current substation has been already visited [substation_id < 0], then skip the calculation
-    3. otherwise:
-        1. identify the substations within the specified tolerance (tol)
-        2. when all the substations in tolerance have substation_id < 0, then specify a new substation_id
-        3. otherwise, if one of the substation in tolerance has a substation_id >= 0, then set that substation_id to all the others;
-           in case of multiple substations with substation_ids >= 0, the first value is picked for all
+    The buses within tolerance are found with a KD-tree of the bus locations.
+    Buses without location are not assigned to any substation (station_id = -1).
+    Two methods are available:
+
+    - "cluster": every pair of buses within tolerance belongs to the same substation,
+      so that the substations are the connected clusters of close buses;
+      the substation ids follow the order of the first bus of each cluster
+    - "first_come": the original sequential algorithm:
+
+        1. initialize all substation ids to -1
+        2. if the current substation has been already visited [substation_id < 0], then skip the calculation
+        3. otherwise:
+            1. identify the substations within the specified tolerance (tol)
+            2. when all the substations in tolerance have substation_id < 0, then specify a new substation_id
+            3. otherwise, if one of the substation in tolerance has a substation_id >= 0, then set that substation_id to all the others;
+               in case of multiple substations with substation_ids >= 0, the first value is picked for all
     """
+    if method not in ["cluster", "first_come"]:
+        raise ValueError(
+            f"Unknown method {method} to set the substation ids; options: cluster, first_come"
+        )
 
-    buses["station_id"] = -1
-
-    # create temporary series to execute distance calculations using m as reference distances
+    # create temporary coordinates to execute distance calculations using m as reference distances
     temp_bus_geom = buses.geometry.to_crs(distance_crs)
+    coords = np.column_stack([temp_bus_geom.x, temp_bus_geom.y])
+    located = np.flatnonzero(~np.isnan(coords).any(axis=1))
+    tree = cKDTree(coords[located])
+
+    station_ids = np.full(len(buses), -1)
+
+    if method == "cluster":
+        # pairs of buses within tolerance, as positions in buses
+        pairs = located[tree.query_pairs(tol, output_type="ndarray")]
+        graph = coo_matrix(
+            (np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+            shape=(len(buses), len(buses)),
+        )
+        _, labels = connected_components(graph, directed=False)
+
+        # number the clusters by their first bus
+        station_ids[located] = pd.factorize(labels[located])[0]
+        buses["station_id"] = station_ids
+        return
 
     # set tqdm options for substation ids
     tqdm_kwargs_substation_ids = dict(
         ascii=False,
         unit=" buses",
-        total=buses.shape[0],
+        total=len(located),
         desc="Set substation ids ",
     )
 
     station_id = 0
-    for i, row in tqdm(buses.iterrows(), **tqdm_kwargs_substation_ids):
-        if buses.loc[i, "station_id"] >= 0:
+    for i in tqdm(located, **tqdm_kwargs_substation_ids):
+        if station_ids[i] >= 0:
             continue
 
         # get substations within tolerance
-        close_nodes = np.flatnonzero(
-            temp_bus_geom.distance(temp_bus_geom.loc[i]) <= tol
-        )
+        close_nodes = np.sort(located[tree.query_ball_point(coords[i], tol)])
 
         if len(close_nodes) == 1:
             # if only one substation is in tolerance, then the substation is the current one iì
             # Note that the node cannot be with substation_id >= 0, given the preliminary check
             # at the beginning of the for loop
-            buses.loc[buses.index[i], "station_id"] = station_id
+            station_ids[i] = station_id
             # update station id
             station_id += 1
         else:
             # several substations in tolerance
             # get their ids
-            subset_substation_ids = buses.loc[buses.index[close_nodes], "station_id"]
+            subset_substation_ids = station_ids[close_nodes]
             # check if all substation_ids are negative (<0)
             all_neg = subset_substation_ids.max() < 0
             # check if at least a substation_id is negative (<0)
@@ -163,31 +196,88 @@ def set_substations_ids(buses, distance_crs, tol=2000):
             if all_neg:
                 # when all substation_ids are negative, then this is a new substation id
                 # set the current station_id and increment the counter
-                buses.loc[buses.index[close_nodes], "station_id"] = station_id
+                station_ids[close_nodes] = station_id
                 station_id += 1
             elif some_neg:
                 # otherwise, when at least a substation_id is non-negative, then pick the first value
                 # and set it to all the other substations within tolerance
-                sub_id = -1
-                for substation_id in subset_substation_ids:
-                    if substation_id >= 0:
-                        sub_id = substation_id
-                        break
-                buses.loc[buses.index[close_nodes], "station_id"] = sub_id
+                sub_id = subset_substation_ids[subset_substation_ids >= 0][0]
+                station_ids[close_nodes] = sub_id
 
+    buses["station_id"] = station_ids
 
-def set_lines_ids(lines, buses, distance_crs):
+
+def get_closest_buses(bus_xy, points_xy):
     """
-    Function to set line buses ids to the closest bus in the list
+    Function to get, for each point, the position of the closest bus and its distance
+
+    The closest buses are found with a KD-tree of the bus locations; as in a
+    brute-force search, ties are resolved to the bus with the lowest position
     """
-    # set tqdm options for set lines ids
-    tqdm_kwargs_line_ids = dict(
-        ascii=False,
-        unit=" lines",
-        total=lines.shape[0],
-        desc="Set line bus ids ",
+    # identical locations are indexed once, by the bus with the lowest position
+    unique_xy, first_ids = np.unique(bus_xy, axis=0, return_index=True)
+    tree = cKDTree(unique_xy)
+
+    k = min(2, len(unique_xy))
+    distances, ids = tree.query(points_xy, k=k)
+    distances = distances.reshape(len(points_xy), k)
+    ids = ids.reshape(len(points_xy), k)
+    closest_ids = first_ids[ids[:, 0]]
+
+    # when the two closest locations are equidistant, resolve the tie by brute force
+    is_tie = (distances[:, 0] == distances[:, -1]) & (k > 1)
+    for i in np.flatnonzero(is_tie):
+        d = np.sqrt(((bus_xy - points_xy[i]) ** 2).sum(axis=1))
+        closest_ids[i] = np.argmin(d)
+
+    return closest_ids, distances[:, 0]
+
+
+def extend_lines_to_buses(geoms, bus0_points, bus1_points):
+    """
+    Function to extend the lines to the buses in a single vectorized pass
+
+    The location of bus0 (bus1) is prepended (appended) to the coordinates of
+    a line when not None, i.e. when the line does not start (end) at the bus
+    """
+    extended = np.array(geoms, dtype=object)
+    has_bus0 = ~shapely.is_missing(bus0_points)
+    has_bus1 = ~shapely.is_missing(bus1_points)
+    ext_ids = np.flatnonzero(has_bus0 | has_bus1)
+    if len(ext_ids) == 0:
+        return extended
+
+    # positions among the extended lines
+    line_xy, line_ids = shapely.get_coordinates(extended[ext_ids], return_index=True)
+    bus0_ids = np.flatnonzero(has_bus0[ext_ids])
+    bus1_ids = np.flatnonzero(has_bus1[ext_ids])
+
+    # coordinates of the extended lines: bus0 (0), line (1) and bus1 (2) points
+    coords = np.concatenate(
+        [
+            shapely.get_coordinates(bus0_points[ext_ids][bus0_ids]),
+            line_xy,
+            shapely.get_coordinates(bus1_points[ext_ids][bus1_ids]),
+        ]
     )
+    ids = np.concatenate([bus0_ids, line_ids, bus1_ids])
+    parts = np.repeat([0, 1, 2], [len(bus0_ids), len(line_ids), len(bus1_ids)])
+
+    # stable sort by line and part keeps the order of the line coordinates
+    order = np.lexsort((parts, ids))
+    extended[ext_ids] = shapely.linestrings(coords[order], indices=ids[order])
+
+    return extended
+
 
+def set_lines_ids(lines, buses, distance_crs):
+    """
+    Function to set line buses ids to the closest bus in the list
+
+    The line endings are snapped in bulk with a KD-tree of the buses having the
+    voltage and the dc flag of the lines; the lines are then extended to the
+    buses they do not start or end at
+    """
     # initialization
     lines["bus0"] = -1
     lines["bus1"] = -1
@@ -195,135 +285,105 @@ def set_lines_ids(lines, buses, distance_crs):
     busesepsg = buses.to_crs(distance_crs)
     linesepsg = lines.to_crs(distance_crs)
 
-    for i, row in tqdm(linesepsg.iterrows(), **tqdm_kwargs_line_ids):
+    bus_xy = np.column_stack([busesepsg.geometry.x, busesepsg.geometry.y])
+    _, _, start_xy, end_xy = get_line_endings(linesepsg.geometry.values)
 
-        row["dc"] = float(row["tag_frequency"]) == 0
+    lines_dc = (lines["tag_frequency"].astype(float) == 0).values
 
-        # select buses having the voltage level of the current line
-        buses_sel = busesepsg[
-            (buses["voltage"] == row["voltage"]) & (buses["dc"] == row["dc"])
-        ]
+    # positions of the closest buses to the line endings
+    bus0_ids = np.full(len(lines), -1)
+    bus1_ids = np.full(len(lines), -1)
+    distance_bus0 = np.zeros(len(lines))
+    distance_bus1 = np.zeros(len(lines))
 
-        # find the closest node of the bus0 of the line
-        bus0_id = buses_sel.geometry.distance(row.geometry.boundary.geoms[0]).idxmin()
-        lines.loc[i, "bus0"] = buses.loc[bus0_id, "bus_id"]
+    groups = pd.DataFrame({"voltage": lines["voltage"].values, "dc": lines_dc})
+    for (voltage, dc), line_ids in groups.groupby(["voltage", "dc"]).indices.items():
+        # select buses having the voltage level of the current lines
+        bus_ids = np.flatnonzero((buses["voltage"] == voltage) & (buses["dc"] == dc))
+        if len(bus_ids) == 0:
+            raise ValueError(
+                f"No bus with voltage {voltage} and dc {dc} to connect the lines"
+            )
 
-        # check if the line starts exactly in the node, otherwise modify the linestring
-        distance_bus0 = busesepsg.geometry.loc[bus0_id].distance(
-            row.geometry.boundary.geoms[0]
+        closest_ids, distance_bus0[line_ids] = get_closest_buses(
+            bus_xy[bus_ids], start_xy[line_ids]
         )
-        if distance_bus0 > 0.0:
-            # the line does not start in the node, thus modify the linestring
-            lines.geometry.loc[i] = linemerge(
-                [
-                    LineString(
-                        [
-                            buses.geometry.loc[bus0_id],
-                            lines.geometry.loc[i].boundary.geoms[0],
-                        ]
-                    ),
-                    lines.geometry.loc[i],
-                ]
-            )
+        bus0_ids[line_ids] = bus_ids[closest_ids]
+        closest_ids, distance_bus1[line_ids] = get_closest_buses(
+            bus_xy[bus_ids], end_xy[line_ids]
+        )
+        bus1_ids[line_ids] = bus_ids[closest_ids]
 
-        # find the closest node of the bus1 of the line
-        bus1_id = buses_sel.geometry.distance(row.geometry.boundary.geoms[1]).idxmin()
-        lines.loc[i, "bus1"] = buses.loc[bus1_id, "bus_id"]
+    lines["bus0"] = buses["bus_id"].values[bus0_ids]
+    lines["bus1"] = buses["bus_id"].values[bus1_ids]
 
-        # check if the line ends exactly in the node, otherwise modify the linestring
-        distance_bus1 = busesepsg.geometry.loc[bus1_id].distance(
-            row.geometry.boundary.geoms[1]
-        )
-        if distance_bus1 > 0.0:
-            # the line does not end in the node, thus modify the linestring
-            lines.geometry.loc[i] = linemerge(
-                [
-                    lines.geometry.loc[i],
-                    LineString(
-                        [
-                            lines.geometry.loc[i].boundary.geoms[1],
-                            buses.geometry.loc[bus1_id],
-                        ]
-                    ),
-                ]
-            )
+    # extend the lines that do not start or end exactly in the node
+    bus_points = buses.geometry.values
+    lines["geometry"] = extend_lines_to_buses(
+        lines.geometry.values,
+        np.where(distance_bus0 > 0.0, bus_points[bus0_ids], None),
+        np.where(distance_bus1 > 0.0, bus_points[bus1_ids], None),
+    )
 
     return lines, buses
 
 
+def _join_unique(s):
+    "Join the unique values of a series with | in order of appearance"
+    return "|".join(s.unique())
+
+
+def _first(s):
+    "First value of a series; unlike the 'first' aggregation, missing values are kept"
+    return s.iloc[0]
+
+
 def merge_stations_same_station_id(
     buses, delta_lon=0.001, delta_lat=0.001, precision=4
 ):
     """
     Function to merge buses with same voltage and station_id
-    This function iterates over all substation ids and creates a bus_id for every substation and voltage level.
+    This function groups all substations by station id, voltage and dc flag and creates a bus_id for every group.
     Therefore, a substation with multiple voltage levels is represented with different buses, one per voltage level
     """
-    # initialize list of cleaned buses
-    buses_clean = []
-
-    # initalize the number of buses
-    n_buses = 0
-
-    for g_name, g_value in buses.groupby(by=["station_id"]):
-
-        # average location of the buses having the same station_id
-        station_point_x = np.round(g_value.geometry.x.mean(), precision)
-        station_point_y = np.round(g_value.geometry.y.mean(), precision)
-
-        # loop for every voltage level in the bus
-        # The location of the buses is averaged; in the case of multiple voltage levels for the same station_id,
-        # each bus corresponding to a voltage level and each polatity is located at a distance regulated by delta_lon/delta_lat
-        v_it = 0
-        for v_name, bus_row in g_value.groupby(by=["voltage", "dc"]):
-
-            lon_bus = np.round(station_point_x + v_it * delta_lon, precision)
-            lat_bus = np.round(station_point_y + v_it * delta_lat, precision)
-
-            # add the bus
-            buses_clean.append(
-                [
-                    n_buses,  # "bus_id"
-                    g_name,  # "station_id"
-                    v_name[0],  # "voltage"
-                    bus_row["dc"].all(),  # "dc"
-                    # bus_row["dc"].all(),  # "dc"
-                    "|".join(bus_row["symbol"].unique()),  # "symbol"
-                    bus_row["under_construction"].any(),  # "under_construction"
-                    "|".join(bus_row["tag_substation"].unique()),  # "tag_substation"
-                    bus_row["tag_area"].sum(),  # "tag_area"
-                    lon_bus,  # "lon"
-                    lat_bus,  # "lat"
-                    bus_row["country"].iloc[0],  # "country"
-                    Point(
-                        lon_bus,
-                        lat_bus,
-                    ),  # "geometry"
-                ]
-            )
+    # average location of the buses having the same station_id
+    station_locs = (
+        pd.DataFrame(
+            {"lon": buses.geometry.x, "lat": buses.geometry.y},
+            index=buses.index,
+        )
+        .groupby(buses["station_id"])
+        .transform("mean")
+        .round(precision)
+    )
 
-            # increase counters
-            v_it += 1
-            n_buses += 1
-
-    # names of the columns
-    buses_clean_columns = [
-        "bus_id",
-        "station_id",
-        "voltage",
-        "dc",
-        "symbol",
-        "under_construction",
-        "tag_substation",
-        "tag_area",
-        "lon",
-        "lat",
-        "country",
-        "geometry",
-    ]
-
-    return gpd.GeoDataFrame(buses_clean, columns=buses_clean_columns).set_crs(
-        crs=buses.crs, inplace=True
+    # merge the buses with the same station_id, voltage and polarity
+    buses_clean = (
+        buses.assign(lon=station_locs["lon"], lat=station_locs["lat"])
+        .groupby(["station_id", "voltage", "dc"], as_index=False)
+        .agg(
+            symbol=("symbol", _join_unique),
+            under_construction=("under_construction", "any"),
+            tag_substation=("tag_substation", _join_unique),
+            tag_area=("tag_area", "sum"),
+            lon=("lon", "mean"),
+            lat=("lat", "mean"),
+            country=("country", _first),
+        )
+    )
+
+    # The location of the buses is averaged; in the case of multiple voltage levels for the same station_id,
+    # each bus corresponding to a voltage level and each polatity is located at a distance regulated by delta_lon/delta_lat
+    v_it = buses_clean.groupby("station_id").cumcount()
+    buses_clean["lon"] = (buses_clean["lon"] + v_it * delta_lon).round(precision)
+    buses_clean["lat"] = (buses_clean["lat"] + v_it * delta_lat).round(precision)
+
+    buses_clean.insert(0, "bus_id", np.arange(len(buses_clean)))
+
+    return gpd.GeoDataFrame(
+        buses_clean,
+        geometry=gpd.points_from_xy(buses_clean["lon"], buses_clean["lat"]),
+        crs=buses.crs,
     )
 
 
@@ -339,62 +399,50 @@ def get_ac_frequency(df, fr_col="tag_frequency"):
     if not grid_freq_levels.empty:
         # AC lines frequency shouldn't be 0Hz
         ac_freq_levels = grid_freq_levels.loc[
-            grid_freq_levels.index.get_level_values(0) != "0"
+            pd.to_numeric(grid_freq_levels.index.get_level_values(0)) != 0
         ]
         ac_freq_default = ac_freq_levels.index.get_level_values(0)[0]
 
     return ac_freq_default
 
 
+def _connect_points(points0, points1):
+    "Straight lines from points0 to points1"
+    coords = np.stack(
+        [shapely.get_coordinates(points0), shapely.get_coordinates(points1)], axis=1
+    )
+    return shapely.linestrings(coords.reshape(-1, 2, 2))
+
+
 def get_transformers(buses, lines):
     """
     Function to create fake transformer lines that connect buses of the same station_id at different voltage
     """
-
-    ac_freq = get_ac_frequency(lines)
-    df_transformers = []
-
     # Transformers should be added between AC buses only
-    buses_ac = buses[~buses["dc"]]
-    for g_name, g_value in buses_ac.sort_values("voltage", ascending=True).groupby(
-        by=["station_id"]
-    ):
-
-        # note: by construction there cannot be more that two buses with the same station_id and same voltage
-        n_voltages = len(g_value)
-
-        if n_voltages > 1:
-
-            for id in range(0, n_voltages - 1):
-                # when g_value has more than one node, it means that there are multiple voltages for the same bus
-                geom_trans = LineString(
-                    [g_value.geometry.iloc[id], g_value.geometry.iloc[id + 1]]
-                )
-
-                df_transformers.append(
-                    [
-                        f"transf_{g_name}_{id}",  # "line_id"
-                        g_value["bus_id"].iloc[id],  # "bus0"
-                        g_value["bus_id"].iloc[id + 1],  # "bus1"
-                        g_value.voltage.iloc[id],  # "voltage_bus0"
-                        g_value.voltage.iloc[id + 1],  # "voltage_bus0"
-                        g_value.country.iloc[id],  # "country"
-                        geom_trans,  # "geometry"
-                    ]
-                )
-
-    # name of the columns
-    trasf_columns = [
-        "line_id",
-        "bus0",
-        "bus1",
-        "voltage_bus0",
-        "voltage_bus1",
-        "country",
-        "geometry",
-    ]
-
-    df_transformers = gpd.GeoDataFrame(df_transformers, columns=trasf_columns)
+    buses_ac = buses[~buses["dc"]].sort_values(["station_id", "voltage"], kind="stable")
+
+    # note: by construction there cannot be more that two buses with the same station_id and same voltage
+    # hence a transformer connects every bus to the next voltage level of the same station_id
+    station_ids = buses_ac["station_id"]
+    pos_bus0 = np.flatnonzero(station_ids.eq(station_ids.shift(-1)))
+    bus0 = buses_ac.iloc[pos_bus0]
+    bus1 = buses_ac.iloc[pos_bus0 + 1]
+
+    id = bus0.groupby("station_id").cumcount()
+
+    df_transformers = gpd.GeoDataFrame(
+        {
+            "line_id": (
+                "transf_" + bus0["station_id"].astype(str) + "_" + id.astype(str)
+            ).values,
+            "bus0": bus0["bus_id"].values,
+            "bus1": bus1["bus_id"].values,
+            "voltage_bus0": bus0["voltage"].values,
+            "voltage_bus1": bus1["voltage"].values,
+            "country": bus0["country"].values,
+        },
+        geometry=_connect_points(bus0.geometry.values, bus1.geometry.values),
+    )
     df_transformers.set_index(lines.index[-1] + df_transformers.index + 1, inplace=True)
     # update line endings
     df_transformers = line_endings_to_bus_conversion(df_transformers)
@@ -407,57 +455,58 @@ def get_converters(buses, lines):
     Function to create fake converter lines that connect buses of the same station_id of different polarities
     """
 
-    df_converters = []
-
-    for g_name, g_value in buses.sort_values("voltage", ascending=True).groupby(
-        by=["station_id"]
-    ):
-
-        # note: by construction there cannot be more that two buses with the same station_id and same voltage
-        n_voltages = len(g_value)
-
-        # A converter stations should have both AC and DC parts
-        if g_value["dc"].any() & ~g_value["dc"].all():
-
-            dc_voltage = g_value[g_value.dc]["voltage"].values
-
-            for u in dc_voltage:
-                id_0 = g_value[g_value["dc"] & g_value["voltage"].isin([u])].index[0]
-
-                ac_voltages = g_value[~g_value.dc]["voltage"]
-                # A converter is added between a DC nodes and AC one with the closest voltage
-                id_1 = ac_voltages.sub(u).abs().idxmin()
-
-                geom_conv = LineString(
-                    [g_value.geometry.loc[id_0], g_value.geometry.loc[id_1]]
-                )
-
-                df_converters.append(
-                    [
-                        f"convert_{g_name}_{id_0}",  # "line_id"
-                        g_value["bus_id"].loc[id_0],  # "bus0"
-                        g_value["bus_id"].loc[id_1],  # "bus1"
-                        False,  # "underground"
-                        False,  # "under_construction"
-                        g_value.country.loc[id_0],  # "country"
-                        geom_conv,  # "geometry"
-                    ]
-                )
-
-    # name of the columns
-    conv_columns = [
-        "converter_id",
-        "bus0",
-        "bus1",
-        "underground",
-        "under_construction",
-        "country",
-        "geometry",
-    ]
-
-    df_converters = gpd.GeoDataFrame(df_converters, columns=conv_columns).reset_index()
+    buses_sorted = buses.dropna(subset=["station_id"]).sort_values(
+        ["station_id", "voltage"], kind="stable"
+    )
+    buses_dc = buses_sorted[buses_sorted["dc"]]
+    buses_ac = buses_sorted[~buses_sorted["dc"]]
+
+    # A converter is added between a DC nodes and AC one with the closest voltage
+    # A converter stations should have both AC and DC parts, otherwise pos_bus1 is missing
+    pairs = (
+        pd.merge_asof(
+            pd.DataFrame(
+                {
+                    "station_id": buses_dc["station_id"].values,
+                    "voltage": buses_dc["voltage"].values,
+                    "pos_bus0": np.arange(len(buses_dc)),
+                }
+            ).sort_values("voltage", kind="stable"),
+            pd.DataFrame(
+                {
+                    "station_id": buses_ac["station_id"].values,
+                    "voltage": buses_ac["voltage"].values,
+                    "pos_bus1": np.arange(len(buses_ac)),
+                }
+            ).sort_values("voltage", kind="stable"),
+            on="voltage",
+            by="station_id",
+            direction="nearest",
+        )
+        .dropna(subset=["pos_bus1"])
+        .sort_values("pos_bus0")
+    )
+    bus0 = buses_dc.iloc[pairs["pos_bus0"].values]
+    bus1 = buses_ac.iloc[pairs["pos_bus1"].values.astype(int)]
+
+    df_converters = gpd.GeoDataFrame(
+        {
+            "converter_id": (
+                "convert_"
+                + bus0["station_id"].astype(str)
+                + "_"
+                + bus0.index.astype(str)
+            ).values,
+            "bus0": bus0["bus_id"].values,
+            "bus1": bus1["bus_id"].values,
+            "underground": False,
+            "under_construction": False,
+            "country": bus0["country"].values,
+        },
+        geometry=_connect_points(bus0.geometry.values, bus1.geometry.values),
+    )
 
-    return df_converters
+    return df_converters.reset_index()
 
 
 def connect_stations_same_station_id(lines, buses):
@@ -465,74 +514,41 @@ def connect_stations_same_station_id(lines, buses):
     Function to create fake links between substations with the same substation_id
     """
     ac_freq = get_ac_frequency(lines)
-    station_id_list = buses.station_id.unique()
-
-    add_lines = []
-    from shapely.geometry import LineString
-
-    for s_id in station_id_list:
-        buses_station_id = buses[buses.station_id == s_id]
-
-        if len(buses_station_id) > 1:
-            for b_it in range(1, len(buses_station_id)):
-                add_lines.append(
-                    [
-                        f"link{buses_station_id}_{b_it}",  # "line_id"
-                        buses_station_id.index[0],  # "bus0"
-                        buses_station_id.index[b_it],  # "bus1"
-                        400000,  # "voltage"
-                        1,  # "circuits"
-                        0.0,  # "length"
-                        False,  # "underground"
-                        False,  # "under_construction"
-                        "transmission",  # "tag_type"
-                        ac_freq,  # "tag_frequency"
-                        buses_station_id.country.iloc[0],  # "country"
-                        LineString(
-                            [
-                                buses_station_id.geometry.iloc[0],
-                                buses_station_id.geometry.iloc[b_it],
-                            ]
-                        ),  # "geometry"
-                        LineString(
-                            [
-                                buses_station_id.geometry.iloc[0],
-                                buses_station_id.geometry.iloc[b_it],
-                            ]
-                        ).bounds,  # "bounds"
-                        buses_station_id.geometry.iloc[0],  # "bus_0_coors"
-                        buses_station_id.geometry.iloc[b_it],  # "bus_1_coors"
-                        buses_station_id.lon.iloc[0],  # "bus0_lon"
-                        buses_station_id.lat.iloc[0],  # "bus0_lat"
-                        buses_station_id.lon.iloc[b_it],  # "bus1_lon"
-                        buses_station_id.lat.iloc[b_it],  # "bus1_lat"
-                    ]
-                )
-
-    # name of the columns
-    add_lines_columns = [
-        "line_id",
-        "bus0",
-        "bus1",
-        "voltage",
-        "circuits",
-        "length",
-        "underground",
-        "under_construction",
-        "tag_type",
-        "tag_frequency",
-        "country",
-        "geometry",
-        "bounds",
-        "bus_0_coors",
-        "bus_1_coors",
-        "bus0_lon",
-        "bus0_lat",
-        "bus1_lon",
-        "bus1_lat",
-    ]
-
-    df_add_lines = gpd.GeoDataFrame(pd.concat(add_lines), columns=add_lines_columns)
+
+    # every bus is linked to the first bus of its station_id
+    is_first = ~buses["station_id"].duplicated()
+    first_buses = buses[is_first.values]
+    bus1 = buses[(~is_first & buses["station_id"].notna()).values]
+    pos_bus0 = pd.Series(np.arange(len(first_buses)), index=first_buses["station_id"])
+    bus0 = first_buses.iloc[pos_bus0.loc[bus1["station_id"]].values]
+    b_it = bus1.groupby("station_id").cumcount() + 1
+
+    geometry = _connect_points(bus0.geometry.values, bus1.geometry.values)
+
+    df_add_lines = gpd.GeoDataFrame(
+        {
+            "line_id": (
+                "link" + bus1["station_id"].astype(str) + "_" + b_it.astype(str)
+            ).values,
+            "bus0": bus0.index.values,
+            "bus1": bus1.index.values,
+            "voltage": 400000,
+            "circuits": 1,
+            "length": 0.0,
+            "underground": False,
+            "under_construction": False,
+            "tag_type": "transmission",
+            "tag_frequency": ac_freq,
+            "country": bus0["country"].values,
+            "geometry": geometry,
+            "bus_0_coors": bus0.geometry.values,
+            "bus_1_coors": bus1.geometry.values,
+            "bus0_lon": bus0["lon"].values,
+            "bus0_lat": bus0["lat"].values,
+            "bus1_lon": bus1["lon"].values,
+            "bus1_lat": bus1["lat"].values,
+        }
+    )
     lines = pd.concat([lines, df_add_lines], ignore_index=True)
 
     return lines
@@ -573,11 +589,12 @@ def set_lv_substations(buses):
 
 
 def merge_stations_lines_by_station_id_and_voltage(
-    lines, buses, geo_crs, distance_crs, tol=2000
+    lines, buses, geo_crs, distance_crs, tol=2000, station_ids_method="cluster"
 ):
     """
     Function to merge close stations and adapt the line datasets to adhere to the merged dataset
 
+    station_ids_method is the method of set_substations_ids: "cluster" or "first_come"
     """
 
     logger.info(
@@ -585,7 +602,7 @@ def merge_stations_lines_by_station_id_and_voltage(
     )
 
     # set substation ids
-    set_substations_ids(buses, distance_crs, tol=tol)
+    set_substations_ids(buses, distance_crs, tol=tol, method=station_ids_method)
 
     logger.info("Stage 3b/4: Merge substations with the same id")
 
@@ -619,8 +636,11 @@ def merge_stations_lines_by_station_id_and_voltage(
 
 
 def create_station_at_equal_bus_locations(
-    lines, buses, geo_crs, distance_crs, tol=2000
+    lines, buses, geo_crs, distance_crs, tol=2000, station_ids_method="cluster"
 ):
+    """
+    station_ids_method is the method of set_substations_ids: "cluster" or "first_come"
+    """
     # V1. Create station_id at same bus location
     # - We saw that buses are not connected exactly at one point, they are
     #   usually connected to a substation "area" (analysed on maps)
@@ -639,7 +659,7 @@ def create_station_at_equal_bus_locations(
     bus_all = buses
 
     # set substation ids
-    set_substations_ids(buses, distance_crs, tol=tol)
+    set_substations_ids(buses, distance_crs, tol=tol, method=station_ids_method)
 
     # set the bus ids to the line dataset
     lines, buses = set_lines_ids(lines, buses, distance_crs)
@@ -659,32 +679,27 @@ def create_station_at_equal_bus_locations(
     return lines, buses
 
 
-def _split_linestring_by_point(linestring, points):
+def _split_linestring_by_offsets(linestring, offsets):
     """
-    Function to split a linestring geometry by multiple inner points
+    Function to split a linestring geometry at multiple inner points,
+    given by their linear referencing offsets along the line
 
     Parameters
     ----------
-    lstring : LineString
+    linestring : LineString
         Linestring of the line to be splitted
-    points : list
-        List of points to split the linestring
+    offsets : array
+        Offsets of the points to split the linestring, in the units of
+        the coordinates of the linestring
 
     Return
     ------
     list_lines : list
         List of linestring to split the line
     """
+    bounds = np.unique(np.concatenate([[0.0], offsets, [linestring.length]]))
 
-    list_linestrings = [linestring]
-
-    for p in points:
-        # execute split to all lines and store results
-        temp_list = [split(l, p) for l in list_linestrings]
-        # nest all geometries
-        list_linestrings = [lstring for tval in temp_list for lstring in tval.geoms]
-
-    return list_linestrings
+    return [substring(linestring, a, b) for a, b in zip(bounds[:-1], bounds[1:])]
 
 
 def fix_overpassing_lines(lines, buses, distance_crs, tol=1):
@@ -692,6 +707,10 @@ def fix_overpassing_lines(lines, buses, distance_crs, tol=1):
     Function to avoid buses overpassing lines with no connection
     when the bus is within a given tolerance from the line
 
+    The candidate buses of all the lines are found at once with an STRtree
+    of the lines, then each line is cut at the projections of its buses
+    along the line, skipping those within tolerance from the line endings.
+
     Parameters
     ----------
     lines : GeoDataFrame
@@ -703,65 +722,51 @@ def fix_overpassing_lines(lines, buses, distance_crs, tol=1):
         below which the line will be splitted
     """
 
-    lines_to_add = []  # list of lines to be added
-    lines_to_split = []  # list of lines that have been splitted
-
-    lines_epsgmod = lines.to_crs(distance_crs)
-    buses_epsgmod = buses.to_crs(distance_crs)
+    lines_epsgmod = lines.geometry.to_crs(distance_crs).values
+    buses_epsgmod = buses.geometry.to_crs(distance_crs).values
 
-    # set tqdm options for substation ids
-    tqdm_kwargs_substation_ids = dict(
-        ascii=False,
-        unit=" lines",
-        total=lines.shape[0],
-        desc="Verify lines overpassing nodes ",
+    # pairs of buses and lines within tolerance
+    bus_idx, line_idx = shapely.STRtree(lines_epsgmod).query(
+        buses_epsgmod, predicate="dwithin", distance=tol
     )
 
-    for l in tqdm(lines.index, **tqdm_kwargs_substation_ids):
+    # exclude the buses close to the endings of the lines
+    offsets_epsgmod = shapely.line_locate_point(
+        lines_epsgmod[line_idx], buses_epsgmod[bus_idx]
+    )
+    inner = (offsets_epsgmod > tol) & (
+        offsets_epsgmod < shapely.length(lines_epsgmod[line_idx]) - tol
+    )
+    bus_idx, line_idx = bus_idx[inner], line_idx[inner]
 
-        # bus indices being within tolerance from the line
-        bus_in_tol_epsg = buses_epsgmod[
-            buses_epsgmod.geometry.distance(lines_epsgmod.geometry.loc[l]) <= tol
-        ]
+    if len(line_idx) == 0:
+        return lines, buses
 
-        # exclude endings of the lines
-        bus_in_tol_epsg = bus_in_tol_epsg[
-            (
-                (
-                    bus_in_tol_epsg.geometry.distance(
-                        lines_epsgmod.geometry.loc[l].boundary.geoms[0]
-                    )
-                    > tol
-                )
-                | (
-                    bus_in_tol_epsg.geometry.distance(
-                        lines_epsgmod.geometry.loc[l].boundary.geoms[1]
-                    )
-                    > tol
-                )
-            )
-        ]
+    # offsets of the split points in the crs of the lines
+    offsets = shapely.line_locate_point(
+        lines.geometry.values[line_idx], buses.geometry.values[bus_idx]
+    )
+    split_offsets = pd.Series(offsets).groupby(line_idx).apply(np.sort)
 
-        if not bus_in_tol_epsg.empty:
-            # add index of line to split
-            lines_to_split.append(l)
+    lines_to_add = []  # list of lines to be added
+    lines_to_split = lines.index[split_offsets.index]  # lines to be splitted
 
-            buses_locs = buses.geometry.loc[bus_in_tol_epsg.index]
+    for l, l_offsets in zip(lines_to_split, split_offsets):
 
-            # get new line geometries
-            new_geometries = _split_linestring_by_point(lines.geometry[l], buses_locs)
-            n_geoms = len(new_geometries)
+        # get new line geometries
+        new_geometries = _split_linestring_by_offsets(lines.geometry[l], l_offsets)
+        n_geoms = len(new_geometries)
 
-            # create temporary copies of the line
-            df_append = gpd.GeoDataFrame([lines.loc[l]] * n_geoms)
-            # update geometries
-            df_append["geometry"] = new_geometries
-            # update name of the line
-            df_append["line_id"] = [
-                str(df_append["line_id"].iloc[0]) + f"_{id}" for id in range(n_geoms)
-            ]
+        # create temporary copies of the line
+        df_append = gpd.GeoDataFrame([lines.loc[l]] * n_geoms)
+        # update geometries
+        df_append["geometry"] = new_geometries
+        # update name of the line
+        df_append["line_id"] = [
+            str(df_append["line_id"].iloc[0]) + f"_{id}" for id in range(n_geoms)
+        ]
 
-            lines_to_add.append(df_append)
+        lines_to_add.append(df_append)
 
     df_to_add = gpd.GeoDataFrame(pd.concat(lines_to_add, ignore_index=True))
     df_to_add.set_crs(lines.crs, inplace=True)
@@ -788,8 +793,10 @@ def built_network(inputs, outputs, geo_crs, distance_crs):
 
     logger.info("Stage 1/5: Read input data")
 
-    substations = gpd.read_file(inputs["substations"])
-    lines = gpd.read_file(inputs["lines"])
+    substations = set_osm_dtypes(
+        gpd.read_file(inputs["substations"]), substations_dtypes
+    )
+    lines = set_osm_dtypes(gpd.read_file(inputs["lines"]), lines_dtypes)
     generators = read_geojson(inputs["generators"])
 
     logger.info("Stage 2/5: Add line endings to the substation datasets")
@@ -814,11 +821,19 @@ def built_network(inputs, outputs, geo_crs, distance_crs):
     # METHOD to merge buses with same voltage and within tolerance Step 4/5
     if snakemake.config.get("build_osm_network", {}).get("group_close_buses", False):
         tol = snakemake.config["build_osm_network"].get("group_tolerance_buses", 500)
+        station_ids_method = snakemake.config["build_osm_network"].get(
+            "station_ids_method", "cluster"
+        )
         logger.info(
             f"Stage 4/5: Aggregate close substations: enabled with tolerance {tol} m"
         )
         lines, buses = merge_stations_lines_by_station_id_and_voltage(
-            lines, buses, geo_crs, distance_crs, tol=tol
+            lines,
+            buses,
+            geo_crs,
+            distance_crs,
+            tol=tol,
+            station_ids_method=station_ids_method,
         )
     else:
         logger.info("Stage 4/5: Aggregate close substations: disabled")
@@ -20,8 +20,9 @@ import rioxarray as rx
 import xarray as xr
 from _helpers import (
     configure_logging,
+    download_files,
     sets_path_to_root,
-    three_2_two_digits_country,
+    three_2_two_digits_country_series,
     two_2_three_digits_country,
     two_digits_2_name_country,
 )
@@ -35,26 +36,16 @@ from tqdm import tqdm
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.INFO)
 
+# minimum size in bytes of the WorldPop files; smaller files are error pages
+WORLDPOP_SIZE_MIN = 300
+
 sets_path_to_root("pypsa-africa")
 
 
-def download_GADM(country_code, update=False, out_logging=False):
+def get_GADM_paths(country_code):
     """
-    Download gpkg file from GADM for a given country code
-
-    Parameters
-    ----------
-    country_code : str
-        Two letter country codes of the downloaded files
-    update : bool
-        Update = true, forces re-download of files
-
-    Returns
-    -------
-    gpkg file per country
-
+    Get the name, the url and the zip and gpkg paths of the GADM file of a country
     """
-
     GADM_filename = f"gadm36_{two_2_three_digits_country(country_code)}"
     GADM_url = f"https://biogeo.ucdavis.edu/data/gadm3.6/gpkg/{GADM_filename}_gpkg.zip"
 
@@ -74,17 +65,36 @@ def download_GADM(country_code, update=False, out_logging=False):
         GADM_filename + ".gpkg",
     )  # Input filepath gpkg
 
+    return GADM_filename, GADM_url, GADM_inputfile_zip, GADM_inputfile_gpkg
+
+
+def download_GADM(country_code, update=False, out_logging=False):
+    """
+    Download gpkg file from GADM for a given country code
+
+    Parameters
+    ----------
+    country_code : str
+        Two letter country codes of the downloaded files
+    update : bool
+        Update = true, forces re-download of files
+
+    Returns
+    -------
+    gpkg file per country
+
+    """
+
+    GADM_filename, GADM_url, GADM_inputfile_zip, GADM_inputfile_gpkg = get_GADM_paths(
+        country_code
+    )
+
     if not os.path.exists(GADM_inputfile_gpkg) or update is True:
         if out_logging:
             _logger.warning(
                 f"Stage 4/4: {GADM_filename} of country {two_digits_2_name_country(country_code)} does not exist, downloading to {GADM_inputfile_zip}"
             )
-        #  create data/osm directory
-        os.makedirs(os.path.dirname(GADM_inputfile_zip), exist_ok=True)
-
-        with requests.get(GADM_url, stream=True) as r:
-            with open(GADM_inputfile_zip, "wb") as f:
-                shutil.copyfileobj(r.raw, f)
+        download_files([(GADM_url, GADM_inputfile_zip)], update=update)
 
         with zipfile.ZipFile(GADM_inputfile_zip, "r") as zip_ref:
             zip_ref.extractall(os.path.dirname(GADM_inputfile_zip))
@@ -109,6 +119,17 @@ def get_GADM_layer(country_list, layer_id, geo_crs, update=False, outlogging=Fal
     # initialization of the geoDataFrame
     geodf_list = []
 
+    # download the missing files of all the countries concurrently;
+    # updates are performed by download_GADM
+    GADM_paths = [get_GADM_paths(country_code) for country_code in country_list]
+    download_files(
+        [
+            (GADM_url, GADM_inputfile_zip)
+            for _, GADM_url, GADM_inputfile_zip, GADM_inputfile_gpkg in GADM_paths
+            if not os.path.exists(GADM_inputfile_gpkg)
+        ]
+    )
+
     for country_code in country_list:
         # download file gpkg
         file_gpkg, name_file = download_GADM(country_code, update, outlogging)
@@ -129,9 +150,7 @@ def get_GADM_layer(country_list, layer_id, geo_crs, update=False, outlogging=Fal
         geodf_temp = gpd.read_file(file_gpkg, layer=layer_name).to_crs(geo_crs)
 
         # convert country name representation of the main country (GID_0 column)
-        geodf_temp["GID_0"] = [
-            three_2_two_digits_country(twoD_c) for twoD_c in geodf_temp["GID_0"]
-        ]
+        geodf_temp["GID_0"] = three_2_two_digits_country_series(geodf_temp["GID_0"])
 
         # create a subindex column that is useful
         # in the GADM processing of sub-national zones
@@ -237,9 +256,7 @@ def load_EEZ(countries_codes, geo_crs, EEZ_gpkg="./data/eez/eez_v11.gpkg"):
     geodf_EEZ = geodf_EEZ[
         [any([x in selected_countries_codes_3D]) for x in geodf_EEZ["ISO_TER1"]]
     ]
-    geodf_EEZ["ISO_TER1"] = geodf_EEZ["ISO_TER1"].map(
-        lambda x: three_2_two_digits_country(x)
-    )
+    geodf_EEZ["ISO_TER1"] = three_2_two_digits_country_series(geodf_EEZ["ISO_TER1"])
     geodf_EEZ.reset_index(drop=True, inplace=True)
 
     geodf_EEZ.rename(columns={"ISO_TER1": "name"}, inplace=True)
@@ -306,7 +323,7 @@ def download_WorldPop(
     year=2020,
     update=False,
     out_logging=False,
-    size_min=300,
+    size_min=WORLDPOP_SIZE_MIN,
 ):
     """
     Download Worldpop using either the standard method or the API method.
@@ -333,12 +350,29 @@ def download_WorldPop(
         )
 
 
+def get_WorldPop_standard_paths(country_code, year=2020):
+    """
+    Get the name, the alternative urls and the path of the WorldPop file of a country
+    """
+    WorldPop_filename = f"{two_2_three_digits_country(country_code).lower()}_ppp_{year}_UNadj_constrained.tif"
+    # Urls used to possibly download the file
+    WorldPop_urls = [
+        f"https://data.worldpop.org/GIS/Population/Global_2000_2020_Constrained/2020/BSGM/{two_2_three_digits_country(country_code).upper()}/{WorldPop_filename}",
+        f"https://data.worldpop.org/GIS/Population/Global_2000_2020_Constrained/2020/maxar_v1/{two_2_three_digits_country(country_code).upper()}/{WorldPop_filename}",
+    ]
+    WorldPop_inputfile = os.path.join(
+        os.getcwd(), "data", "WorldPop", WorldPop_filename
+    )  # Input filepath tif
+
+    return WorldPop_filename, WorldPop_urls, WorldPop_inputfile
+
+
 def download_WorldPop_standard(
     country_code,
     year=2020,
     update=False,
     out_logging=False,
-    size_min=300,
+    size_min=WORLDPOP_SIZE_MIN,
 ):
     """
     Download tiff file for each country code using the standard method from worldpop datastore with 1kmx1km resolution.
@@ -364,32 +398,19 @@ def download_WorldPop_standard(
     if out_logging:
         _logger.info("Stage 3/4: Download WorldPop datasets")
 
-    WorldPop_filename = f"{two_2_three_digits_country(country_code).lower()}_ppp_{year}_UNadj_constrained.tif"
-    # Urls used to possibly download the file
-    WorldPop_urls = [
-        f"https://data.worldpop.org/GIS/Population/Global_2000_2020_Constrained/2020/BSGM/{two_2_three_digits_country(country_code).upper()}/{WorldPop_filename}",
-        f"https://data.worldpop.org/GIS/Population/Global_2000_2020_Constrained/2020/maxar_v1/{two_2_three_digits_country(country_code).upper()}/{WorldPop_filename}",
-    ]
-    WorldPop_inputfile = os.path.join(
-        os.getcwd(), "data", "WorldPop", WorldPop_filename
-    )  # Input filepath tif
+    WorldPop_filename, WorldPop_urls, WorldPop_inputfile = get_WorldPop_standard_paths(
+        country_code, year
+    )
 
     if not os.path.exists(WorldPop_inputfile) or update is True:
         if out_logging:
             _logger.warning(
                 f"Stage 4/4: {WorldPop_filename} does not exist, downloading to {WorldPop_inputfile}"
             )
-        #  create data/osm directory
-        os.makedirs(os.path.dirname(WorldPop_inputfile), exist_ok=True)
-
-        loaded = False
-        for WorldPop_url in WorldPop_urls:
-            with requests.get(WorldPop_url, stream=True) as r:
-                with open(WorldPop_inputfile, "wb") as f:
-                    if float(r.headers["Content-length"]) > size_min:
-                        shutil.copyfileobj(r.raw, f)
-                        loaded = True
-                        break
+        # the first url providing a file larger than size_min is used
+        [loaded] = download_files(
+            [(WorldPop_urls, WorldPop_inputfile)], size_min=size_min, update=update
+        )
         if not loaded:
             _logger.error(f"Stage 4/4: Impossible to download {WorldPop_filename}")
 
@@ -397,7 +418,7 @@ def download_WorldPop_standard(
 
 
 def download_WorldPop_API(
-    country_code, year=2020, update=False, out_logging=False, size_min=300
+    country_code, year=2020, update=False, out_logging=False, size_min=WORLDPOP_SIZE_MIN
 ):
     """
     Download tiff file for each country code using the api method from worldpop API with 100mx100m resolution.
@@ -686,6 +707,21 @@ def add_population_data(
     # initialize new population column
     df_gadm["pop"] = 0.0
 
+    # download the missing WorldPop files of all the countries concurrently;
+    # updates are performed by download_WorldPop
+    if worldpop_method == "standard":
+        WorldPop_paths = [
+            get_WorldPop_standard_paths(c_code, year) for c_code in country_codes
+        ]
+        download_files(
+            [
+                (WorldPop_urls, WorldPop_inputfile)
+                for _, WorldPop_urls, WorldPop_inputfile in WorldPop_paths
+                if not os.path.exists(WorldPop_inputfile)
+            ],
+            size_min=WORLDPOP_SIZE_MIN,
+        )
+
     tqdm_kwargs = dict(
         ascii=False,
         unit=" countries",
@@ -2,17 +2,39 @@
 # SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
+import importlib.metadata
 import logging
 import os
+from functools import lru_cache
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import reverse_geocode as rg
-from _helpers import configure_logging, save_to_geojson, to_csv_nafix
+import shapely
+from _helpers import (
+    CountryShapes,
+    cached_geodata_chunks,
+    configure_logging,
+    get_cache_key,
+    get_line_endings,
+    get_raw_files,
+    iter_raw_geodata,
+    load_extended_country_shapes,
+    read_raw_geodata,
+    save_to_geojson,
+    set_osm_dtypes,
+    to_csv_nafix,
+)
+from config_osm_data import lines_dtypes, substations_dtypes
+from scipy.spatial import cKDTree
 
 logger = logging.getLogger(__name__)
 
+# version of the intermediate results cached by clean_data;
+# increase it when the cleaning of the cached results changes
+CLEAN_CACHE_VERSION = 1
+
 
 def prepare_substation_df(df_all_substations):
     """
@@ -73,46 +95,36 @@ def prepare_substation_df(df_all_substations):
 
 
 def add_line_endings_tosubstations(substations, lines):
-    # extract columns from substation df
-    bus_s = gpd.GeoDataFrame(columns=substations.columns)
-    bus_e = gpd.GeoDataFrame(columns=substations.columns)
+    """
+    Add the endings of the lines to the substations
 
-    is_ac = lines["tag_frequency"].astype(float) != 0
+    The endings are extracted in a single vectorized pass and the buses
+    of the start and end points are built in a single dataframe
+    """
+    start_points, end_points, start_xy, end_xy = get_line_endings(lines.geometry.values)
+    bus_xy = np.concatenate([start_xy, end_xy])
 
     # Read information from line.csv
-    bus_s[["voltage", "country"]] = lines[["voltage", "country"]].astype(str)
-    bus_s["geometry"] = lines.geometry.boundary.map(
-        lambda p: p.geoms[0] if len(p.geoms) >= 2 else None
-    )
-    bus_s["lon"] = bus_s["geometry"].map(lambda p: p.x if p != None else None)
-    bus_s["lat"] = bus_s["geometry"].map(lambda p: p.y if p != None else None)
-    bus_s["bus_id"] = (
-        (substations["bus_id"].max() if "bus_id" in substations else 0)
-        + 1
-        + bus_s.index
-    )
-    bus_s["dc"] = ~is_ac
-
-    bus_e[["voltage", "country"]] = lines[["voltage", "country"]].astype(str)
-    bus_e["geometry"] = lines.geometry.boundary.map(
-        lambda p: p.geoms[1] if len(p.geoms) >= 2 else None
+    bus_all = gpd.GeoDataFrame(
+        {
+            "voltage": np.tile(lines["voltage"].astype(str).values, 2),
+            "country": np.tile(lines["country"].astype(str).values, 2),
+            "geometry": np.concatenate([start_points, end_points]),
+            "lon": bus_xy[:, 0],
+            "lat": bus_xy[:, 1],
+            "bus_id": np.arange(2 * len(lines)),
+            "dc": False,  # np.nan
+            # Add NaN as default
+            "station_id": np.nan,
+            # Assuming substations completed for installed lines
+            "under_construction": False,
+            "tag_area": 0.0,  # np.nan
+            "symbol": "substation",
+            # TODO: this tag may be improved, maybe depending on voltage levels
+            "tag_substation": "transmission",
+        },
+        crs=lines.crs,
     )
-    bus_e["lon"] = bus_e["geometry"].map(lambda p: p.x if p != None else None)
-    bus_e["lat"] = bus_e["geometry"].map(lambda p: p.y if p != None else None)
-    bus_e["bus_id"] = bus_s["bus_id"].max() + 1 + bus_e.index
-    bus_s["dc"] = ~is_ac
-
-    bus_all = pd.concat([bus_s, bus_e], ignore_index=True)
-
-    # Add NaN as default
-    bus_all["station_id"] = np.nan
-    bus_all["dc"] = False  # np.nan
-    # Assuming substations completed for installed lines
-    bus_all["under_construction"] = False
-    bus_all["tag_area"] = 0.0  # np.nan
-    bus_all["symbol"] = "substation"
-    # TODO: this tag may be improved, maybe depending on voltage levels
-    bus_all["tag_substation"] = "transmission"
 
     buses = pd.concat([substations, bus_all], ignore_index=True)
 
@@ -174,24 +186,28 @@ def split_cells(df, lst_col="voltage"):
 
 
 def filter_voltage(df, threshold_voltage=35000):
+    """
+    Parse the voltage column and keep the rows with a voltage no lower than
+    threshold_voltage; when threshold_voltage is None, the voltage is only parsed.
+    An already numeric voltage column is not parsed again.
+    """
+    if not pd.api.types.is_numeric_dtype(df["voltage"]):
+        # Drop any row with N/A voltage
+        df = df.dropna(subset=["voltage"])
 
-    # Drop any row with N/A voltage
-    df = df.dropna(subset=["voltage"])
-
-    # Split semicolon separated cells i.e. [66000;220000] and create new identical rows
-    df = split_cells(df)
+        # Split semicolon separated cells i.e. [66000;220000] and create new identical rows
+        df = split_cells(df)
 
-    # Convert voltage to float, if impossible, discard row
-    df["voltage"] = (
-        df["voltage"].apply(lambda x: pd.to_numeric(x, errors="coerce")).astype(float)
-    )
-    df = df.dropna(subset=["voltage"])  # Drop any row with Voltage = N/A
+        # Convert voltage to float, if impossible, discard row
+        df["voltage"] = pd.to_numeric(df["voltage"], errors="coerce").astype(float)
+        df = df.dropna(subset=["voltage"])  # Drop any row with Voltage = N/A
 
-    # convert voltage to int
-    df.loc[:, "voltage"] = df["voltage"].astype(int)
+        # convert voltage to int
+        df.loc[:, "voltage"] = df["voltage"].astype(int)
 
     # keep only lines with a voltage no lower than than threshold_voltage
-    df = df[df.voltage >= threshold_voltage]
+    if threshold_voltage is not None:
+        df = df[df.voltage >= threshold_voltage]
 
     return df
 
@@ -230,6 +246,15 @@ def prepare_lines_df(df_lines):
         }
     )
 
+    # The cleaning sets numbers in the string tag columns: store them as
+    # object columns, as the string dtype of pandas>=3 rejects numbers
+    str_cols = [
+        col
+        for col, dtype in df_lines.dtypes.items()
+        if isinstance(dtype, pd.StringDtype)
+    ]
+    df_lines[str_cols] = df_lines[str_cols].astype(object)
+
     # Add NaN as default
     df_lines["bus0"] = np.nan
     df_lines["bus1"] = np.nan
@@ -279,34 +304,44 @@ def split_cells_multiple(df, list_col=["cables", "circuits", "voltage"]):
     One line with 'cable':{3,6} and 'voltage':{220000,110000} or
     only 'voltage':{110000, 220000, 3330000} needs to split in several lines
     with new line_ID
+
+    The semicolon separated values of the columns in list_col are aligned
+    by position and single values are repeated for every split line.
+    Rows whose columns have different numbers of values (other than one)
+    cannot be aligned and are left unchanged.
     """
-    # TODO: split multiple cell probably needs fix
-    n_rows = df.shape[0]
-    df_list = [df]
-    for i in range(n_rows):
-        sub = df[list_col].iloc[i]  # for each cables and voltage
-        if sub.notnull().all() == True:  # check not both empty
-            # check both contain ";"
-            if [";" in s for s in sub].count(True) == len(list_col):
-                d = [s.split(";") for s in sub]  # split them
-                r = df.loc[i, :].copy()
-                df.loc[i, list_col[0]] = d[0][0]  # first split  [0]
-                df.loc[i, list_col[1]] = d[1][0]
-                r[list_col[0]] = d[0][1]  # second split [1]
-                r[list_col[1]] = d[1][1]
-                df_list.append(r)
-
-    df = pd.concat(df_list, ignore_index=True)
-
-    # if some columns still contain ";" then sum the values
-    for cl_name in list_col:
-        if df[cl_name].dtype == "string":
-            sel_ids = df[cl_name].str.contains(";") == True
-            # TODO: split multiple cell need fix
-            df = df.drop(
-                df.loc[sel_ids, cl_name].index,
+    df = df.reset_index(drop=True)
+
+    # semicolon separated values of the string columns
+    split_values = {
+        col: df[col].str.split(";")
+        for col in list_col
+        if pd.api.types.is_string_dtype(df[col].dtype)
+    }
+    if not split_values:
+        return df
+
+    n_values = pd.DataFrame(
+        {col: values.str.len().fillna(1) for col, values in split_values.items()}
+    ).astype(int)
+    n_split = n_values.max(axis=1)
+
+    # the columns shall have either a single value or n_split values
+    is_aligned = (n_values.eq(1) | n_values.eq(n_split, axis=0)).all(axis=1)
+    n_split = n_split.where(is_aligned, 1).to_numpy(dtype=int)
+
+    # repeat each row once per split value
+    split_ids = np.repeat(np.arange(len(df)), n_split)
+    df_split = df.iloc[split_ids].reset_index(drop=True)
+
+    for col, values in split_values.items():
+        is_split = (n_values[col].to_numpy() > 1) & (n_split > 1)
+        if is_split.any():
+            df_split.loc[is_split[split_ids], col] = (
+                values[is_split].explode().str.strip().to_numpy()
             )
-    return df  # return new frame
+
+    return df_split
 
 
 # cable and circuit tags may be in a non-numeric format
@@ -356,9 +391,33 @@ dropped_circuits_tags = [
 ]
 
 
-def integrate_lines_df(df_all_lines, distance_crs):
+def get_ac_freq_default(grid_freq_levels, ac_freq_default=50):
+    """
+    Function to get the most common AC frequency from the counts of the frequency tags
+
+    Parameters
+    ----------
+    grid_freq_levels : Series
+        Number of lines per frequency tag, sorted in descending order
+    ac_freq_default : float
+        Frequency used when no frequency tag is available
+    """
+    if not grid_freq_levels.empty:
+        # AC lines frequency shouldn't be 0Hz
+        ac_freq_levels = grid_freq_levels.loc[
+            grid_freq_levels.index.get_level_values(0) != "0"
+        ]
+        ac_freq_default = float(ac_freq_levels.index.get_level_values(0)[0])
+
+    return ac_freq_default
+
+
+def integrate_lines_df(df_all_lines, distance_crs, ac_freq_default=None):
     """
     Function to add underground, under_construction, frequency and circuits
+
+    The missing frequencies are set to ac_freq_default; when None,
+    the most common frequency of df_all_lines is used
     """
     # Add under construction info
     # Default = False. No more information available atm
@@ -376,20 +435,13 @@ def integrate_lines_df(df_all_lines, distance_crs):
     # NB The standard frequency value may be regional-dependent
     # TODO Fill by adjancent value
 
-    # Initialize a default frequency value
-    ac_freq_default = 50
-
     if "tag_frequency" in df_all_lines.columns:
 
-        grid_freq_levels = df_all_lines["tag_frequency"].value_counts(
-            sort=True, dropna=True
-        )
-        if not grid_freq_levels.empty:
-            # AC lines frequency shouldn't be 0Hz
-            ac_freq_levels = grid_freq_levels.loc[
-                grid_freq_levels.index.get_level_values(0) != "0"
-            ]
-            ac_freq_default = float(ac_freq_levels.index.get_level_values(0)[0])
+        if ac_freq_default is None:
+            grid_freq_levels = df_all_lines["tag_frequency"].value_counts(
+                sort=True, dropna=True
+            )
+            ac_freq_default = get_ac_freq_default(grid_freq_levels)
 
         df_all_lines.loc[
             df_all_lines["tag_frequency"].isna(), "tag_frequency"
@@ -397,7 +449,9 @@ def integrate_lines_df(df_all_lines, distance_crs):
 
     # Add frequency column if not present in data
     else:
-        df_all_lines["tag_frequency"] = ac_freq_default
+        df_all_lines["tag_frequency"] = (
+            50 if ac_freq_default is None else ac_freq_default
+        )
 
     df_all_lines = split_cells_multiple(df_all_lines)
     # Add circuits information
@@ -549,12 +603,77 @@ def filter_lines_by_geometry(df_all_lines):
 
     # remove lines without endings (Temporary fix for a Tanzanian line TODO: reformulation?)
     df_all_lines = df_all_lines[
-        df_all_lines["geometry"].map(lambda g: len(g.boundary.geoms) >= 2)
+        count_line_endings(df_all_lines["geometry"].values) >= 2
     ]
 
     return df_all_lines
 
 
+def count_line_endings(geoms):
+    """
+    Count the points of the boundary of the lines in a vectorized way
+
+    The boundary of a line is made by its two endings, unless closed;
+    the boundary of a multi-line is made by the endings of its parts
+    shared by an odd number of parts (mod-2 rule)
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    n_endings = np.where(
+        shapely.is_closed(geoms) | (shapely.get_num_points(geoms) < 2), 0, 2
+    )
+
+    is_multi = shapely.get_type_id(geoms) == shapely.GeometryType.MULTILINESTRING
+    if is_multi.any():
+        parts, part_ids = shapely.get_parts(geoms[is_multi], return_index=True)
+        endings = pd.DataFrame(
+            {
+                "geom_id": np.tile(part_ids, 2),
+                "x": np.concatenate(
+                    [
+                        shapely.get_x(shapely.get_point(parts, 0)),
+                        shapely.get_x(shapely.get_point(parts, -1)),
+                    ]
+                ),
+                "y": np.concatenate(
+                    [
+                        shapely.get_y(shapely.get_point(parts, 0)),
+                        shapely.get_y(shapely.get_point(parts, -1)),
+                    ]
+                ),
+            }
+        ).dropna()
+        n_shared = endings.groupby(["geom_id", "x", "y"]).size()
+        n_multi_endings = (
+            (n_shared % 2 == 1)
+            .groupby(level="geom_id")
+            .sum()
+            .reindex(np.arange(is_multi.sum()), fill_value=0)
+        )
+        n_endings[is_multi] = n_multi_endings.values
+
+    return n_endings
+
+
+def filter_lines_by_shape(df_all_lines, shape):
+    """
+    Keep the lines whose both endpoints are contained in the shape
+
+    The endpoints of all the lines are tested in a single pass
+    against the prepared shape
+    """
+    shapely.prepare(shape)
+
+    geoms = df_all_lines["geometry"].values
+    start_points = shapely.get_point(geoms, 0)
+    end_points = shapely.get_point(geoms, -1)
+
+    is_contained = shapely.contains_xy(
+        shape, shapely.get_x(start_points), shapely.get_y(start_points)
+    ) & shapely.contains_xy(shape, shapely.get_x(end_points), shapely.get_y(end_points))
+
+    return df_all_lines[is_contained]
+
+
 def prepare_generators_df(df_all_generators):
     """
     Prepare the dataframe for generators
@@ -581,14 +700,6 @@ def prepare_generators_df(df_all_generators):
     return df_all_generators
 
 
-def find_first_overlap(geom, country_geoms, default_name):
-    """Return the first country whose shape intersects the geometry"""
-    for c_name, c_geom in country_geoms.items():
-        if not geom.disjoint(c_geom):
-            return c_name
-    return default_name
-
-
 def set_countryname_by_shape(
     df,
     ext_country_shapes,
@@ -596,37 +707,71 @@ def set_countryname_by_shape(
     exclude_external=True,
     col_country="country",
 ):
-    "Set the country name by the name shape"
+    """
+    Set the country name by the name shape
+
+    ext_country_shapes is the CountryShapes lookup of the extended country shapes
+    """
     if names_by_shapes:
-        df[col_country] = [
-            find_first_overlap(
-                row["geometry"],
-                ext_country_shapes,
-                None if exclude_external else row[col_country],
-            )
-            for id, row in df.iterrows()
-        ]
+        df[col_country] = ext_country_shapes.first_overlap(
+            df["geometry"].values,
+            [None] * len(df) if exclude_external else df[col_country].values,
+        )
         df.dropna(subset=[col_country], inplace=True)
     return df
 
 
-def create_extended_country_shapes(country_shapes, offshore_shapes):
-    """Obtain the extended country shape by merging on- and off-shore shapes"""
+@lru_cache(maxsize=None)
+def get_cities_index(cache_path=os.path.join("data", "cities")):
+    """
+    Function to get the KD-tree of the cities of reverse_geocode and their names
+
+    The coordinates (lat, lon) and the names of the cities are extracted
+    from the reverse_geocode data at the first call and cached as .npy and
+    .parquet files in a subfolder of cache_path named after the version of
+    reverse_geocode, so that the cache is rebuilt when the library, and so
+    its city table, changes. The table is read from GeocodeData._locations,
+    which is not public API: reverse-geocode is pinned to 1.6 in
+    envs/environment.yaml accordingly.
+
+    Returns
+    -------
+    tree : cKDTree
+        KD-tree of the (lat, lon) coordinates of the cities
+    cities : DataFrame
+        Name ("city") and country code ("country_code") of the cities
+    """
+    cache_path = os.path.join(cache_path, importlib.metadata.version("reverse_geocode"))
+    coords_file = os.path.join(cache_path, "cities_latlon.npy")
+    names_file = os.path.join(cache_path, "cities.parquet")
+
+    if not (os.path.exists(coords_file) and os.path.exists(names_file)):
+        logger.info(f"Caching the cities of reverse_geocode in {cache_path}")
+        locations = rg.GeocodeData()._locations
+        os.makedirs(cache_path, exist_ok=True)
+
+        cities = pd.DataFrame(
+            {
+                "city": [loc["city"] for loc in locations],
+                "country_code": [loc["country_code"] for loc in locations],
+            }
+        )
+        cities.to_parquet(names_file + ".tmp")
+        os.replace(names_file + ".tmp", names_file)
+
+        coords = np.array(
+            [(loc["latitude"], loc["longitude"]) for loc in locations],
+            dtype=np.float64,
+        )
+        with open(coords_file + ".tmp", "wb") as f:
+            np.save(f, coords)
+        os.replace(coords_file + ".tmp", coords_file)
 
-    merged_shapes = gpd.GeoDataFrame(
-        {
-            "name": list(country_shapes.index),
-            "geometry": [
-                c_geom.unary_union(offshore_shapes[c_code])
-                if c_code in offshore_shapes
-                else c_geom
-                for c_code, c_geom in country_shapes.items()
-            ],
-        },
-        crs=country_shapes.crs,
-    ).set_index("name")["geometry"]
+    # cKDTree copies the coordinates, hence they are loaded in memory
+    coords = np.load(coords_file)
+    cities = pd.read_parquet(names_file)
 
-    return merged_shapes
+    return cKDTree(coords), cities
 
 
 def set_name_by_closestcity(df_all_generators, colname="name"):
@@ -635,34 +780,90 @@ def set_name_by_closestcity(df_all_generators, colname="name"):
     """
 
     # get cities name
-    list_cities = rg.search([g.coords[0] for g in df_all_generators.geometry])
+    tree, cities = get_cities_index()
+    _, city_ids = tree.query(
+        np.column_stack([df_all_generators.geometry.y, df_all_generators.geometry.x])
+    )
+    city_names = pd.Series(
+        cities["city"].to_numpy()[city_ids], index=df_all_generators.index
+    )
 
     # replace name
-    df_all_generators.loc[:, colname] = [
-        l["city"] + "_" + str(id) + " - " + c_code
-        for (l, c_code, id) in zip(
-            list_cities, df_all_generators.country, df_all_generators.index
-        )
-    ]
+    df_all_generators.loc[:, colname] = (
+        city_names
+        + "_"
+        + df_all_generators.index.astype(str)
+        + " - "
+        + df_all_generators["Country"]
+    )
 
     return df_all_generators
 
 
-def clean_data(
-    input_files,
-    output_files,
-    africa_shape,
-    geo_crs,
-    distance_crs,
-    ext_country_shapes=None,
-    names_by_shapes=True,
-    tag_substation="transmission",
-    threshold_voltage=35000,
-    add_line_endings=True,
-    generator_name_method="OSM",
+def iter_clean_lines_chunks(
+    input_files, africa_shape, distance_crs, threshold_voltage, chunk_size
 ):
+    """
+    Clean the raw lines and cables in chunks of chunk_size rows and yield
+    the cleaned chunks
+
+    The chunks are streamed through prepare_lines_df, integrate_lines_df,
+    filter_voltage, filter_lines_by_geometry and filter_lines_by_shape.
+    The default frequency is voted in a first pass that reads only the
+    frequency tags. No chunk is yielded when no raw lines are available.
+    """
+    raw_files = [input_files["lines"], input_files["cables"]]
+
+    # 1st pass: most common frequency among all the lines and cables
+    freq_counts = [
+        df_chunk["tags.frequency"].value_counts(dropna=True)
+        for fn in raw_files
+        for df_chunk in iter_raw_geodata(fn, chunk_size, columns=["tags.frequency"])
+        if "tags.frequency" in df_chunk.columns
+    ]
+    if freq_counts:
+        grid_freq_levels = (
+            pd.concat(freq_counts)
+            .groupby(level=0)
+            .sum()
+            .sort_values(ascending=False, kind="stable")
+        )
+    else:
+        grid_freq_levels = pd.Series(dtype=int)
+    ac_freq_default = get_ac_freq_default(grid_freq_levels)
+
+    # 2nd pass: clean the lines chunk by chunk
+    for fn in raw_files:
+        for df_chunk in iter_raw_geodata(fn, chunk_size):
+            df_chunk = prepare_lines_df(df_chunk)
+            df_chunk = finalize_lines_type(df_chunk)
+            df_chunk = integrate_lines_df(df_chunk, distance_crs, ac_freq_default)
+            df_chunk = filter_voltage(df_chunk, threshold_voltage)
+            df_chunk = filter_lines_by_geometry(df_chunk)
+            df_chunk = filter_lines_by_shape(df_chunk, africa_shape)
+            yield df_chunk
+
+
+def filter_substations(df_all_substations, tag_substation, threshold_voltage):
+    "Filter the substations by tag and voltage"
+    # filter substations by tag
+    if tag_substation:  # if the string is not empty check it
+        df_all_substations = df_all_substations[
+            df_all_substations["tag_substation"] == tag_substation
+        ]
+
+    # filter substation by voltage
+    df_all_substations = filter_voltage(df_all_substations, threshold_voltage)
+
+    return df_all_substations
+
+
+def clean_lines(input_files, africa_shape, distance_crs, threshold_voltage):
+    """
+    Clean the raw lines and cables
+    """
     # Load raw data lines
-    df_lines = gpd.read_file(input_files["lines"])
+    df_lines = read_raw_geodata(input_files["lines"])
 
     # prepare lines dataframe and data types
     df_lines = prepare_lines_df(df_lines)
@@ -671,11 +872,11 @@ def clean_data(
     # initialize name of the final dataframe
     df_all_lines = df_lines
 
-    # load cables only if data are stored
-    if os.path.getsize(input_files["cables"]) > 0:
-        # Load raw data lines
-        df_cables = gpd.read_file(input_files["cables"])
+    # Load raw data cables
+    df_cables = read_raw_geodata(input_files["cables"])
 
+    # process cables only if data are stored
+    if not df_cables.empty:
         # prepare cables dataframe and data types
         df_cables = prepare_lines_df(df_cables)
         df_cables = finalize_lines_type(df_cables)
@@ -694,13 +895,74 @@ def clean_data(
     df_all_lines = filter_lines_by_geometry(df_all_lines)
 
     # drop lines crossing regions with and without the region under interest
-    df_all_lines = df_all_lines[
-        df_all_lines.apply(lambda x: africa_shape.contains(x.geometry.boundary), axis=1)
-    ]
+    df_all_lines = filter_lines_by_shape(df_all_lines, africa_shape)
 
-    # set unique line ids
-    df_all_lines = set_unique_id(df_all_lines, "line_id")
+    return df_all_lines
+
+
+def clean_substations(input_files, tag_substation, threshold_voltage):
+    """
+    Clean the raw substations
+    """
+    df_all_substations = read_raw_geodata(input_files["substations"])
+
+    # prepare dataset for substations
+    df_all_substations = prepare_substation_df(df_all_substations)
+
+    return filter_substations(df_all_substations, tag_substation, threshold_voltage)
+
+
+def iter_clean_substations_chunks(
+    input_files, tag_substation, threshold_voltage, chunk_size
+):
+    """
+    Clean the raw substations in chunks of chunk_size rows and yield the
+    cleaned chunks; no chunk is yielded when no raw substations are available
+    """
+    for df_chunk in iter_raw_geodata(input_files["substations"], chunk_size):
+        yield filter_substations(
+            prepare_substation_df(df_chunk), tag_substation, threshold_voltage
+        )
+
+
+def iter_lines_with_countries(
+    input_files,
+    africa_shape,
+    distance_crs,
+    ext_country_shapes=None,
+    names_by_shapes=True,
+    threshold_voltage=None,
+    chunk_size=None,
+):
+    """
+    Clean the raw lines and cables, set their country and yield them in chunks
+    of chunk_size rows, or at once when chunk_size is None
+
+    The lines are filtered by voltage before setting their country, unless
+    threshold_voltage is None
+    """
+    if chunk_size:
+        df_chunks = iter_clean_lines_chunks(
+            input_files, africa_shape, distance_crs, threshold_voltage, chunk_size
+        )
+    else:
+        df_chunks = []
+
+    has_chunks = False
+    for df_chunk in df_chunks:
+        has_chunks = True
+        yield set_lines_country(df_chunk, ext_country_shapes, names_by_shapes)
+
+    if not has_chunks:
+        # no chunks, or no raw lines available
+        df_all_lines = clean_lines(
+            input_files, africa_shape, distance_crs, threshold_voltage
+        )
+        yield set_lines_country(df_all_lines, ext_country_shapes, names_by_shapes)
 
+
+def set_lines_country(df_all_lines, ext_country_shapes, names_by_shapes):
+    "Set the country of the cleaned lines and parse their dtypes"
     df_all_lines = gpd.GeoDataFrame(df_all_lines, geometry="geometry")
 
     # set the country name by the shape
@@ -708,37 +970,52 @@ def clean_data(
         df_all_lines, ext_country_shapes, names_by_shapes=names_by_shapes
     )
 
-    save_to_geojson(df_all_lines, output_files["lines"])
-
-    # ----------- SUBSTATIONS -----------
+    # parse numeric and categorical columns once
+    return set_osm_dtypes(df_all_lines, lines_dtypes)
 
-    df_all_substations = gpd.read_file(input_files["substations"])
 
-    # prepare dataset for substations
-    df_all_substations = prepare_substation_df(df_all_substations)
+def iter_substations_with_countries(
+    input_files,
+    ext_country_shapes=None,
+    names_by_shapes=True,
+    tag_substation=None,
+    threshold_voltage=None,
+    chunk_size=None,
+):
+    """
+    Clean the raw substations, set their country and yield them in chunks
+    of chunk_size rows, or at once when chunk_size is None
 
-    # add line endings if option is enabled
-    if add_line_endings:
-        df_all_substations = add_line_endings_tosubstations(
-            gpd.GeoDataFrame(), df_all_lines
+    The substations are filtered by tag and voltage before setting their
+    country, unless tag_substation and threshold_voltage are None
+    """
+    if chunk_size:
+        df_chunks = iter_clean_substations_chunks(
+            input_files, tag_substation, threshold_voltage, chunk_size
         )
+    else:
+        df_chunks = []
 
-    # filter substations by tag
-    if tag_substation:  # if the string is not empty check it
-        df_all_substations = df_all_substations[
-            df_all_substations["tag_substation"] == tag_substation
-        ]
+    has_chunks = False
+    for df_chunk in df_chunks:
+        has_chunks = True
+        yield set_substations_country(df_chunk, ext_country_shapes, names_by_shapes)
 
-    # filter substation by voltage
-    df_all_substations = filter_voltage(df_all_substations, threshold_voltage)
+    if not has_chunks:
+        # no chunks, or no raw substations available
+        df_all_substations = clean_substations(
+            input_files, tag_substation, threshold_voltage
+        )
+        yield set_substations_country(
+            df_all_substations, ext_country_shapes, names_by_shapes
+        )
 
+
+def set_substations_country(df_all_substations, ext_country_shapes, names_by_shapes):
+    "Set the country of the cleaned substations and parse their dtypes"
     # finalize dataframe types
     df_all_substations = finalize_substation_types(df_all_substations)
 
-    # set unique bus ids
-    df_all_substations = set_unique_id(df_all_substations, "bus_id")
-
-    # save to geojson file
     df_all_substations = gpd.GeoDataFrame(df_all_substations, geometry="geometry")
 
     # set the country name by the shape
@@ -749,11 +1026,181 @@ def clean_data(
         col_country="Country",
     )
 
+    # parse numeric and categorical columns once
+    return set_osm_dtypes(df_all_substations, substations_dtypes)
+
+
+def get_clean_cache_path(
+    cache_dir, name, raw_files, shape_files, distance_crs, names_by_shapes
+):
+    """
+    Get the path of the cached intermediate result name, addressed by the content
+    of the raw files, the shape files and the options that affect the result
+
+    The content of the files is hashed once and then cached in cache_dir, keyed
+    on their path, size and modification time by get_file_md5. The caching is disabled when the
+    shape files are not specified.
+    """
+    if not cache_dir:
+        return None
+
+    if shape_files is None:
+        logger.warning(
+            "The cache of clean_osm_data is disabled: the shape files are not specified"
+        )
+        return None
+
+    files = [fn_raw for fn in raw_files for fn_raw in get_raw_files(fn)]
+    files += [fn for fn in shape_files if os.path.getsize(fn) > 0]
+
+    key = get_cache_key(
+        files,
+        cache_dir,
+        version=CLEAN_CACHE_VERSION,
+        name=name,
+        distance_crs=str(distance_crs),
+        names_by_shapes=names_by_shapes,
+    )
+    return os.path.join(cache_dir, f"{name}_{key}")
+
+
+def clean_data(
+    input_files,
+    output_files,
+    africa_shape,
+    geo_crs,
+    distance_crs,
+    ext_country_shapes=None,
+    names_by_shapes=True,
+    tag_substation="transmission",
+    threshold_voltage=35000,
+    add_line_endings=True,
+    generator_name_method="OSM",
+    chunk_size=None,
+    cache_dir=None,
+    shape_files=None,
+):
+    """
+    Clean the raw OSM data of lines, substations and generators
+
+    When chunk_size is specified, the raw lines, cables and substations are
+    cleaned in chunks of chunk_size rows to bound the memory usage
+
+    When cache_dir is specified, the cleaned lines and substations with
+    their countries are cached before the voltage and tag filters, so that
+    changing threshold_voltage or tag_substation does not repeat the
+    geometric operations. The cache is keyed on the raw files and on
+    shape_files, the files of africa_shape and ext_country_shapes.
+    Without cache, the lines and substations are filtered before setting
+    their countries.
+    """
+    if ext_country_shapes is not None and not isinstance(
+        ext_country_shapes, CountryShapes
+    ):
+        # index the country shapes once
+        ext_country_shapes = CountryShapes(ext_country_shapes)
+
+    lines_cache_path = get_clean_cache_path(
+        cache_dir,
+        "lines",
+        [input_files["lines"], input_files["cables"]],
+        shape_files,
+        distance_crs,
+        names_by_shapes,
+    )
+    df_chunks = cached_geodata_chunks(
+        lines_cache_path,
+        iter_lines_with_countries,
+        input_files,
+        africa_shape,
+        distance_crs,
+        ext_country_shapes=ext_country_shapes,
+        names_by_shapes=names_by_shapes,
+        threshold_voltage=threshold_voltage if lines_cache_path is None else None,
+        chunk_size=chunk_size,
+        read_chunk_size=chunk_size,
+    )
+
+    # filter lines by voltage
+    df_all_lines = pd.concat(
+        [filter_voltage(df_chunk, threshold_voltage) for df_chunk in df_chunks],
+        ignore_index=True,
+    )
+    df_all_lines = set_osm_dtypes(df_all_lines, lines_dtypes)
+
+    # set unique line ids
+    df_all_lines = set_unique_id(df_all_lines, "line_id")
+
+    save_to_geojson(df_all_lines, output_files["lines"])
+
+    # ----------- SUBSTATIONS -----------
+
+    # add line endings if option is enabled
+    if add_line_endings:
+        df_all_substations = add_line_endings_tosubstations(
+            gpd.GeoDataFrame(), df_all_lines
+        )
+        df_all_substations = filter_substations(
+            df_all_substations, tag_substation, threshold_voltage
+        )
+
+        # finalize dataframe types
+        df_all_substations = finalize_substation_types(df_all_substations)
+
+        # set unique bus ids
+        df_all_substations = set_unique_id(df_all_substations, "bus_id")
+
+        df_all_substations = gpd.GeoDataFrame(df_all_substations, geometry="geometry")
+
+        # set the country name by the shape
+        df_all_substations = set_countryname_by_shape(
+            df_all_substations,
+            ext_country_shapes,
+            names_by_shapes=names_by_shapes,
+            col_country="Country",
+        )
+    else:
+        substations_cache_path = get_clean_cache_path(
+            cache_dir,
+            "substations",
+            [input_files["substations"]],
+            shape_files,
+            distance_crs,
+            names_by_shapes,
+        )
+        is_cached = substations_cache_path is not None
+        df_chunks = cached_geodata_chunks(
+            substations_cache_path,
+            iter_substations_with_countries,
+            input_files,
+            ext_country_shapes=ext_country_shapes,
+            names_by_shapes=names_by_shapes,
+            tag_substation=None if is_cached else tag_substation,
+            threshold_voltage=None if is_cached else threshold_voltage,
+            chunk_size=chunk_size,
+            read_chunk_size=chunk_size,
+        )
+
+        # filter substations by tag and voltage
+        df_all_substations = pd.concat(
+            [
+                filter_substations(df_chunk, tag_substation, threshold_voltage)
+                for df_chunk in df_chunks
+            ],
+            ignore_index=True,
+        )
+
+        # set unique bus ids
+        df_all_substations = set_unique_id(df_all_substations, "bus_id")
+
+    # parse numeric and categorical columns once
+    df_all_substations = set_osm_dtypes(df_all_substations, substations_dtypes)
+
     save_to_geojson(df_all_substations, output_files["substations"])
 
     # ----------- GENERATORS -----------
 
-    df_all_generators = gpd.read_file(input_files["generators"])
+    df_all_generators = read_raw_geodata(input_files["generators"])
 
     # prepare the generator dataset
     df_all_generators = prepare_generators_df(df_all_generators)
@@ -794,6 +1241,8 @@ if __name__ == "__main__":
     generator_name_method = snakemake.config["clean_osm_data_options"].get(
         "generator_name_method", "OSM"
     )
+    chunk_size = snakemake.config["clean_osm_data_options"].get("chunk_size", None)
+    cache_dir = snakemake.config["clean_osm_data_options"].get("cache_dir", None)
     offshore_shape_path = snakemake.input.offshore_shapes
     onshore_shape_path = snakemake.input.country_shapes
     geo_crs = snakemake.config["crs"]["geo_crs"]
@@ -806,20 +1255,11 @@ if __name__ == "__main__":
 
     # only when country names are defined by shapes, load the info
     if names_by_shapes:
-        country_shapes = gpd.read_file(onshore_shape_path).set_index("name")["geometry"]
-
-    if os.stat(offshore_shape_path).st_size == 0:
-        logger.info("No offshore file exist. Passing only onshore shape")
-        ext_country_shapes = country_shapes
-
-    else:
-        logger.info("Combining on- and offshore shape")
-        offshore_shapes = gpd.read_file(offshore_shape_path).set_index("name")[
-            "geometry"
-        ]
-        ext_country_shapes = create_extended_country_shapes(
-            country_shapes, offshore_shapes
+        ext_country_shapes = load_extended_country_shapes(
+            onshore_shape_path, offshore_shape_path, cache_dir=cache_dir
         )
+    else:
+        ext_country_shapes = None
 
     clean_data(
         input_files,
@@ -833,4 +1273,11 @@ if __name__ == "__main__":
         threshold_voltage=threshold_voltage,
         add_line_endings=add_line_endings,
         generator_name_method=generator_name_method,
+        chunk_size=chunk_size,
+        cache_dir=cache_dir,
+        shape_files=[
+            snakemake.input.africa_shape,
+            onshore_shape_path,
+            offshore_shape_path,
+        ],
     )
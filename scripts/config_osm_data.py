@@ -143,6 +143,27 @@ feature_columns = {
     "tower": columns_basic + columns_tower,
 }
 
+# ===============================
+# CLEAN OSM DATA TYPES
+# ===============================
+# Dtypes of the cleaned OSM tables written by clean_osm_data and read by build_osm_network.
+# Numeric tags are parsed once; repetitive string tags are stored as categoricals.
+
+lines_dtypes = {
+    "voltage": "int64",
+    "circuits": "int64",
+    "tag_frequency": "float64",
+    "tag_type": "category",
+    "country": "category",
+}
+
+substations_dtypes = {
+    "voltage": "int64",
+    "symbol": "category",
+    "tag_substation": "category",
+    "country": "category",
+}
+
 # Python dictionary of ISO 3166-1-alpha-2 codes, as per publicly
 # available data on official ISO site in July 2015.
 #
@@ -11,20 +11,35 @@
 # Disables pylint problem in this scripts
 # pylint: disable=E1120
 """ OSM extraction script."""
-import hashlib
+import gzip
+import io
+import itertools
 import json
 import logging
 import multiprocessing as mp
 import os
 import pickle
 import shutil
+import struct
 import sys
+import zlib
+from xml.etree import ElementTree
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import requests
+import shapely
 import urllib3
-from _helpers import configure_logging, sets_path_to_root, to_csv_nafix
+from _helpers import (
+    configure_logging,
+    download_files,
+    get_file_md5,
+    get_raw_path,
+    save_raw_geodata,
+    sets_path_to_root,
+    to_csv_nafix,
+)
 from config_osm_data import (
     continent_regions,
     continents,
@@ -39,7 +54,7 @@ from esy.osmfilter import osm_info as osm_info
 from esy.osmfilter import osm_pickle as osm_pickle
 from esy.osmfilter import run_filter
 from shapely import geometry
-from shapely.geometry import LineString, Point, Polygon
+from shapely.geometry import LineString, Point
 from tqdm import tqdm
 
 # esy.osm filter: https://gitlab.com/dlr-ve-esy/esy-osmfilter/-/tree/master/
@@ -53,6 +68,9 @@ _logger.setLevel(logging.INFO)
 
 OSM_CRS = "EPSG:4326"
 
+# features downloaded by default; "tower" is also available in feature_category
+DEFAULT_FEATURE_LIST = ["substation", "generator", "line", "cable"]
+
 
 def getContinentCountry(code):
     """
@@ -65,22 +83,9 @@ def getContinentCountry(code):
     return continent, country
 
 
-def download_pbf(country_code, update, verify, logging=True):
+def get_pbf_paths(country_code):
     """
-    Download pbf file from geofabrik for a given country code
-
-    Parameters
-    ----------
-    country_code : str
-        Three letter country codes of the downloaded files
-    update : bool
-        Name of the network component
-        Update = true, forces re-download of files
-
-    Returns
-    -------
-    Pbf file per country
-
+    Get the geofabrik url and the local path of the pbf file of a country
     """
     continent, country_name = getContinentCountry(country_code)
     # Filename for geofabrik
@@ -101,26 +106,42 @@ def download_pbf(country_code, update, verify, logging=True):
         os.getcwd(), "data", "osm", continent, "pbf", geofabrik_filename
     )
 
+    return geofabrik_url, PBF_inputfile
+
+
+def download_pbf(country_code, update, verify, logging=True):
+    """
+    Download pbf file from geofabrik for a given country code
+
+    Parameters
+    ----------
+    country_code : str
+        Three letter country codes of the downloaded files
+    update : bool
+        Name of the network component
+        Update = true, forces re-download of files
+
+    Returns
+    -------
+    Pbf file per country
+
+    """
+    geofabrik_url, PBF_inputfile = get_pbf_paths(country_code)
+    geofabrik_filename = os.path.basename(PBF_inputfile)
+
     _logger.info(f" Input file {PBF_inputfile} ")
 
     if not os.path.exists(PBF_inputfile):
         if logging:
             _logger.info(f"{geofabrik_filename} downloading to {PBF_inputfile}")
-        #  create data/osm directory
-        os.makedirs(os.path.dirname(PBF_inputfile), exist_ok=True)
-        with requests.get(geofabrik_url, stream=True, verify=False) as r:
-
-            if r.status_code == 200:
-                # url properly found, thus execute as expected
-                with open(PBF_inputfile, "wb") as f:
-                    shutil.copyfileobj(r.raw, f)
-            else:
-                # error status code: file not found
-                _logger.error(
-                    f"Error code: {r.status_code}. File {geofabrik_filename} not downloaded from {geofabrik_url}"
-                )
+        download_files([(geofabrik_url, PBF_inputfile)], verify=False)
 
-    if verify is True:
+        # the replication state of a replaced pbf file is outdated
+        if os.path.exists(PBF_inputfile + ".state.txt"):
+            os.remove(PBF_inputfile + ".state.txt")
+
+    # the pbf files updated with the replication diffs cannot match the md5 of Geofabrik
+    if verify is True and not is_updated_pbf(PBF_inputfile):
         if verify_pbf(PBF_inputfile, geofabrik_url, update) is False:
             _logger.warning(f"md5 mismatch, deleting {geofabrik_filename}")
             if os.path.exists(PBF_inputfile):
@@ -135,6 +156,14 @@ def download_pbf(country_code, update, verify, logging=True):
 verified_pbf = []
 
 
+def is_updated_pbf(PBF_inputfile):
+    """
+    Check whether the pbf file has been updated by update_pbf, which stores
+    the replication state of the file in {PBF_inputfile}.state.txt
+    """
+    return os.path.exists(PBF_inputfile + ".state.txt")
+
+
 def verify_pbf(PBF_inputfile, geofabrik_url, update):
     if PBF_inputfile in verified_pbf:
         return True
@@ -142,19 +171,12 @@ def verify_pbf(PBF_inputfile, geofabrik_url, update):
     geofabrik_md5_url = geofabrik_url + ".md5"
     PBF_md5file = PBF_inputfile + ".md5"
 
-    def calculate_md5(fname):
-        hash_md5 = hashlib.md5()
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-
     if update is True or not os.path.exists(PBF_md5file):
         with requests.get(geofabrik_md5_url, stream=True, verify=False) as r:
             with open(PBF_md5file, "wb") as f:
                 shutil.copyfileobj(r.raw, f)
 
-    local_md5 = calculate_md5(PBF_inputfile)
+    local_md5 = get_file_md5(PBF_inputfile)
 
     with open(PBF_md5file) as f:
         contents = f.read()
@@ -167,10 +189,224 @@ def verify_pbf(PBF_inputfile, geofabrik_url, update):
         return False
 
 
+GEOFABRIK_URL = "https://download.geofabrik.de"
+
+
+def get_pbf_sequence_number(PBF_inputfile):
+    """
+    Read the replication sequence number from the header block of a pbf file
+
+    Geofabrik extracts store the sequence number of the replication diffs
+    they are based on in the osmosis_replication_sequence_number field.
+    Returns None when the field is not available.
+    """
+    from esy.osm.pbf import fileformat_pb2, osmformat_pb2
+
+    with open(PBF_inputfile, "rb") as f:
+        (header_size,) = struct.unpack(">I", f.read(4))
+        header = fileformat_pb2.BlobHeader()
+        header.ParseFromString(f.read(header_size))
+        blob = fileformat_pb2.Blob()
+        blob.ParseFromString(f.read(header.datasize))
+
+    data = zlib.decompress(blob.zlib_data) if blob.zlib_data else blob.raw
+    header_block = osmformat_pb2.HeaderBlock()
+    header_block.ParseFromString(data)
+
+    if header_block.HasField("osmosis_replication_sequence_number"):
+        return header_block.osmosis_replication_sequence_number
+    return None
+
+
+def read_state_sequence_number(state_file):
+    """Read the sequenceNumber of a replication state.txt file"""
+    with open(state_file) as f:
+        for line in f:
+            if line.startswith("sequenceNumber="):
+                return int(line.split("=", 1)[1])
+    return None
+
+
+def _fetch_update_file(diff_source, relpath, dest_file):
+    """
+    Fetch a replication file from diff_source into dest_file
+
+    diff_source is either the url of a Geofabrik-like server or a local directory
+    with the same layout, e.g. {diff_source}/africa/nigeria-updates/state.txt
+    """
+    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+
+    if os.path.isdir(diff_source):
+        shutil.copyfile(os.path.join(diff_source, relpath), dest_file)
+        return
+
+    with requests.get(
+        f"{diff_source.rstrip('/')}/{relpath}", stream=True, verify=False
+    ) as r:
+        r.raise_for_status()
+        with open(dest_file, "wb") as f:
+            shutil.copyfileobj(r.raw, f)
+
+
+def iter_osc_elements(osc_file):
+    """Yield (element type, id, power tag) of the elements of an .osc.gz diff"""
+    with gzip.open(osc_file) as f:
+        for _, elem in ElementTree.iterparse(f, events=("end",)):
+            if elem.tag in ["node", "way", "relation"]:
+                power = None
+                for tag in elem.iter("tag"):
+                    if tag.get("k") == "power":
+                        power = tag.get("v")
+                yield elem.tag, elem.get("id"), power
+                elem.clear()
+
+
+def update_pbf(country_code, feature_list, diff_source=GEOFABRIK_URL):
+    """
+    Update a pbf file incrementally with the replication diffs of Geofabrik
+
+    The replication sequence number of the local extract is stored in
+    {PBF_inputfile}.state.txt (initialized from the pbf header); the .osc.gz
+    diffs between the local and the remote sequence number are fetched
+    and applied to the pbf file with pyosmium. When pyosmium is not available,
+    the pbf file is downloaded again.
+    The filtered data of the country are not removed: process_data filters
+    again the countries whose power features may have changed.
+
+    Parameters
+    ----------
+    country_code : str
+        Geofabrik code of the country
+    feature_list : list
+        Features whose changes require to filter the country again
+    diff_source : str
+        Url of the replication server or local directory with the same layout
+
+    Returns
+    -------
+    changed : bool
+        True when the power features of the country may have changed
+    """
+    continent, country_name = getContinentCountry(country_code)
+
+    PBF_inputfile = download_pbf(country_code, update=False, verify=False)
+    PBF_statefile = PBF_inputfile + ".state.txt"
+
+    if not os.path.exists(PBF_inputfile):
+        return True
+
+    if os.path.exists(PBF_statefile):
+        local_seq = read_state_sequence_number(PBF_statefile)
+    else:
+        local_seq = get_pbf_sequence_number(PBF_inputfile)
+
+    # the layout of the updates folder follows the one of Geofabrik
+    updates_relpath = (
+        f"{country_name}-updates"
+        if continent == country_name
+        else f"{continent}/{country_name}-updates"
+    )
+    updates_path = os.path.join(
+        os.path.dirname(PBF_inputfile), f"{country_name}-updates"
+    )
+    remote_statefile = os.path.join(updates_path, "state.txt")
+
+    _fetch_update_file(diff_source, f"{updates_relpath}/state.txt", remote_statefile)
+    remote_seq = read_state_sequence_number(remote_statefile)
+
+    if local_seq is None:
+        _logger.warning(
+            f"Unknown sequence number of {PBF_inputfile}: the file is downloaded again"
+        )
+        os.remove(PBF_inputfile)
+        download_pbf(country_code, update=True, verify=False)
+        shutil.copyfile(remote_statefile, PBF_statefile)
+        return True
+
+    if remote_seq <= local_seq:
+        _logger.info(f"No changes for {country_name} since sequence {local_seq}")
+        return False
+
+    # fetch the diffs
+    osc_files = []
+    for seq in range(local_seq + 1, remote_seq + 1):
+        seq_str = f"{seq:09d}"
+        seq_relpath = f"{seq_str[0:3]}/{seq_str[3:6]}/{seq_str[6:9]}.osc.gz"
+        osc_file = os.path.join(updates_path, *seq_relpath.split("/"))
+        _fetch_update_file(diff_source, f"{updates_relpath}/{seq_relpath}", osc_file)
+        osc_files.append(osc_file)
+
+    _logger.info(
+        f"Applying {len(osc_files)} diffs to {country_name} "
+        f"(sequence {local_seq} to {remote_seq})"
+    )
+
+    # check whether power features or nodes of the pre-filtered data have changed
+    file_stored_pickle = os.path.join(
+        os.getcwd(), "data", "osm", continent, f"Data_{country_code}.pickle"
+    )
+    if os.path.exists(file_stored_pickle):
+        with open(file_stored_pickle, "rb") as f:
+            Data = pickle.load(f)
+        known_ids = {
+            "node": set(Data.get("Node", {})),
+            "way": set(Data.get("Way", {})),
+            "relation": set(Data.get("Relation", {})),
+        }
+        changed = any(
+            (power in feature_list) or (element_id in known_ids[element_type])
+            for osc_file in osc_files
+            for element_type, element_id, power in iter_osc_elements(osc_file)
+        )
+    else:
+        changed = True
+
+    try:
+        import osmium
+
+        merge_reader = osmium.MergeInputReader()
+        for osc_file in osc_files:
+            merge_reader.add_file(osc_file)
+
+        PBF_tmpfile = PBF_inputfile.replace(".osm.pbf", ".tmp.osm.pbf")
+        if os.path.exists(PBF_tmpfile):
+            os.remove(PBF_tmpfile)
+        # the updated pbf file stores the new sequence number as Geofabrik extracts
+        header = osmium.io.Header()
+        header.set("osmosis_replication_sequence_number", str(remote_seq))
+        writer = osmium.io.Writer(PBF_tmpfile, header)
+        merge_reader.apply_to_reader(osmium.io.Reader(PBF_inputfile), writer, False)
+        writer.close()
+        os.replace(PBF_tmpfile, PBF_inputfile)
+    except ImportError:
+        _logger.warning("pyosmium not available: the pbf file is downloaded again")
+        os.remove(PBF_inputfile)
+        download_pbf(country_code, update=True, verify=False)
+
+    shutil.copyfile(remote_statefile, PBF_statefile)
+
+    # the md5 of the updated pbf file no longer matches the Geofabrik one
+    if os.path.exists(PBF_inputfile + ".md5"):
+        os.remove(PBF_inputfile + ".md5")
+
+    if not changed:
+        _logger.info(f"No changes of the power features of {country_name}")
+
+    return changed
+
+
 pre_filtered = []
 
 
-def download_and_filter(feature, country_code, update=False, verify=False):
+def download_and_filter(
+    feature,
+    country_code,
+    update=False,
+    verify=False,
+    feature_list=None,
+    multiprocess=True,
+    filter_features=None,
+):
     """
     Download OpenStreetMap raw file for selected tag.
 
@@ -187,6 +423,13 @@ def download_and_filter(feature, country_code, update=False, verify=False):
         Name of the network component
         Update = true, forces re-download of files
         Update = false, uses existing or previously downloaded files to safe time
+    feature_list : list
+        Features used to pre-filter the pbf file; DEFAULT_FEATURE_LIST
+        by default
+    multiprocess : bool
+        When true, run_filter pre-filters the pbf file with a process pool
+    filter_features : list
+        Values of the power tag of the created elements; [feature] by default
 
     Returns
     -------
@@ -200,18 +443,25 @@ def download_and_filter(feature, country_code, update=False, verify=False):
 
     continent, country_name = getContinentCountry(country_code)
 
+    if feature_list is None:
+        feature_list = DEFAULT_FEATURE_LIST
+
     # folder path
     folder_path = os.path.join(os.getcwd(), "data", "osm", continent)
 
+    # working folder of run_filter: one per country and feature to allow parallel runs
+    work_path = os.path.join(folder_path, country_code, feature)
+    os.makedirs(work_path, exist_ok=True)
+
     # path of the Data.pickle used by run_filter
-    file_pickle = os.path.join(folder_path, "Data.pickle")
+    file_pickle = os.path.join(work_path, "Data.pickle")
 
     # path of the backup file
     file_stored_pickle = os.path.join(folder_path, f"Data_{country_code}.pickle")
 
     # json file for the Data dictionary
-    JSON_outputfile = os.path.join(folder_path, country_code + "_power.json")
-    # json file for the Elements dictionary is automatically written to "data/osm/Elements"+filename)
+    JSON_outputfile = os.path.join(work_path, country_code + "_power.json")
+    # json file for the Elements dictionary is automatically written to work_path/Elements
 
     # check if data have already been processed or not
     filter_file_exists = False
@@ -258,10 +508,14 @@ def download_and_filter(feature, country_code, update=False, verify=False):
         ("", ""),
     ]
 
+    if filter_features is None:
+        filter_features = [feature]
+
     whitefilter = [
         [
-            ("power", feature),
-        ],
+            ("power", f),
+        ]
+        for f in filter_features
     ]
 
     Data, Elements = run_filter(
@@ -275,17 +529,14 @@ def download_and_filter(feature, country_code, update=False, verify=False):
         CreateElements=create_elements,
         LoadElements=True,
         verbose=False,
-        multiprocess=True,
+        multiprocess=multiprocess,
     )
 
     # if new_prefilter_data, the prefiltering is performed and the Data.pickle for the country is created;
     # save a backup file
     if new_prefilter_data:
-        if os.path.exists(file_stored_pickle):
-            os.remove(file_pickle)
-        else:
-            # rename and store pickle country
-            os.rename(file_pickle, file_stored_pickle)
+        # rename and store pickle country, replacing the outdated one when updated
+        os.replace(file_pickle, file_stored_pickle)
 
     logging.disable(
         logging.NOTSET
@@ -299,6 +550,63 @@ def download_and_filter(feature, country_code, update=False, verify=False):
     return feature_data
 
 
+def download_and_filter_all(
+    country_code, feature_list, update=False, verify=False, multiprocess=True
+):
+    """
+    Download and filter all the features of a country in a single pass.
+
+    The elements of all the features are created by a single run_filter
+    call and then split by the value of the power tag, so that
+    the pre-filtered data of the country are loaded and filtered only once.
+
+    Parameters
+    ----------
+    country_code : str
+        Geofabrik code of the country
+    feature_list : list
+        Features to filter, e.g. ["substation", "line"]
+    update : bool
+        When true, the pbf file is downloaded and pre-filtered again
+    verify : bool
+        When true, the md5 of the pbf file is checked
+    multiprocess : bool
+        When true, run_filter pre-filters the pbf file with a process pool
+
+    Returns
+    -------
+    feature_data : Data, Elements
+        Elements contains the elements of each feature, with the same
+        elementname used by download_and_filter
+    """
+    Data, Elements_power = download_and_filter(
+        "power",
+        country_code,
+        update,
+        verify,
+        feature_list=feature_list,
+        multiprocess=multiprocess,
+        filter_features=feature_list,
+    )
+
+    elements_power = Elements_power[f"{country_code}_powers"]
+
+    # split the elements by the value of the power tag
+    Elements = {
+        f"{country_code}_{feature}s": {
+            element_type: {} for element_type in elements_power.keys()
+        }
+        for feature in feature_list
+    }
+    for element_type, elements in elements_power.items():
+        for element_id, element in elements.items():
+            elementname = f"{country_code}_{element['tags'].get('power')}s"
+            if elementname in Elements:
+                Elements[elementname][element_type][element_id] = element
+
+    return Data, Elements
+
+
 def convert_filtered_data_to_dfs(country_code, feature_data, feature):
     """Convert Filtered Data, Elements to Pandas Dataframes"""
     Data, Elements = feature_data
@@ -308,65 +616,184 @@ def convert_filtered_data_to_dfs(country_code, feature_data, feature):
     return (df_node, df_way, Data)
 
 
-def lonlat_lookup(df_way, Data):
-    """Lookup refs and convert to list of longlats"""
+def build_node_index(Data):
+    """
+    Build an indexed node store from the pre-filtered OpenStreetMap data
+
+    Parameters
+    ----------
+    Data : dict
+        Pre-filtered data as returned by run_filter; nodes are stored
+        in Data["Node"] as {str(id): {"lonlat": [lon, lat], ...}}
+
+    Returns
+    -------
+    node_ids : np.ndarray
+        Sorted int64 array of the node ids
+    node_lonlat : np.ndarray
+        float64 array (N, 2) of the coordinates sorted as node_ids
+    """
+    n_nodes = len(Data["Node"])
+    node_ids = np.fromiter(map(int, Data["Node"].keys()), dtype=np.int64, count=n_nodes)
+    node_lonlat = np.array(
+        [n["lonlat"] for n in Data["Node"].values()], dtype=np.float64
+    ).reshape(n_nodes, 2)
+
+    sort_ids = np.argsort(node_ids, kind="stable")
+
+    return node_ids[sort_ids], node_lonlat[sort_ids]
+
+
+def lonlat_lookup(df_way, node_index):
+    """
+    Lookup refs of the ways in the node index
+
+    All the refs are resolved in a single searchsorted pass; the coordinates
+    of the i-th way are stored in coords[offsets[i]:offsets[i + 1]].
+    Refs missing from the node index are skipped, hence a way may be empty
+    when none of its refs is found; the number of such ways is logged.
+
+    Parameters
+    ----------
+    df_way : DataFrame
+        Ways dataframe with the "refs" column
+    node_index : tuple
+        Sorted node ids and coordinates, as returned by build_node_index
+
+    Returns
+    -------
+    coords : np.ndarray
+        float64 array (M, 2) of the longitude and latitude of all the refs
+    offsets : np.ndarray
+        int64 array of len(df_way) + 1 offsets of the ways in coords
+    """
     if "refs" not in df_way.columns:
-        _logger.warning("refs column not found")
-        print(df_way.columns)
+        _logger.warning(f"refs column not found in columns {list(df_way.columns)}")
+
+    node_ids, node_lonlat = node_index
+
+    n_refs = df_way["refs"].map(len).to_numpy(dtype=np.int64)
+    refs = np.fromiter(
+        itertools.chain.from_iterable(df_way["refs"]),
+        dtype=np.int64,
+        count=n_refs.sum(),
+    )
+    way_ids = np.repeat(np.arange(len(n_refs)), n_refs)
 
-    def look(ref):
-        lonlat_row = list(map(lambda r: tuple(Data["Node"][str(r)]["lonlat"]), ref))
-        return lonlat_row
+    pos = np.minimum(np.searchsorted(node_ids, refs), max(len(node_ids) - 1, 0))
+    if len(node_ids) > 0:
+        is_found = node_ids[pos] == refs
+    else:
+        is_found = np.zeros(len(refs), dtype=bool)
+
+    if not is_found.all():
+        _logger.warning(
+            f"{(~is_found).sum()} refs not found in the nodes data: they are skipped"
+        )
+        n_refs = np.bincount(way_ids[is_found], minlength=len(n_refs))
+
+        n_empty = np.count_nonzero(n_refs == 0)
+        if n_empty > 0:
+            _logger.warning(f"{n_empty} ways have no refs found in the nodes data")
 
-    lonlat_list = df_way["refs"].apply(look)
+    offsets = np.zeros(len(n_refs) + 1, dtype=np.int64)
+    np.cumsum(n_refs, out=offsets[1:])
 
-    return lonlat_list
+    return node_lonlat[pos[is_found]], offsets
+
+
+def drop_short_ways(df_way, coords, offsets, min_nodes):
+    """
+    Drop inplace the ways of df_way with less than min_nodes resolved nodes
 
+    Returns the coords and offsets of the remaining ways, as by lonlat_lookup
+    """
+    n_nodes = np.diff(offsets)
+    is_short = n_nodes < min_nodes
 
-def convert_ways_points(df_way, Data, geo_crs, distance_crs):
-    """Convert Ways to Point Coordinates"""
-    lonlat_list = lonlat_lookup(df_way, Data)
-    way_polygon = list(
-        map(
-            lambda lonlat: Polygon(lonlat) if len(lonlat) >= 3 else Point(lonlat[0]),
-            lonlat_list,
+    if is_short.any():
+        _logger.warning(
+            f"{is_short.sum()} ways with less than {min_nodes} nodes are dropped"
         )
+        df_way.drop(df_way.index[is_short], inplace=True)
+        coords = coords[np.repeat(~is_short, n_nodes)]
+        offsets = np.zeros(len(df_way) + 1, dtype=np.int64)
+        np.cumsum(n_nodes[~is_short], out=offsets[1:])
+
+    return coords, offsets
+
+
+def _split_lonlat(coords, offsets):
+    """Convert the coords buffer into a list of lonlat tuples per way"""
+    if len(offsets) == 1:
+        return []
+    return [list(map(tuple, c.tolist())) for c in np.split(coords, offsets[1:-1])]
+
+
+def convert_ways_points(df_way, node_index, geo_crs, distance_crs):
+    """
+    Convert Ways to Point Coordinates
+
+    Ways of at least three nodes are converted into polygons, the others
+    into the point of their first node; the conversion, the area and the
+    centroids are computed in bulk with the shapely 2 vectorized functions.
+    Ways without any resolved node are dropped.
+    """
+    coords, offsets = lonlat_lookup(df_way, node_index)
+    coords, offsets = drop_short_ways(df_way, coords, offsets, min_nodes=1)
+    n_refs = np.diff(offsets)
+    way_ids = np.repeat(np.arange(len(n_refs)), n_refs)
+
+    is_polygon = n_refs >= 3
+    way_polygon = np.empty(len(n_refs), dtype=object)
+
+    # polygons from the flat coordinates; indices of the rings are made contiguous
+    is_polygon_coord = is_polygon[way_ids]
+    ring_ids = (np.cumsum(is_polygon) - 1)[way_ids[is_polygon_coord]]
+    way_polygon[is_polygon] = shapely.polygons(
+        shapely.linearrings(coords[is_polygon_coord], indices=ring_ids)
     )
-    area_column = list(
-        map(
-            int,
-            round(
-                gpd.GeoSeries(way_polygon).set_crs(geo_crs).to_crs(distance_crs).area,
-                -1,
-            ),
-        )
+    way_polygon[~is_polygon] = shapely.points(coords[offsets[:-1][~is_polygon]])
+
+    area_column = (
+        gpd.GeoSeries(way_polygon, crs=geo_crs)
+        .to_crs(distance_crs)
+        .area.round(-1)
+        .astype(int)
+        .tolist()
     )
 
-    def find_center_point(p):
-        if p.geom_type == "Polygon":
-            center_point = p.centroid
-        else:
-            center_point = p
-        return list((center_point.x, center_point.y))
-
-    lonlat_column = list(map(find_center_point, way_polygon))
+    # the centroid of a point is the point itself
+    lonlat_column = shapely.get_coordinates(shapely.centroid(way_polygon)).tolist()
 
     df_way.insert(0, "Area", area_column)
     df_way.insert(0, "lonlat", lonlat_column)
 
 
-def convert_ways_lines(df_way, Data, geo_crs, distance_crs):
-    """Convert Ways to Line Coordinates"""
-    lonlat_list = lonlat_lookup(df_way, Data)
-    lonlat_column = lonlat_list
-    df_way.insert(0, "lonlat", lonlat_column)
+def convert_ways_lines(df_way, node_index, geo_crs, distance_crs):
+    """
+    Convert Ways to Line Coordinates
 
-    way_linestring = map(lambda lonlats: LineString(lonlats), lonlat_list)
-    length_column = (
-        gpd.GeoSeries(way_linestring).set_crs(geo_crs).to_crs(distance_crs).length
+    Ways with less than two resolved nodes cannot be represented
+    as a linestring and are dropped
+    """
+    coords, offsets = lonlat_lookup(df_way, node_index)
+    coords, offsets = drop_short_ways(df_way, coords, offsets, min_nodes=2)
+    df_way.insert(0, "lonlat", _split_lonlat(coords, offsets))
+
+    n_nodes = np.diff(offsets)
+    way_linestring = gpd.GeoSeries(
+        shapely.linestrings(
+            coords, indices=np.repeat(np.arange(len(n_nodes)), n_nodes)
+        ),
+        index=df_way.index,
+        crs=geo_crs,
     )
 
+    length_column = way_linestring.to_crs(distance_crs).length
+
     df_way.insert(0, "Length", length_column)
+    df_way["geometry"] = way_linestring
 
 
 def convert_pd_to_gdf_nodes(df_way, geo_crs):
@@ -385,14 +812,285 @@ def convert_pd_to_gdf_lines(df_way, geo_crs, simplified=False):
             lambda x: x.simplify(0.005, preserve_topology=False)
         )
 
-    gdf = gpd.GeoDataFrame(
-        df_way, geometry=[LineString(x) for x in df_way.lonlat], crs=OSM_CRS
-    ).to_crs(geo_crs)
+    # reuse the geometries built by convert_ways_lines when available
+    if "geometry" in df_way.columns:
+        gdf = gpd.GeoDataFrame(df_way, geometry="geometry", crs=OSM_CRS)
+    else:
+        gdf = gpd.GeoDataFrame(
+            df_way, geometry=[LineString(x) for x in df_way.lonlat], crs=OSM_CRS
+        )
+    gdf = gdf.to_crs(geo_crs)
     gdf.drop(columns=["lonlat"], inplace=True)
 
     return gdf
 
 
+def _feature_tag_columns(feature):
+    """Tag columns kept for the feature, e.g. ["tags.power", "tags.voltage"]"""
+    return [c for c in feature_columns[feature] if c.startswith("tags.")]
+
+
+def _elements_to_df(elements, feature, geom_column):
+    """
+    Convert a chunk of streamed elements of a feature into a DataFrame
+
+    Only the tags kept for the feature are stored, so that all the chunks
+    of a feature share the same columns
+    """
+    df = pd.json_normalize(elements)
+    return df.reindex(columns=["id", geom_column] + _feature_tag_columns(feature))
+
+
+def _write_stream_nodes(nodes, feature, country_code, folder, part_id):
+    """Write a chunk of the nodes of a feature as GeoParquet file"""
+    df_node = _elements_to_df(nodes, feature, "lonlat")
+    lonlat = np.array(df_node.pop("lonlat").tolist(), dtype=np.float64).reshape(-1, 2)
+
+    df_node["Type"] = "Node"
+    df_node["Country"] = country_code
+
+    gdf = gpd.GeoDataFrame(
+        df_node,
+        geometry=gpd.points_from_xy(lonlat[:, 0], lonlat[:, 1]),
+        crs=OSM_CRS,
+    )
+    gdf.to_parquet(os.path.join(folder, f"{feature}s_node_{part_id:05d}.parquet"))
+
+
+def _write_stream_ways(
+    ways, feature, country_code, node_index, distance_crs, folder, part_id
+):
+    """Convert a chunk of the ways of a feature and write it as GeoParquet file"""
+    df_way = _elements_to_df(ways, feature, "refs")
+
+    if feature_category[feature] == "way":
+        convert_ways_lines(df_way, node_index, OSM_CRS, distance_crs)
+        geometry = df_way.pop("geometry")
+    else:
+        convert_ways_points(df_way, node_index, OSM_CRS, distance_crs)
+        # reshape to keep two columns when all the ways are dropped
+        lonlat = np.array(df_way["lonlat"].tolist(), dtype=np.float64).reshape(-1, 2)
+        geometry = gpd.points_from_xy(lonlat[:, 0], lonlat[:, 1])
+
+    df_way = df_way.drop(columns=["lonlat", "refs"])
+    df_way["Type"] = "Way"
+    df_way["Country"] = country_code
+
+    gdf = gpd.GeoDataFrame(df_way, geometry=geometry, crs=OSM_CRS)
+    gdf.to_parquet(os.path.join(folder, f"{feature}s_way_{part_id:05d}.parquet"))
+
+
+def stream_filter_pbf(
+    country_code,
+    feature_list,
+    distance_crs,
+    update=False,
+    verify=False,
+    chunk_size=100000,
+):
+    """
+    Extract the power features of a country by streaming the pbf file.
+
+    Alternative to download_and_filter that does not build the Data and
+    Elements dictionaries of esy.osmfilter: the power-tagged elements are
+    read from the pbf in chunks of chunk_size elements and written
+    to per-country, per-feature GeoParquet files, so that the peak memory
+    is bounded by the chunk size rather than by the country size.
+
+    The pbf file is read twice:
+
+    1. power nodes are written directly, power ways are spilled to
+       temporary chunks and the ids of their nodes are collected
+    2. the coordinates of the nodes referenced by the power ways
+       are collected, then the spilled ways are converted chunk by chunk
+
+    As in the esy.osmfilter engine, relations are not converted.
+
+    Parameters
+    ----------
+    country_code : str
+        Geofabrik code of the country
+    feature_list : list
+        Values of the power tag to extract, e.g. ["substation", "line"]
+    distance_crs : str
+        Metric crs used to calculate length and area of the ways
+    update : bool
+        When true, the pbf file is downloaded and streamed again
+    verify : bool
+        When true, the md5 of the pbf file is checked and the file streamed again
+    chunk_size : int
+        Number of elements per chunk
+
+    Returns
+    -------
+    parquet_path : str
+        Folder of the GeoParquet files of the country
+    """
+    import esy.osm.pbf
+
+    PBF_inputfile = download_pbf(country_code, update, verify)
+
+    continent, country_name = getContinentCountry(country_code)
+
+    parquet_path = os.path.join(
+        os.getcwd(), "data", "osm", continent, "parquet", country_code
+    )
+
+    if os.path.exists(parquet_path) and update is False and verify is False:
+        _logger.info(f"Loading streamed features for {country_name}")
+        return parquet_path
+
+    _logger.info(f"Streaming power features for {country_name}")
+
+    # write into a temporary folder to avoid partial outputs
+    tmp_path = parquet_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    nodes = {feature: [] for feature in feature_list}
+    n_node_parts = {feature: 0 for feature in feature_list}
+    ways = []
+    way_chunk_files = []
+    way_refs = []
+
+    def flush_nodes(feature):
+        _write_stream_nodes(
+            nodes[feature],
+            feature,
+            country_code,
+            tmp_path,
+            n_node_parts[feature],
+        )
+        n_node_parts[feature] += 1
+        nodes[feature] = []
+
+    def flush_ways():
+        way_chunk_file = os.path.join(tmp_path, f"ways_{len(way_chunk_files):05d}.pkl")
+        with open(way_chunk_file, "wb") as f:
+            pickle.dump(ways, f, protocol=pickle.HIGHEST_PROTOCOL)
+        way_chunk_files.append(way_chunk_file)
+        way_refs.append(
+            np.unique(
+                np.fromiter(
+                    itertools.chain.from_iterable(w["refs"] for w in ways),
+                    dtype=np.int64,
+                )
+            )
+        )
+        ways.clear()
+
+    # 1st pass: stream power nodes and spill power ways
+    with esy.osm.pbf.File(PBF_inputfile) as osm:
+        for entry in osm:
+            feature = entry.tags.get("power")
+            if feature not in nodes:
+                continue
+
+            if isinstance(entry, esy.osm.pbf.Node):
+                nodes[feature].append(
+                    {"id": entry.id, "tags": entry.tags, "lonlat": entry.lonlat}
+                )
+                if len(nodes[feature]) >= chunk_size:
+                    flush_nodes(feature)
+            elif isinstance(entry, esy.osm.pbf.Way):
+                ways.append({"id": entry.id, "tags": entry.tags, "refs": entry.refs})
+                if len(ways) >= chunk_size:
+                    flush_ways()
+
+    for feature in feature_list:
+        if nodes[feature]:
+            flush_nodes(feature)
+    if ways:
+        flush_ways()
+
+    # 2nd pass: collect the coordinates of the nodes referenced by the ways
+    needed_refs = np.unique(np.concatenate(way_refs)) if way_refs else np.array([])
+    node_ids, node_lonlat = [np.empty(0, dtype=np.int64)], [np.empty((0, 2))]
+    ids_chunk, lonlat_chunk = [], []
+
+    def flush_refs():
+        ids = np.array(ids_chunk, dtype=np.int64)
+        is_needed = np.isin(ids, needed_refs, assume_unique=True)
+        node_ids.append(ids[is_needed])
+        node_lonlat.append(np.array(lonlat_chunk, dtype=np.float64)[is_needed])
+        ids_chunk.clear()
+        lonlat_chunk.clear()
+
+    if len(needed_refs) > 0:
+        with esy.osm.pbf.File(PBF_inputfile) as osm:
+            for entry in osm:
+                # nodes precede ways and relations in pbf files
+                if not isinstance(entry, esy.osm.pbf.Node):
+                    break
+                ids_chunk.append(entry.id)
+                lonlat_chunk.append(entry.lonlat)
+                if len(ids_chunk) >= chunk_size:
+                    flush_refs()
+        if ids_chunk:
+            flush_refs()
+
+    node_ids = np.concatenate(node_ids)
+    node_lonlat = np.concatenate(node_lonlat).reshape(-1, 2)
+    sort_ids = np.argsort(node_ids, kind="stable")
+    node_index = node_ids[sort_ids], node_lonlat[sort_ids]
+
+    # convert the spilled ways chunk by chunk
+    for part_id, way_chunk_file in enumerate(way_chunk_files):
+        with open(way_chunk_file, "rb") as f:
+            ways_chunk = pickle.load(f)
+        os.remove(way_chunk_file)
+
+        for feature in feature_list:
+            ways_feature = [w for w in ways_chunk if w["tags"]["power"] == feature]
+            if ways_feature:
+                _write_stream_ways(
+                    ways_feature,
+                    feature,
+                    country_code,
+                    node_index,
+                    distance_crs,
+                    tmp_path,
+                    part_id,
+                )
+
+    shutil.rmtree(parquet_path, ignore_errors=True)
+    os.rename(tmp_path, parquet_path)
+
+    return parquet_path
+
+
+def get_stream_part_files(parquet_path, feature):
+    """List the GeoParquet files of a feature written by stream_filter_pbf"""
+    return [
+        os.path.join(parquet_path, f)
+        for f in sorted(os.listdir(parquet_path))
+        if f.startswith(f"{feature}s_") and f.endswith(".parquet")
+    ]
+
+
+def read_stream_part(part_file, feature):
+    """
+    Read a GeoParquet file of a feature written by stream_filter_pbf
+
+    The returned DataFrame has the same structure as the one obtained
+    by the esy.osmfilter engine, namely the lonlat column of the points or
+    of the lines and, for the lines, the geometry column
+    """
+    gdf = gpd.read_parquet(part_file)
+
+    if feature_category[feature] == "way":
+        coords, way_ids = shapely.get_coordinates(
+            gdf.geometry.values, return_index=True
+        )
+        offsets = np.zeros(len(gdf) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(way_ids, minlength=len(gdf)), out=offsets[1:])
+        gdf["lonlat"] = _split_lonlat(coords, offsets)
+        return pd.DataFrame(gdf)
+
+    gdf["lonlat"] = np.column_stack([gdf.geometry.x, gdf.geometry.y]).tolist()
+    return pd.DataFrame(gdf.drop(columns="geometry"))
+
+
 def convert_iso_to_geofk(iso_code, iso_coding=True, convert_dict=iso_to_geofk_dict):
     """
     Function to convert the iso code name of a country into the corresponding geofabrik
@@ -421,8 +1119,49 @@ def convert_iso_to_geofk(iso_code, iso_coding=True, convert_dict=iso_to_geofk_di
         return iso_code
 
 
-def output_csv_geojson(output_files, df_all_feature, columns_feature, feature, geo_crs):
-    """Function to save the feature as csv and geojson"""
+def select_feature_rows_columns(df_feature, columns_feature, feature):
+    """
+    Remove the non-line elements of the line features and keep only
+    the columns_feature columns, plus the geometry column if any
+    """
+    # remove non-line elements
+    if feature_category[feature] == "way":
+        # check geometry with multiple points: at least two needed to draw a line
+        is_linestring = df_feature["lonlat"].apply(
+            lambda x: (len(x) >= 2) and (type(x[0]) == tuple)
+        )
+        df_feature = df_feature[is_linestring]
+
+    # the geometry column, if any, is kept for the GeoJSON only
+    df_feature = df_feature[
+        df_feature.columns.intersection(set(columns_feature) | {"geometry"})
+    ]
+    return df_feature.reset_index(drop=True)
+
+
+def convert_pd_to_gdf_feature(df_feature, feature, geo_crs):
+    """Convert the Pandas Dataframe of a feature to GeoPandas Dataframe"""
+    if feature_category[feature] == "way":
+        return convert_pd_to_gdf_lines(df_feature, geo_crs)
+    else:
+        return convert_pd_to_gdf_nodes(df_feature, geo_crs)
+
+
+def output_csv_geojson(
+    output_files,
+    df_all_feature,
+    columns_feature,
+    feature,
+    geo_crs,
+    raw_format="parquet",
+    export_geojson=False,
+):
+    """
+    Function to save the feature as csv and raw geodata
+
+    The geodata are saved in raw_format next to the geojson file expected
+    by snakemake; see save_raw_geodata
+    """
 
     # get path from snakemake; expected geojson
     path_file_geojson = output_files[feature + "s"]
@@ -439,51 +1178,153 @@ def output_csv_geojson(output_files, df_all_feature, columns_feature, feature, g
     if not "lonlat" in df_all_feature.columns:
         if not "geometry" in df_all_feature.columns:
             _logger.warning(f"Store empty Dataframe for {feature} as geometry missed.")
-            gdf_feature = []
+            gdf_feature = gpd.GeoDataFrame(geometry=[])
             # create empty file to avoid issues with snakemake
-            with open(path_file_geojson, "w") as fp:
-                pass
+            save_raw_geodata(gdf_feature, path_file_geojson, raw_format, export_geojson)
             return None
         # TODO: is it possible to have "geometry" without "lonlat"?
         else:
             # TODO: is it possible that nodes dataframe will also be empty?
             gdf_feature = convert_pd_to_gdf_lines(df_all_feature, geo_crs)
-            gdf_feature.to_file(path_file_geojson, driver="GeoJSON")  # Generate GeoJson
+            save_raw_geodata(gdf_feature, path_file_geojson, raw_format, export_geojson)
             return None
 
-    # remove non-line elements
-    if feature_category[feature] == "way":
-        # check geometry with multiple points: at least two needed to draw a line
-        is_linestring = df_all_feature["lonlat"].apply(
-            lambda x: (len(x) >= 2) and (type(x[0]) == tuple)
-        )
-        df_all_feature = df_all_feature[is_linestring]
-
-    df_all_feature = df_all_feature[
-        df_all_feature.columns.intersection(set(columns_feature))
-    ]
-    df_all_feature.reset_index(drop=True, inplace=True)
+    df_all_feature = select_feature_rows_columns(
+        df_all_feature, columns_feature, feature
+    )
 
     # Generate Files
-    to_csv_nafix(df_all_feature, path_file_csv)  # Generate CSV
+    to_csv_nafix(
+        df_all_feature.drop(columns="geometry", errors="ignore"), path_file_csv
+    )  # Generate CSV
 
     if df_all_feature.empty:
         _logger.warning(f"Store empty Dataframe for {feature}.")
-        gdf_feature = []
+        gdf_feature = gpd.GeoDataFrame(geometry=[])
 
         # create empty file to avoid issues with snakemake
-        with open(path_file_geojson, "w") as fp:
-            pass
+        save_raw_geodata(gdf_feature, path_file_geojson, raw_format, export_geojson)
+
+        return None
+
+    gdf_feature = convert_pd_to_gdf_feature(df_all_feature, feature, geo_crs)
+
+    _logger.info(f"Writing {raw_format} file")
+    save_raw_geodata(gdf_feature, path_file_geojson, raw_format, export_geojson)
+
+
+def output_stream_feature(
+    output_files,
+    parquet_paths,
+    columns_feature,
+    feature,
+    geo_crs,
+    raw_format="parquet",
+    export_geojson=False,
+):
+    """
+    Function to save the feature streamed by stream_filter_pbf as csv and raw geodata
 
+    Each GeoParquet file of the countries, of at most chunk_size elements,
+    is converted and appended to the csv and the parquet outputs as it is read,
+    so that the memory is bounded by the chunk size rather than by the size
+    of all the countries. The GeoJSON and FlatGeobuf outputs are written at once
+    by output_csv_geojson instead.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    part_files = [
+        f for path in parquet_paths for f in get_stream_part_files(path, feature)
+    ]
+
+    if raw_format != "parquet" or export_geojson:
+        df_all_feature = (
+            pd.concat([read_stream_part(f, feature) for f in part_files])
+            if part_files
+            else pd.DataFrame()
+        )
+        output_csv_geojson(
+            output_files,
+            df_all_feature,
+            columns_feature,
+            feature,
+            geo_crs=geo_crs,
+            raw_format=raw_format,
+            export_geojson=export_geojson,
+        )
         return None
 
+    path_file_geojson = output_files[feature + "s"]
+    path_file_csv = path_file_geojson.replace(".geojson", ".csv")
+    path_file_parquet = get_raw_path(path_file_geojson, raw_format)
+    os.makedirs(os.path.dirname(path_file_geojson) or ".", exist_ok=True)
+
+    # remove the outdated outputs and create the placeholder geojson file
+    save_raw_geodata(gpd.GeoDataFrame(geometry=[]), path_file_geojson, raw_format)
+
+    # columns of the outputs, shared by all the parts, in the order of columns_feature
+    part_columns = set().union(
+        *[pq.read_schema(f).names for f in part_files], ["lonlat"]
+    )
+    columns = [c for c in columns_feature if c in part_columns]
     if feature_category[feature] == "way":
-        gdf_feature = convert_pd_to_gdf_lines(df_all_feature, geo_crs)
-    else:
-        gdf_feature = convert_pd_to_gdf_nodes(df_all_feature, geo_crs)
+        columns.append("geometry")
+
+    n_rows = 0
+    writer = None
+    for part_file in part_files:
+        df_part = select_feature_rows_columns(
+            read_stream_part(part_file, feature), columns_feature, feature
+        )
+        if df_part.empty:
+            continue
+
+        # the numeric columns may be missing in the nodes or the ways
+        df_part = df_part.reindex(columns=columns).astype(
+            {c: "float64" for c in ["Area", "Length"] if c in columns}
+        )
+        df_part.index += n_rows
+
+        to_csv_nafix(
+            df_part.drop(columns="geometry", errors="ignore"),
+            path_file_csv,
+            mode="w" if n_rows == 0 else "a",
+            header=n_rows == 0,
+        )
+
+        buffer = io.BytesIO()
+        convert_pd_to_gdf_feature(df_part, feature, geo_crs).to_parquet(
+            buffer, index=False
+        )
+        table = pq.read_table(buffer)
+
+        if writer is None:
+            # the tags are strings, even when all missing in the first part;
+            # the bbox of the geo metadata of the first part does not hold
+            # for the other parts
+            geo = json.loads(table.schema.metadata[b"geo"])
+            for geo_column in geo["columns"].values():
+                geo_column.pop("bbox", None)
+            schema = pa.schema(
+                [
+                    f.with_type(pa.string())
+                    if f.name.startswith("tags.") or pa.types.is_null(f.type)
+                    else f
+                    for f in table.schema
+                ],
+                metadata={**table.schema.metadata, b"geo": json.dumps(geo)},
+            )
+            writer = pq.ParquetWriter(path_file_parquet, schema)
 
-    _logger.info("Writing GeoJSON file")
-    gdf_feature.to_file(path_file_geojson, driver="GeoJSON")  # Generate GeoJson
+        writer.write_table(table.cast(schema))
+        n_rows += len(df_part)
+
+    if writer is not None:
+        writer.close()
+    else:
+        _logger.warning(f"Store empty Dataframe for {feature}.")
+        to_csv_nafix(pd.DataFrame(), path_file_csv)
 
 
 # Auxiliary function to initialize the parallel data download
@@ -492,9 +1333,10 @@ def _init_process_pop(update_, verify_):
     update, verify = update_, verify_
 
 
-# Auxiliary function to download the data
+# Auxiliary function to download and verify the data
 def _process_func_pop(c_code):
-    download_pbf(c_code, update, verify, logging=False)
+    PBF_inputfile = download_pbf(c_code, update, verify, logging=False)
+    return PBF_inputfile, PBF_inputfile in verified_pbf
 
 
 def parallel_download_pbf(country_list, nprocesses, update=False, verify=False):
@@ -510,9 +1352,22 @@ def parallel_download_pbf(country_list, nprocesses, update=False, verify=False):
     update : bool
         If true, existing pbf files are updated. Default: False
     verify : bool
-        If true, checks the md5 of the file. Default: False
+        If true, checks the md5 of the file in the worker processes. Default: False
     """
 
+    # download the missing files concurrently, with at most nprocesses
+    # concurrent downloads from geofabrik; the pool verifies the files
+    pbf_paths = [get_pbf_paths(c_code) for c_code in country_list]
+    download_files(
+        [
+            (geofabrik_url, PBF_inputfile)
+            for geofabrik_url, PBF_inputfile in pbf_paths
+            if not os.path.exists(PBF_inputfile)
+        ],
+        max_per_host=nprocesses,
+        verify=False,
+    )
+
     # argument for the parallel processing
     kwargs = {
         "initializer": _init_process_pop,
@@ -522,14 +1377,268 @@ def parallel_download_pbf(country_list, nprocesses, update=False, verify=False):
 
     # execute the parallel download with tqdm progressbar
     with mp.get_context("spawn").Pool(**kwargs) as pool:
-        for _ in tqdm(
-            pool.imap(_process_func_pop, country_list),
+        for PBF_inputfile, verified in tqdm(
+            pool.imap_unordered(_process_func_pop, country_list),
             ascii=False,
             unit=" countries",
             total=len(country_list),
             desc="Download pbf ",
         ):
-            pass
+            # files verified by the workers are not verified again
+            if verified and PBF_inputfile not in verified_pbf:
+                verified_pbf.append(PBF_inputfile)
+
+
+def process_feature_country(
+    feature,
+    country_code,
+    feature_list,
+    distance_crs,
+    update=False,
+    verify=False,
+    multiprocess=True,
+):
+    """
+    Filter the feature of a country and convert it into a DataFrame
+
+    Parameters
+    ----------
+    feature : str
+        Feature to process, e.g. "substation"
+    country_code : str
+        Geofabrik code of the country
+    feature_list : list
+        Features used to pre-filter the pbf file of the country
+    distance_crs : str
+        Metric crs used to calculate length and area of the ways
+    update : bool
+        When true, the pbf file is downloaded and pre-filtered again
+    verify : bool
+        When true, the md5 of the pbf file is checked
+    multiprocess : bool
+        When true, the pre-filtering of the pbf file uses a process pool
+
+    Returns
+    -------
+    df_feature : DataFrame
+        Nodes and ways of the feature for the country
+    """
+    feature_data = download_and_filter(
+        feature,
+        country_code,
+        update,
+        verify,
+        feature_list=feature_list,
+        multiprocess=multiprocess,
+    )
+
+    return convert_feature_data(feature, country_code, feature_data, distance_crs)
+
+
+def process_country(
+    country_code,
+    feature_list,
+    distance_crs,
+    update=False,
+    verify=False,
+    multiprocess=True,
+):
+    """
+    Filter all the features of a country in a single pass and convert them into DataFrames
+
+    Returns
+    -------
+    df_features : dict
+        Dictionary of the DataFrame of each feature for the country
+    """
+    feature_data = download_and_filter_all(
+        country_code, feature_list, update, verify, multiprocess=multiprocess
+    )
+
+    # the node index is shared by the features of the country only
+    node_index = build_node_index(feature_data[0])
+
+    return {
+        feature: convert_feature_data(
+            feature, country_code, feature_data, distance_crs, node_index
+        )
+        for feature in feature_list
+    }
+
+
+def convert_feature_data(
+    feature, country_code, feature_data, distance_crs, node_index=None
+):
+    """
+    Convert the filtered Data, Elements of a feature into a DataFrame
+
+    The node index of the country is built from Data when node_index is None
+    """
+    df_node, df_way, Data = convert_filtered_data_to_dfs(
+        country_code, feature_data, feature
+    )
+
+    if node_index is None:
+        node_index = build_node_index(Data)
+
+    if feature_category[feature] == "way":
+        convert_ways_lines(
+            df_way, node_index, OSM_CRS, distance_crs
+        ) if not df_way.empty else _logger.warning(
+            f"Empty Way Dataframe for {feature} in {country_code}"
+        )
+        if not df_node.empty:
+            _logger.warning(f"Node dataframe not empty for {feature} in {country_code}")
+
+    if feature_category[feature] == "node":
+        convert_ways_points(
+            df_way, node_index, OSM_CRS, distance_crs
+        ) if not df_way.empty else None
+
+    # Add Type Column
+    df_node["Type"] = "Node"
+    df_way["Type"] = "Way"
+
+    # Concat. Nodes and Ways
+    df_feature = pd.concat([df_node, df_way], axis=0)
+
+    # Add Country Column with GeoFabrik coding
+    df_feature["Country"] = country_code
+
+    return df_feature
+
+
+# Auxiliary function to initialize the parallel data processing
+def _init_process_data(feature_list_, distance_crs_):
+    global feature_list, distance_crs
+    feature_list, distance_crs = feature_list_, distance_crs_
+
+
+# Auxiliary function to process all the features of a country
+def _process_func_country(args):
+    country_code, update, verify = args
+    # workers of the pool cannot start the process pool of run_filter
+    return process_country(
+        country_code,
+        feature_list,
+        distance_crs,
+        update,
+        verify,
+        multiprocess=False,
+    )
+
+
+# Auxiliary function to process the data of a (feature, country) pair
+def _process_func_data(args):
+    feature, country_code, update, verify = args
+    # workers of the pool cannot start the process pool of run_filter
+    df_feature = process_feature_country(
+        feature,
+        country_code,
+        feature_list,
+        distance_crs,
+        update,
+        verify,
+        multiprocess=False,
+    )
+    return feature, df_feature
+
+
+def parallel_process_data(
+    feature_list,
+    country_codes,
+    distance_crs,
+    nprocesses,
+    update=False,
+    verify=False,
+    single_pass=False,
+    changed_countries=(),
+):
+    """
+    Function to filter and convert the (country, feature) pairs in parallel
+
+    The pairs are processed in two stages: first, a single feature per country,
+    so that the pbf file of every country is pre-filtered only once;
+    then, all the remaining pairs, which load the pre-filtered data.
+    When single_pass is true, the countries are processed in parallel instead,
+    each filtering all the features in a single pass.
+
+    Parameters
+    ----------
+    feature_list : list
+        Features to process, e.g. ["substation", "line"]
+    country_codes : list
+        List of geofabrik country codes to process
+    distance_crs : str
+        Metric crs used to calculate length and area of the ways
+    nprocesses : int
+        Number of parallel processes
+    update : bool
+        If true, existing pbf files are updated. Default: False
+    verify : bool
+        If true, checks the md5 of the file. Default: False
+    single_pass : bool
+        If true, all the features of a country are filtered in a single pass
+    changed_countries : list
+        Countries updated by update_pbf, which are pre-filtered again
+
+    Returns
+    -------
+    df_features : dict
+        Dictionary of the list of DataFrames per country for each feature
+    """
+    df_features = {feature: [] for feature in feature_list}
+
+    # argument for the parallel processing
+    kwargs = {
+        "initializer": _init_process_data,
+        "initargs": (feature_list, distance_crs),
+        "processes": nprocesses,
+    }
+
+    if single_pass:
+        countries = [
+            (c_code, update or c_code in changed_countries, verify)
+            for c_code in country_codes
+        ]
+
+        # execute the parallel processing with tqdm progressbar
+        with mp.get_context("spawn").Pool(**kwargs) as pool:
+            for df_country in tqdm(
+                pool.imap(_process_func_country, countries),
+                ascii=False,
+                unit=" countries",
+                total=len(countries),
+                desc="Process osm data ",
+            ):
+                for feature in feature_list:
+                    df_features[feature].append(df_country[feature])
+
+        return df_features
+
+    first_stage = [
+        (feature_list[0], c_code, update or c_code in changed_countries, verify)
+        for c_code in country_codes
+    ]
+    second_stage = [
+        (feature, c_code, False, False)
+        for feature in feature_list[1:]
+        for c_code in country_codes
+    ]
+
+    # execute the parallel processing with tqdm progressbar
+    with mp.get_context("spawn").Pool(**kwargs) as pool:
+        for pairs in [first_stage, second_stage]:
+            for feature, df_feature in tqdm(
+                pool.imap(_process_func_data, pairs),
+                ascii=False,
+                unit=" pairs",
+                total=len(pairs),
+                desc="Process osm data ",
+            ):
+                df_features[feature].append(df_feature)
+
+    return df_features
 
 
 def process_data(
@@ -542,9 +1651,38 @@ def process_data(
     update=False,
     verify=False,
     nprocesses=1,
+    engine="esy",
+    chunk_size=100000,
+    single_pass=False,
+    incremental=False,
+    diff_source=GEOFABRIK_URL,
+    raw_format="parquet",
+    export_geojson=False,
 ):
     """
     Download the features in feature_list for each country of the country_list
+
+    Parameters
+    ----------
+    engine : str
+        Engine used to extract the features from the pbf files:
+        "esy" uses esy.osmfilter, "stream" uses stream_filter_pbf
+    chunk_size : int
+        Number of elements per chunk of the "stream" engine
+    single_pass : bool
+        When true, the "esy" engine filters all the features
+        of a country in a single pass
+    incremental : bool
+        When true, the existing pbf files are updated with the replication
+        diffs of diff_source and only the countries whose power features
+        changed are filtered again. The updated pbf files no longer match
+        the md5 of Geofabrik, so they are not verified even if verify is true
+    diff_source : str
+        Url of the replication server or local directory with the same layout
+    raw_format : str
+        Format of the raw geodata: "parquet", "flatgeobuf" or "geojson"
+    export_geojson : bool
+        When true, the raw geodata are exported also as GeoJSON
     """
 
     # parallel download of data if parallel download is enabled
@@ -554,51 +1692,121 @@ def process_data(
         )
         parallel_download_pbf(country_list, nprocesses, update, verify)
 
-    # loop the request for each feature
-
-    for feature in feature_list:  # feature dataframe
+    country_codes = [
+        convert_iso_to_geofk(country_code_isogeofk, iso_coding)
+        for country_code_isogeofk in country_list
+    ]
 
-        df_list = []
+    if incremental and verify:
+        _logger.warning(
+            "The md5 of the pbf files updated with the replication diffs is not verified"
+        )
 
-        for country_code_isogeofk in country_list:
+    # countries whose pbf files have been updated with changes of the power features
+    changed_countries = []
+    if incremental:
+        changed_countries = [
+            c_code
+            for c_code in country_codes
+            if update_pbf(c_code, feature_list, diff_source)
+        ]
+        _logger.info(f"Countries to filter again: {changed_countries}")
+
+    if engine == "stream":
+        parquet_paths = [
+            stream_filter_pbf(
+                c_code,
+                feature_list,
+                distance_crs,
+                update=update or c_code in changed_countries,
+                verify=verify,
+                chunk_size=chunk_size,
+            )
+            for c_code in country_codes
+        ]
+
+        for feature in feature_list:
+            output_stream_feature(
+                output_files,
+                parquet_paths,
+                feature_columns[feature],
+                feature,
+                geo_crs=geo_crs,
+                raw_format=raw_format,
+                export_geojson=export_geojson,
+            )
 
-            country_code = convert_iso_to_geofk(country_code_isogeofk, iso_coding)
+        return None
 
-            feature_data = download_and_filter(feature, country_code, update, verify)
+    elif engine != "esy":
+        _logger.error(f"Unknown engine {engine}: esy.osmfilter is used")
 
-            df_node, df_way, Data = convert_filtered_data_to_dfs(
-                country_code, feature_data, feature
+    if nprocesses > 1:
+        df_features = parallel_process_data(
+            feature_list,
+            country_codes,
+            distance_crs,
+            nprocesses,
+            update,
+            verify,
+            single_pass=single_pass,
+            changed_countries=changed_countries,
+        )
+    elif single_pass:
+        df_countries = [
+            process_country(
+                c_code,
+                feature_list,
+                distance_crs,
+                update or c_code in changed_countries,
+                verify,
             )
-
-            if feature_category[feature] == "way":
-                convert_ways_lines(
-                    df_way, Data, OSM_CRS, distance_crs
-                ) if not df_way.empty else _logger.warning(
-                    f"Empty Way Dataframe for {feature} in {country_code}"
-                )
-                if not df_node.empty:
-                    _logger.warning(
-                        f"Node dataframe not empty for {feature} in {country_code}"
+            for c_code in country_codes
+        ]
+        df_features = {
+            feature: [df_country[feature] for df_country in df_countries]
+            for feature in feature_list
+        }
+    else:
+        # loop the request for each feature, writing each feature before the next one
+        for feature in feature_list:  # feature dataframe
+
+            df_all_feature = pd.concat(
+                [
+                    process_feature_country(
+                        feature,
+                        country_code,
+                        feature_list,
+                        distance_crs,
+                        # the changed countries are pre-filtered again with the first feature
+                        update
+                        or (
+                            country_code in changed_countries
+                            and feature == feature_list[0]
+                        ),
+                        verify,
                     )
+                    for country_code in country_codes
+                ],
+                ignore_index=True,
+            )
 
-            if feature_category[feature] == "node":
-                convert_ways_points(
-                    df_way, Data, OSM_CRS, distance_crs
-                ) if not df_way.empty else None
-
-            # Add Type Column
-            df_node["Type"] = "Node"
-            df_way["Type"] = "Way"
-
-            # Concat. Nodes and Ways
-            df_feature = pd.concat([df_node, df_way], axis=0)
+            output_csv_geojson(
+                output_files,
+                df_all_feature,
+                feature_columns[feature],
+                feature,
+                geo_crs=geo_crs,
+                raw_format=raw_format,
+                export_geojson=export_geojson,
+            )
 
-            # Add Country Column with GeoFabrik coding
-            df_feature["Country"] = country_code
+        return None
 
-            df_list.append(df_feature)
+    for feature in feature_list:  # feature dataframe
 
-        df_all_feature = pd.concat(df_list, ignore_index=True)
+        # pop the DataFrames of the feature so that they are released once written
+        df_all_feature = pd.concat(df_features.pop(feature), ignore_index=True)
 
         output_csv_geojson(
             output_files,
@@ -606,6 +1814,8 @@ def process_data(
             feature_columns[feature],
             feature,
             geo_crs=geo_crs,
+            raw_format=raw_format,
+            export_geojson=export_geojson,
         )
 
 
@@ -722,8 +1932,7 @@ if __name__ == "__main__":
     # Required to set path to pypsa-africa
     sets_path_to_root("pypsa-africa")
 
-    # ["substation", "generator", "line", "cable", "tower"]
-    feature_list = ["substation", "generator", "line", "cable"]
+    feature_list = DEFAULT_FEATURE_LIST
 
     # get list of countries into geofabrik convention; expected iso norm in input
     country_list = country_list_to_geofk(snakemake.config["countries"])
@@ -736,6 +1945,16 @@ if __name__ == "__main__":
     geo_crs = snakemake.config["crs"]["geo_crs"]
     distance_crs = snakemake.config["crs"]["distance_crs"]
 
+    # options of the extraction engine
+    download_options = snakemake.config.get("download_osm_data_options", {})
+    engine = download_options.get("engine", "esy")
+    chunk_size = download_options.get("chunk_size", 100000)
+    single_pass = download_options.get("single_pass", False)
+    incremental = download_options.get("incremental_update", False)
+    diff_source = download_options.get("diff_source", GEOFABRIK_URL)
+    raw_format = download_options.get("raw_format", "parquet")
+    export_geojson = download_options.get("export_geojson", False)
+
     # Set update # Verify = True checks local md5s and pre-filters data again
     process_data(
         feature_list,
@@ -747,4 +1966,11 @@ if __name__ == "__main__":
         update=False,
         verify=False,
         nprocesses=nprocesses,
+        engine=engine,
+        chunk_size=chunk_size,
+        single_pass=single_pass,
+        incremental=incremental,
+        diff_source=diff_source,
+        raw_format=raw_format,
+        export_geojson=export_geojson,
     )
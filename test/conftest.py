@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Fixtures of synthetic raw OSM data for the benchmarks of the OSM cleaning stage.
+
+The raw lines, cables, substations and generators mimic the data written by
+download_osm_data, including semicolon separated voltage, cables and circuits
+tags and invalid values, with random geometries inside a test shape covering
+two countries. No download is required.
+
+Run the benchmarks from the root of the repository, e.g.::
+
+    pytest test --osm-rows 10000,100000
+
+By default, only small sizes are benchmarked; larger sizes, such as 1000000
+rows, are opt-in through --osm-rows.
+"""
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "scripts"))
+
+from _helpers import save_raw_geodata  # noqa: E402
+
+# test shape of the synthetic data and its two countries
+TEST_BOUNDS = (0.0, 0.0, 10.0, 10.0)
+TEST_COUNTRIES = {"NG": box(0.0, 0.0, 5.0, 10.0), "BJ": box(5.0, 0.0, 10.0, 10.0)}
+
+# tag values sampled for the synthetic data, including invalid ones
+VOLTAGE_TAGS = ["220000", "110000;33000", "400000", "abc", None, "132000;66000;33000"]
+CABLES_TAGS = ["3", "6", "3;6", None, "single", "6;6;3"]
+CIRCUITS_TAGS = ["1", "2", None, "1;1", "1;2;1"]
+FREQUENCY_TAGS = ["50", "60", None, None, "0"]
+SUBSTATION_TAGS = ["transmission", "distribution"]
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--osm-rows",
+        default="1000,10000",
+        help="Comma separated numbers of raw OSM lines of the benchmarks",
+    )
+
+
+def pytest_generate_tests(metafunc):
+    if "n_rows" in metafunc.fixturenames:
+        n_rows = [int(n) for n in metafunc.config.getoption("osm_rows").split(",")]
+        metafunc.parametrize("n_rows", n_rows, scope="session")
+
+
+def random_points(rng, n, bounds=TEST_BOUNDS):
+    "Coordinates of n random points inside bounds"
+    xmin, ymin, xmax, ymax = bounds
+    return rng.uniform((xmin, ymin), (xmax, ymax), (n, 2))
+
+
+def generate_raw_lines(n, power="line", seed=0, bounds=TEST_BOUNDS):
+    """
+    Generate n raw OSM lines, or cables when power is "cable"
+
+    The lines are straight segments of random direction starting inside bounds
+    """
+    rng = np.random.default_rng(seed)
+    start = random_points(rng, n, bounds)
+    end = start + rng.normal(0.0, 0.3, (n, 2))
+
+    return gpd.GeoDataFrame(
+        {
+            # duplicated ids as for the ways split by download_osm_data
+            "id": rng.integers(0, n // 2 + 1, n),
+            "tags.power": power,
+            "tags.cables": rng.choice(CABLES_TAGS, n),
+            "tags.voltage": rng.choice(VOLTAGE_TAGS, n),
+            "tags.circuits": rng.choice(CIRCUITS_TAGS, n),
+            "tags.frequency": rng.choice(FREQUENCY_TAGS, n),
+            "Country": "NG",
+            "Length": rng.uniform(1e3, 1e4, n),
+        },
+        geometry=shapely.linestrings(np.stack([start, end], axis=1)),
+        crs="EPSG:4326",
+    )
+
+
+def generate_raw_substations(n, seed=0, bounds=TEST_BOUNDS):
+    "Generate n raw OSM substations with random locations inside bounds"
+    rng = np.random.default_rng(seed)
+    points = random_points(rng, n, bounds)
+
+    return gpd.GeoDataFrame(
+        {
+            "id": np.arange(n),
+            "tags.power": "substation",
+            "tags.substation": rng.choice(SUBSTATION_TAGS, n),
+            "tags.voltage": rng.choice(VOLTAGE_TAGS, n),
+            "Country": "NG",
+            "Area": rng.uniform(1e2, 1e4, n),
+        },
+        geometry=gpd.points_from_xy(points[:, 0], points[:, 1]),
+        crs="EPSG:4326",
+    )
+
+
+def generate_raw_generators(n, seed=0, bounds=TEST_BOUNDS):
+    "Generate n raw OSM generators with random locations inside bounds"
+    rng = np.random.default_rng(seed)
+    points = random_points(rng, n, bounds)
+
+    return gpd.GeoDataFrame(
+        {
+            "id": np.arange(n),
+            "tags.power": "generator",
+            "tags.generator:source": rng.choice(["solar", "wind", "hydro"], n),
+            "tags.generator:output:electricity": [
+                f"{p} MW" for p in rng.integers(1, 500, n)
+            ],
+            "tags.name": [None] * n,
+            "Country": "NG",
+            "Area": rng.uniform(1e2, 1e4, n),
+        },
+        geometry=gpd.points_from_xy(points[:, 0], points[:, 1]),
+        crs="EPSG:4326",
+    )
+
+
+def generate_raw_osm_data(path, n_rows, seed=0, raw_format="parquet"):
+    """
+    Write the synthetic raw OSM data of n_rows lines in path, as download_osm_data
+
+    Cables, substations and generators are scaled with n_rows.
+    Returns the dictionary of the raw input files expected by clean_data.
+    """
+    raw_data = {
+        "lines": generate_raw_lines(n_rows, "line", seed),
+        "cables": generate_raw_lines(max(n_rows // 10, 1), "cable", seed + 1),
+        "substations": generate_raw_substations(max(n_rows // 2, 1), seed + 2),
+        "generators": generate_raw_generators(max(n_rows // 100, 1), seed + 3),
+    }
+
+    input_files = {}
+    for name, df in raw_data.items():
+        input_files[name] = os.path.join(path, f"all_raw_{name}.geojson")
+        save_raw_geodata(df, input_files[name], raw_format)
+
+    return input_files
+
+
+@pytest.fixture(scope="session")
+def test_shape():
+    "Shape of the region containing the synthetic data"
+    return box(*TEST_BOUNDS).buffer(1.0)
+
+
+@pytest.fixture(scope="session")
+def country_shapes():
+    "Shapes of the two countries of the synthetic data"
+    return gpd.GeoSeries(
+        list(TEST_COUNTRIES.values()),
+        index=list(TEST_COUNTRIES.keys()),
+        crs="EPSG:4326",
+    ).rename_axis("name")
+
+
+@pytest.fixture(scope="session")
+def raw_osm_files(tmp_path_factory, n_rows):
+    "Raw input files of n_rows synthetic lines for clean_data"
+    path = tmp_path_factory.mktemp(f"raw_osm_{n_rows}")
+    return generate_raw_osm_data(str(path), n_rows)
+
+
+@pytest.fixture(scope="session")
+def raw_lines(n_rows):
+    "Synthetic raw lines of n_rows rows"
+    return generate_raw_lines(n_rows)
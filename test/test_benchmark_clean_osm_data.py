@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Benchmarks of the OSM cleaning stage on synthetic raw OSM data; see conftest.py.
+"""
+import os
+
+import geopandas as gpd
+import pytest
+from _helpers import CountryShapes
+from clean_osm_data import (
+    clean_data,
+    finalize_lines_type,
+    integrate_lines_df,
+    prepare_lines_df,
+    set_countryname_by_shape,
+    split_cells_multiple,
+)
+
+GEO_CRS = "EPSG:4326"
+DISTANCE_CRS = "EPSG:3857"
+
+# rounds of the benchmarks of the single functions
+ROUNDS = 3
+
+
+@pytest.fixture(scope="session")
+def prepared_lines(raw_lines):
+    "Synthetic lines prepared as in clean_lines"
+    return finalize_lines_type(prepare_lines_df(raw_lines.copy()))
+
+
+@pytest.fixture(scope="session")
+def country_lookup(country_shapes):
+    "Prepared and STRtree-indexed country shapes"
+    return CountryShapes(country_shapes)
+
+
+def copy_arg(df):
+    "Setup of benchmark.pedantic copying the input of the benchmarked function"
+    return lambda: ((df.copy(),), {})
+
+
+def test_prepare_lines_df(benchmark, raw_lines):
+    df = benchmark.pedantic(prepare_lines_df, setup=copy_arg(raw_lines), rounds=ROUNDS)
+    assert len(df) == len(raw_lines)
+
+
+def test_split_cells_multiple(benchmark, prepared_lines):
+    df = benchmark.pedantic(
+        split_cells_multiple, setup=copy_arg(prepared_lines), rounds=ROUNDS
+    )
+    assert len(df) >= len(prepared_lines)
+
+
+def test_integrate_lines_df(benchmark, prepared_lines):
+    df = benchmark.pedantic(
+        lambda df: integrate_lines_df(df, DISTANCE_CRS),
+        setup=copy_arg(prepared_lines),
+        rounds=ROUNDS,
+    )
+    assert df["circuits"].dtype == int
+
+
+def test_set_countryname_by_shape(benchmark, prepared_lines, country_lookup):
+    df = benchmark.pedantic(
+        lambda df: set_countryname_by_shape(df, country_lookup),
+        setup=copy_arg(gpd.GeoDataFrame(prepared_lines, geometry="geometry")),
+        rounds=ROUNDS,
+    )
+    assert set(df["country"]) <= set(country_lookup.names)
+
+
+def test_clean_data(benchmark, raw_osm_files, test_shape, country_lookup, tmp_path):
+    output_files = {
+        name: str(tmp_path / f"{name}.geojson")
+        for name in ["lines", "substations", "generators"]
+    }
+    output_files["generators_csv"] = str(tmp_path / "generators.csv")
+
+    benchmark.pedantic(
+        clean_data,
+        args=(raw_osm_files, output_files, test_shape, GEO_CRS, DISTANCE_CRS),
+        kwargs=dict(ext_country_shapes=country_lookup),
+        rounds=1,
+    )
+    assert all(os.path.getsize(fn) > 0 for fn in output_files.values())
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests of clean_data against the expected outputs of a small hand-written
+raw OSM dataset; see conftest.py for the two countries of the test shape.
+"""
+import os
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+from _helpers import CountryShapes, read_raw_geodata, save_raw_geodata
+from clean_osm_data import clean_data, count_line_endings
+from shapely.geometry import LineString, MultiLineString, Point, box
+
+GEO_CRS = "EPSG:4326"
+DISTANCE_CRS = "EPSG:3857"
+
+# columns of the outputs compared with the expected values
+LINES_COLUMNS = [
+    "line_id",
+    "voltage",
+    "circuits",
+    "underground",
+    "tag_type",
+    "tag_frequency",
+    "country",
+]
+SUBSTATIONS_COLUMNS = ["bus_id", "voltage", "tag_substation", "lon", "lat", "country"]
+
+# lines 4 (invalid voltage), 5 (low voltage) and 7 (outside the region) and
+# the 33 kV part of line 2 are dropped; the circuits of line 2 and cable 6
+# are derived from the cables
+EXPECTED_LINES = [
+    [1, 220000, 1, False, "line", 50.0, "NG"],
+    [2, 110000, 2, False, "line", 50.0, "NG"],
+    [3, 400000, 2, False, "line", 50.0, "BJ"],
+    [6, 132000, 1, True, "cable", 50.0, "NG"],
+]
+
+# substation 10 is split by voltage; 11 (distribution) and 12 (invalid voltage)
+# are dropped
+EXPECTED_SUBSTATIONS = [
+    ["10-1", 220000, "transmission", 2.0, 2.0, "NG"],
+    ["10-2", 110000, "transmission", 2.0, 2.0, "NG"],
+]
+
+
+def raw_line(x0, y0, x1, y1):
+    return LineString([(x0, y0), (x1, y1)])
+
+
+@pytest.fixture
+def small_osm_files(tmp_path):
+    "Raw input files of a small hand-written OSM dataset for clean_data"
+    raw_data = {
+        "lines": gpd.GeoDataFrame(
+            {
+                "id": [1, 2, 3, 4, 5, 7],
+                "tags.power": "line",
+                "tags.cables": ["3", "6", None, "3", "3", "3"],
+                "tags.voltage": [
+                    "220000",
+                    "110000;33000",
+                    "400000",
+                    "abc",
+                    "11000",
+                    "220000",
+                ],
+                "tags.circuits": ["1", None, "2", "1", "1", "1"],
+                "tags.frequency": ["50", None, "50", "50", "60", "50"],
+                "Country": "NG",
+                "Length": 1.0,
+            },
+            geometry=[
+                raw_line(1, 1, 2, 2),
+                raw_line(2, 2, 3, 1),
+                raw_line(6, 5, 7, 6),
+                raw_line(1, 5, 2, 6),
+                raw_line(3, 3, 4, 4),
+                raw_line(20, 1, 21, 2),
+            ],
+            crs=GEO_CRS,
+        ),
+        "cables": gpd.GeoDataFrame(
+            {
+                "id": [6],
+                "tags.power": "cable",
+                "tags.cables": ["3"],
+                "tags.voltage": ["132000"],
+                "tags.circuits": [None],
+                "tags.frequency": [None],
+                "Country": "NG",
+                "Length": 1.0,
+            },
+            geometry=[raw_line(3, 1, 3.5, 1.5)],
+            crs=GEO_CRS,
+        ),
+        "substations": gpd.GeoDataFrame(
+            {
+                "id": [10, 11, 12],
+                "tags.power": "substation",
+                "tags.substation": ["transmission", "distribution", "transmission"],
+                "tags.voltage": ["220000;110000", "110000", "abc"],
+                "Country": "NG",
+                "Area": 1.0,
+            },
+            geometry=[Point(2, 2), Point(3, 1), Point(6, 5)],
+            crs=GEO_CRS,
+        ),
+        "generators": gpd.GeoDataFrame(
+            {
+                "id": [20, 21, 22],
+                "tags.power": "generator",
+                "tags.generator:source": ["solar", "gas", "wind"],
+                "tags.generator:output:electricity": ["5 MW", "450 MW", "yes"],
+                "tags.name": ["Solar farm", None, None],
+                "Country": "NG",
+                "Area": 1.0,
+            },
+            geometry=[Point(3.4, 6.5), Point(2.4, 6.4), Point(7, 7)],
+            crs=GEO_CRS,
+        ),
+    }
+
+    input_files = {}
+    for name, df in raw_data.items():
+        input_files[name] = str(tmp_path / f"all_raw_{name}.geojson")
+        save_raw_geodata(df, input_files[name])
+
+    return input_files
+
+
+@pytest.fixture
+def shape_files(tmp_path, country_shapes):
+    "Files of the region and country shapes keying the cache of clean_data"
+    files = [str(tmp_path / f"{name}.geojson") for name in ["africa", "country"]]
+    gpd.GeoDataFrame(geometry=[box(-1, -1, 11, 11)], crs=GEO_CRS).to_file(files[0])
+    country_shapes.reset_index().to_file(files[1])
+    return files
+
+
+def run_clean_data(input_files, path, country_shapes, **kwargs):
+    "Run clean_data and read the cleaned lines, substations and generators"
+    os.makedirs(path, exist_ok=True)
+    output_files = {
+        name: os.path.join(path, f"{name}.geojson")
+        for name in ["lines", "substations", "generators"]
+    }
+    output_files["generators_csv"] = os.path.join(path, "generators.csv")
+
+    clean_data(
+        input_files,
+        output_files,
+        box(-1, -1, 11, 11),
+        GEO_CRS,
+        DISTANCE_CRS,
+        ext_country_shapes=CountryShapes(country_shapes),
+        **kwargs,
+    )
+    return (
+        gpd.read_file(output_files["lines"]),
+        gpd.read_file(output_files["substations"]),
+        pd.read_csv(output_files["generators_csv"]),
+    )
+
+
+def to_records(df, columns):
+    return df[columns].sort_values(columns[0]).values.tolist()
+
+
+@pytest.mark.parametrize("chunk_size", [None, 2])
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_clean_data_baseline(
+    tmp_path, small_osm_files, shape_files, country_shapes, chunk_size, use_cache
+):
+    kwargs = dict(add_line_endings=False, chunk_size=chunk_size)
+    if use_cache:
+        kwargs.update(cache_dir=str(tmp_path / "cache"), shape_files=shape_files)
+
+    # the second run reads the cache, when enabled
+    for run in range(2):
+        lines, substations, generators = run_clean_data(
+            small_osm_files, str(tmp_path / f"out_{run}"), country_shapes, **kwargs
+        )
+
+        assert to_records(lines, LINES_COLUMNS) == EXPECTED_LINES
+        assert to_records(substations, SUBSTATIONS_COLUMNS) == EXPECTED_SUBSTATIONS
+        assert generators["id"].tolist() == [20, 21]
+        assert generators["power_output_MW"].tolist() == [5.0, 450.0]
+
+    assert os.path.isdir(tmp_path / "cache") == use_cache
+    # the md5 of the inputs are cached in the cache directory only
+    if use_cache:
+        assert os.listdir(tmp_path / "cache" / "md5")
+    assert not any(fn.endswith(".md5cache") for fn in os.listdir(tmp_path))
+
+
+@pytest.mark.parametrize("raw_format", ["geojson", "flatgeobuf"])
+def test_clean_data_raw_formats(tmp_path, small_osm_files, country_shapes, raw_format):
+    for fn in small_osm_files.values():
+        save_raw_geodata(read_raw_geodata(fn), fn, raw_format)
+
+    # the chunks of the geojson and flatgeobuf files are read from a single reader
+    lines, substations, _ = run_clean_data(
+        small_osm_files,
+        str(tmp_path / "out"),
+        country_shapes,
+        add_line_endings=False,
+        chunk_size=2,
+    )
+
+    assert to_records(lines, LINES_COLUMNS) == EXPECTED_LINES
+    assert to_records(substations, SUBSTATIONS_COLUMNS) == EXPECTED_SUBSTATIONS
+
+
+def test_clean_data_line_endings(tmp_path, small_osm_files, country_shapes):
+    lines, substations, _ = run_clean_data(
+        small_osm_files, str(tmp_path), country_shapes, add_line_endings=True
+    )
+
+    assert to_records(lines, LINES_COLUMNS) == EXPECTED_LINES
+
+    # one substation at each ending of the lines
+    endings = [
+        [220000, 1.0, 1.0, "NG"],
+        [110000, 2.0, 2.0, "NG"],
+        [400000, 6.0, 5.0, "BJ"],
+        [132000, 3.0, 1.0, "NG"],
+        [220000, 2.0, 2.0, "NG"],
+        [110000, 3.0, 1.0, "NG"],
+        [400000, 7.0, 6.0, "BJ"],
+        [132000, 3.5, 1.5, "NG"],
+    ]
+    assert to_records(substations, ["bus_id", "voltage", "lon", "lat", "country"]) == [
+        [i] + ending for i, ending in enumerate(endings)
+    ]
+
+
+def test_clean_data_closest_city(
+    tmp_path, monkeypatch, small_osm_files, country_shapes
+):
+    # the cities of reverse_geocode are cached in data/cities of the working directory
+    monkeypatch.chdir(tmp_path)
+
+    _, _, generators = run_clean_data(
+        small_osm_files,
+        str(tmp_path / "out"),
+        country_shapes,
+        generator_name_method="closest_city",
+    )
+
+    assert generators["name"].tolist() == ["Makoko_0 - NG", "Cotonou_1 - NG"]
+    assert os.listdir(tmp_path / "data" / "cities")
+
+
+def test_count_line_endings():
+    geoms = [
+        raw_line(0, 0, 1, 1),
+        LineString([(0, 0), (1, 0), (1, 1), (0, 0)]),
+        LineString(),
+        MultiLineString([[(0, 0), (1, 1)], [(1, 1), (2, 2)]]),
+        MultiLineString([[(0, 0), (1, 1)], [(1, 1), (0, 0)]]),
+        MultiLineString([[(0, 0), (1, 1)], [(1, 1), (2, 2)], [(1, 1), (3, 0)]]),
+        None,
+    ]
+
+    # same count as the boundary of the lines, by the mod-2 rule
+    expected = [len(g.boundary.geoms) if g is not None else 0 for g in geoms]
+    assert expected == [2, 0, 0, 2, 0, 4, 0]
+    assert count_line_endings(geoms).tolist() == expected
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests of the DownloadManager of _helpers against a local HTTP stand-in server.
+"""
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from _helpers import download_files
+
+FILES = {
+    "/data.bin": bytes(range(256)) * 40,
+    "/small.bin": b"error page",
+}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Handler serving the files of the state, FILES by default, with the ETag
+    of the state and range requests conditioned by If-Range
+
+    The failures of the server are set in the attribute state of the server:
+    the first n_errors requests of a path get a 500 response and
+    the first n_truncated responses of a path send only half of the file
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        state = self.server.state
+        with state["lock"]:
+            state["requests"].append((self.path, self.headers.get("Range")))
+            state["if_range"].append(self.headers.get("If-Range"))
+            n_requests = sum(path == self.path for path, _ in state["requests"])
+            state["active"] += 1
+            state["max_active"] = max(state["max_active"], state["active"])
+
+        try:
+            time.sleep(state["delay"])
+            self._respond(state, n_requests)
+        finally:
+            with state["lock"]:
+                state["active"] -= 1
+
+    def _respond(self, state, n_requests):
+        if self.path not in state["files"]:
+            self.send_error(404)
+            return
+        if n_requests <= state["n_errors"]:
+            self.send_error(500)
+            return
+
+        data = state["files"][self.path]
+        start = 0
+        if self.headers.get("Range") and self.headers.get("If-Range") in [
+            None,
+            state["etag"],
+        ]:
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("ETag", state["etag"])
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+
+        if n_requests <= state["n_errors"] + state["n_truncated"]:
+            # close the connection in the middle of the transfer
+            self.wfile.write(data[start : (start + len(data)) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+
+@pytest.fixture
+def server():
+    "Local HTTP stand-in server; yields its url and its state"
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    httpd.state = dict(
+        lock=threading.Lock(),
+        requests=[],
+        if_range=[],
+        files=dict(FILES),
+        etag='"v1"',
+        n_errors=0,
+        n_truncated=0,
+        delay=0.0,
+        active=0,
+        max_active=0,
+    )
+    thread = threading.Thread(
+        target=httpd.serve_forever, kwargs=dict(poll_interval=0.01), daemon=True
+    )
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", httpd.state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def download(downloads, size_min=0, **kwargs):
+    "download_files without waiting between the retries"
+    return download_files(downloads, size_min=size_min, retry_wait=0, **kwargs)
+
+
+def read(fn):
+    with open(fn, "rb") as f:
+        return f.read()
+
+
+def test_download(server, tmp_path):
+    url, state = server
+    fn = str(tmp_path / "data.bin")
+
+    assert download([(url + "/data.bin", fn)]) == [True]
+    assert read(fn) == FILES["/data.bin"]
+    assert not os.path.exists(fn + ".part")
+
+
+def test_download_retries_server_errors(server, tmp_path):
+    url, state = server
+    state["n_errors"] = 2
+    fn = str(tmp_path / "data.bin")
+
+    assert download([(url + "/data.bin", fn)], retries=2) == [True]
+    assert read(fn) == FILES["/data.bin"]
+    assert len(state["requests"]) == 3
+
+
+def test_download_fails_after_retries(server, tmp_path):
+    url, state = server
+    state["n_errors"] = 3
+    fn = str(tmp_path / "data.bin")
+
+    assert download([(url + "/data.bin", fn)], retries=2) == [False]
+    assert not os.path.exists(fn)
+
+
+def test_download_resumes_incomplete_transfer(server, tmp_path):
+    url, state = server
+    state["n_truncated"] = 1
+    fn = str(tmp_path / "data.bin")
+
+    # chunks smaller than the transfer, so that the partial file is written
+    assert download([(url + "/data.bin", fn)], retries=1, chunk_size=1024) == [True]
+    assert read(fn) == FILES["/data.bin"]
+
+    # the second request resumes the partial file with a range request
+    half = len(FILES["/data.bin"]) // 2
+    assert state["requests"] == [
+        ("/data.bin", None),
+        ("/data.bin", f"bytes={half}-"),
+    ]
+    assert state["if_range"] == [None, '"v1"']
+    assert not os.path.exists(fn + ".part.json")
+
+
+def test_download_restarts_changed_file(server, tmp_path):
+    url, state = server
+    state["n_truncated"] = 1
+    fn = str(tmp_path / "data.bin")
+
+    # partial download of the first version of the file
+    assert download([(url + "/data.bin", fn)], retries=0, chunk_size=1024) == [False]
+    assert os.path.exists(fn + ".part")
+
+    # the file changes on the server: the partial file is not resumed
+    state["files"]["/data.bin"] = FILES["/data.bin"][::-1]
+    state["etag"] = '"v2"'
+    assert download([(url + "/data.bin", fn)], chunk_size=1024) == [True]
+    assert read(fn) == FILES["/data.bin"][::-1]
+    assert state["if_range"][-1] == '"v1"'
+
+
+def test_download_discards_part_without_validator(server, tmp_path):
+    url, state = server
+    fn = str(tmp_path / "data.bin")
+    with open(fn + ".part", "wb") as f:
+        f.write(b"stale partial file")
+
+    assert download([(url + "/data.bin", fn)]) == [True]
+    assert read(fn) == FILES["/data.bin"]
+    assert state["requests"] == [("/data.bin", None)]
+
+
+@pytest.mark.parametrize("extra_bytes", [0, 10])
+def test_download_checks_complete_part(server, tmp_path, extra_bytes):
+    url, state = server
+    fn = str(tmp_path / "data.bin")
+    data = FILES["/data.bin"]
+
+    # partial file of the complete size, or oversized, with a valid validator
+    with open(fn + ".part", "wb") as f:
+        f.write(data + b"x" * extra_bytes)
+    with open(fn + ".part.json", "w") as f:
+        json.dump({"url": url + "/data.bin", "validator": state["etag"]}, f)
+
+    assert download([(url + "/data.bin", fn)], retries=1) == [True]
+    assert read(fn) == data
+
+    # the oversized partial file is discarded and downloaded again
+    expected = [("/data.bin", f"bytes={len(data) + extra_bytes}-")]
+    if extra_bytes:
+        expected.append(("/data.bin", None))
+    assert state["requests"] == expected
+
+
+def test_download_size_min(server, tmp_path):
+    url, state = server
+    fn = str(tmp_path / "data.bin")
+    size_min = len(FILES["/small.bin"])
+
+    # the files of size_min bytes or less are discarded without retries
+    assert download([(url + "/small.bin", fn)], size_min=size_min) == [False]
+    assert not os.path.exists(fn)
+    assert len(state["requests"]) == 1
+
+    # the first alternative url providing a larger file is used
+    urls = [url + "/small.bin", url + "/missing.bin", url + "/data.bin"]
+    assert download([(urls, fn)], size_min=size_min) == [True]
+    assert read(fn) == FILES["/data.bin"]
+
+
+def test_download_skips_completed(server, tmp_path):
+    url, state = server
+    fn = str(tmp_path / "data.bin")
+
+    download([(url + "/data.bin", fn)])
+    assert download([(url + "/data.bin", fn)]) == [True]
+    assert len(state["requests"]) == 1
+
+    # files updated or changed since their download are downloaded again
+    download([(url + "/data.bin", fn)], update=True)
+    assert len(state["requests"]) == 2
+
+    with open(fn, "ab") as f:
+        f.write(b"changed")
+    download([(url + "/data.bin", fn)])
+    assert len(state["requests"]) == 3
+    assert read(fn) == FILES["/data.bin"]
+
+
+def test_download_max_per_host(server, tmp_path):
+    url, state = server
+    state["delay"] = 0.05
+    downloads = [(url + "/data.bin", str(tmp_path / f"data_{i}.bin")) for i in range(8)]
+
+    assert all(download(downloads, max_per_host=2))
+    assert state["max_active"] == 2
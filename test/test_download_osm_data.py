@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Offline tests of download_osm_data.
+
+For the incremental update of the pbf files, a small pbf file and the .osc.gz
+diffs are written in a temporary folder, which is used as local replication
+server; no download is required. These tests are skipped without pyosmium.
+"""
+import gzip
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+from _helpers import read_raw_geodata
+from download_osm_data import (
+    _write_stream_ways,
+    convert_ways_lines,
+    convert_ways_points,
+    get_pbf_paths,
+    get_pbf_sequence_number,
+    process_data,
+    read_state_sequence_number,
+    update_pbf,
+)
+
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+requires_osmium = pytest.mark.skipif(osmium is None, reason="pyosmium not installed")
+
+COUNTRY = "NG"
+FEATURES = ["substation", "line"]
+
+# node index of the tests of the way conversion, as built by build_node_index
+NODE_INDEX = (
+    np.array([1, 2, 3, 4], dtype=np.int64),
+    np.array([[3.0, 6.0], [3.1, 6.0], [3.1, 6.1], [3.0, 6.1]]),
+)
+
+OSC_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="test">
+{changes}
+</osmChange>
+"""
+
+
+def write_pbf(fn):
+    "Write a pbf file with a power line of two nodes and an untagged node"
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    writer = osmium.SimpleWriter(fn)
+    for node_id, lon in [(1, 3.0), (2, 3.1), (5, 3.2)]:
+        writer.add_node(
+            osmium.osm.mutable.Node(id=node_id, version=1, location=(lon, 6.0))
+        )
+    writer.add_way(
+        osmium.osm.mutable.Way(id=10, version=1, nodes=[1, 2], tags={"power": "line"})
+    )
+    writer.close()
+
+
+def write_state(fn, sequence_number):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, "w") as f:
+        f.write(f"sequenceNumber={sequence_number}\n")
+
+
+def write_osc(fn, changes):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with gzip.open(fn, "wt") as f:
+        f.write(OSC_TEMPLATE.format(changes=changes))
+
+
+def read_pbf_ids(fn):
+    "Ids of the nodes and of the ways of a pbf file"
+    ids = {"n": set(), "w": set()}
+    for obj in osmium.FileProcessor(fn):
+        if obj.type_str() in ids:
+            ids[obj.type_str()].add(obj.id)
+    return ids
+
+
+@pytest.fixture
+def local_replication(tmp_path, monkeypatch):
+    """
+    Pbf file of the country at sequence 1 and local replication server at sequence 2
+
+    Returns the path of the pbf file, of the replication server and of the diff
+    """
+    monkeypatch.chdir(tmp_path)
+    _, PBF_inputfile = get_pbf_paths(COUNTRY)
+    write_pbf(PBF_inputfile)
+    write_state(PBF_inputfile + ".state.txt", 1)
+
+    diff_source = str(tmp_path / "replication")
+    updates_path = os.path.join(diff_source, "africa", "nigeria-updates")
+    write_state(os.path.join(updates_path, "state.txt"), 2)
+    osc_file = os.path.join(updates_path, "000", "000", "002.osc.gz")
+
+    return PBF_inputfile, diff_source, osc_file
+
+
+def write_filtered_data(tmp_path):
+    "Pre-filtered data of the country, as stored by download_and_filter"
+    fn = tmp_path / "data" / "osm" / "africa" / f"Data_{COUNTRY}.pickle"
+    Data = {"Node": {"1": {}, "2": {}}, "Way": {"10": {}}, "Relation": {}}
+    with open(fn, "wb") as f:
+        pickle.dump(Data, f)
+
+
+@requires_osmium
+def test_update_pbf_applies_diff(local_replication):
+    PBF_inputfile, diff_source, osc_file = local_replication
+    write_osc(
+        osc_file,
+        '<create><node id="3" version="1" lat="6.1" lon="3.3">'
+        '<tag k="power" v="substation"/></node></create>',
+    )
+
+    assert update_pbf(COUNTRY, FEATURES, diff_source)
+
+    ids = read_pbf_ids(PBF_inputfile)
+    assert ids["n"] == {1, 2, 3, 5}
+    assert ids["w"] == {10}
+    assert read_state_sequence_number(PBF_inputfile + ".state.txt") == 2
+    assert get_pbf_sequence_number(PBF_inputfile) == 2
+
+
+@requires_osmium
+def test_update_pbf_unrelated_changes(local_replication, tmp_path):
+    PBF_inputfile, diff_source, osc_file = local_replication
+    write_filtered_data(tmp_path)
+    write_osc(
+        osc_file,
+        '<delete><node id="5" version="2" lat="6.0" lon="3.2"/></delete>',
+    )
+
+    # the diff is applied, but the power features did not change
+    assert not update_pbf(COUNTRY, FEATURES, diff_source)
+    assert read_pbf_ids(PBF_inputfile)["n"] == {1, 2}
+
+
+@requires_osmium
+def test_update_pbf_moved_power_node(local_replication, tmp_path):
+    PBF_inputfile, diff_source, osc_file = local_replication
+    write_filtered_data(tmp_path)
+    write_osc(
+        osc_file,
+        '<modify><node id="1" version="2" lat="6.5" lon="3.0"/></modify>',
+    )
+
+    # the node of the power line has moved
+    assert update_pbf(COUNTRY, FEATURES, diff_source)
+
+
+@requires_osmium
+def test_update_pbf_up_to_date(local_replication):
+    PBF_inputfile, diff_source, _ = local_replication
+    write_state(PBF_inputfile + ".state.txt", 2)
+
+    assert not update_pbf(COUNTRY, FEATURES, diff_source)
+    assert read_pbf_ids(PBF_inputfile)["n"] == {1, 2, 5}
+
+
+@requires_osmium
+def test_process_data_filters_changed_countries(local_replication, tmp_path):
+    PBF_inputfile, diff_source, osc_file = local_replication
+    write_osc(
+        osc_file,
+        '<create><node id="3" version="1" lat="6.1" lon="3.3">'
+        '<tag k="power" v="substation"/></node></create>',
+    )
+    output_files = {
+        f"{feature}s": str(tmp_path / "raw" / f"all_raw_{feature}s.geojson")
+        for feature in FEATURES
+    }
+    kwargs = dict(engine="stream", diff_source=diff_source)
+
+    process_data(FEATURES, [COUNTRY], output_files, "EPSG:4326", "EPSG:3857", **kwargs)
+    assert read_raw_geodata(output_files["substations"]).empty
+    assert len(read_raw_geodata(output_files["lines"])) == 1
+
+    # the streamed data of the updated country are filtered again; the updated
+    # pbf file is kept, without md5 verification against Geofabrik
+    process_data(
+        FEATURES,
+        [COUNTRY],
+        output_files,
+        "EPSG:4326",
+        "EPSG:3857",
+        incremental=True,
+        verify=True,
+        **kwargs,
+    )
+    assert read_raw_geodata(output_files["substations"])["id"].tolist() == [3]
+    assert len(read_raw_geodata(output_files["lines"])) == 1
+    assert get_pbf_sequence_number(PBF_inputfile) == 2
+    assert not os.path.exists(PBF_inputfile + ".md5")
+
+
+@pytest.mark.parametrize(
+    "refs, kept_ids",
+    [([[99], [1, 2, 3]], [1]), ([[1, 2, 3], [99]], [0]), ([[99]], [])],
+)
+def test_convert_ways_points_missing_refs(refs, kept_ids):
+    df_way = pd.DataFrame({"id": np.arange(len(refs)), "refs": refs})
+    convert_ways_points(df_way, NODE_INDEX, "EPSG:4326", "EPSG:3857")
+
+    # the ways whose refs are all missing are dropped
+    assert df_way["id"].tolist() == kept_ids
+    # the centroid of the triangle is the mean of its nodes
+    for lonlat in df_way["lonlat"]:
+        assert lonlat == pytest.approx(NODE_INDEX[1][:3].mean(axis=0))
+
+
+def test_convert_ways_lines_missing_refs():
+    df_way = pd.DataFrame({"id": [0, 1, 2], "refs": [[99, 98], [1, 99], [1, 2, 99]]})
+    convert_ways_lines(df_way, NODE_INDEX, "EPSG:4326", "EPSG:3857")
+
+    # the ways with less than two resolved nodes are dropped
+    assert df_way["id"].tolist() == [2]
+    assert df_way["lonlat"].tolist() == [[(3.0, 6.0), (3.1, 6.0)]]
+    assert (df_way["Length"] > 0).all()
+
+
+@pytest.mark.parametrize("feature", ["substation", "line"])
+def test_write_stream_ways_missing_refs(tmp_path, feature):
+    ways = [{"id": 0, "refs": [99, 98], "tags": {"power": feature}}]
+    _write_stream_ways(
+        ways, feature, COUNTRY, NODE_INDEX, "EPSG:3857", str(tmp_path), 0
+    )
+
+    # a chunk whose ways are all dropped is written as an empty part
+    df = read_raw_geodata(str(tmp_path / f"{feature}s_way_00000.geojson"))
+    assert df.empty